@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+マルチターンのクエリ1回あたりのファイル操作回数を数えるベンチマーク
+
+read_prompt_file と add_input_output_pair を繰り返し、その間に発生した
+ファイル関連の監査イベント（open、os.replaceなど）を sys.addaudithook で数える。
+設定ファイルの書き込みはプロセス終了時にまとめて行われるため、最後に
+PromptFile.flush_config を呼んだ分も含めて1クエリあたりの回数を出す。
+
+使い方: python benchmarks/config_syscalls.py [クエリ回数]
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+from collections import Counter
+from pathlib import Path
+from unittest.mock import patch
+
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+# ファイルシステムに触れる監査イベント
+FILE_EVENTS = {
+    'open', 'os.rename', 'os.replace', 'os.remove', 'os.mkdir', 'os.listdir',
+    'os.scandir', 'os.truncate', 'os.chmod', 'shutil.copyfile', 'sqlite3.connect',
+}
+
+events = Counter()
+recording = False
+
+
+def audit(event, args):
+    if recording and event in FILE_EVENTS:
+        events[event] += 1
+
+
+def main():
+    global recording
+    queries = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+    temp_dir = tempfile.mkdtemp()
+    os.environ['CODEX_CACHE_DIR'] = temp_dir
+    from prompt_file import PromptFile
+
+    config = {'model': 'gpt-4o', 'temperature': 0, 'max_tokens': 300,
+              'shell': 'zsh', 'multi_turn': 'on', 'token_count': 0, 'language': 'en'}
+    with patch.object(PromptFile, 'default_file_path', os.path.join(temp_dir, "current_context.txt")), \
+            patch.object(PromptFile, 'default_config_path', os.path.join(temp_dir, "current_context.config")):
+        prompt_file = PromptFile("zsh-context.txt", config, "default")
+
+        sys.addaudithook(audit)
+        recording = True
+        for i in range(queries):
+            query = "# list the files changed in the last {} days".format(i)
+            prompt_file.read_prompt_file(query)
+            prompt_file.add_input_output_pair(query, "find . -mtime -{}".format(i))
+        if hasattr(prompt_file, 'flush_config'):
+            prompt_file.flush_config()
+        recording = False
+
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    result = {
+        'queries': queries,
+        'file_events_per_query': round(sum(events.values()) / queries, 2),
+        'by_event': {name: round(count / queries, 2) for name, count in sorted(events.items())},
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
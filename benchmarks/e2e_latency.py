@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ローカルのOpenAI互換サーバーを相手にしたエンドツーエンドの遅延ベンチマーク
+
+fake_openai_server.py をスレッドで起動してOPENAI_BASE_URLをそこへ向け、
+実際のプロセス起動とHTTP通信を含めて次のシナリオを計測する。
+    builtin_direct   組み込みコマンドを毎回新しいプロセスで実行（コールドスタート）
+    query_direct     クエリを毎回新しいプロセスで実行
+    builtin_daemon   組み込みコマンドを常駐サーバー経由で実行
+    query_daemon     クエリを常駐サーバー経由で実行
+    multi_turn       マルチターンモードで連続したクエリを常駐サーバー経由で実行
+各実行について、全体の時間、最初の応答バイトまでの時間（TTFT、処理中メッセージは除く）、
+応答の転送速度（bytes/s）を測り、中央値などをJSONで書き出す。
+--compareに以前の結果を指定すると、中央値が--threshold倍を超えて遅くなった項目を表示して
+終了コード1を返す。
+
+使い方:
+    python benchmarks/e2e_latency.py --runs 5 --output results/e2e-$(git rev-parse --short HEAD).json
+    python benchmarks/e2e_latency.py --chunk-chars 1 --chunk-delay 0.02 --compare results/previous.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+from fake_openai_server import FakeOpenAIServer
+
+ROOT = Path(__file__).resolve().parent.parent
+QUERY_SCRIPT = str(ROOT / "src" / "codex_query_integrated.py")
+CLIENT_SCRIPT = str(ROOT / "src" / "codex_client.py")
+
+# 処理中メッセージと、その消去（これより後が応答）
+PROGRESS = "処理中".encode('utf-8')
+CLEAR_MARKER = b"\r                 \r"
+BUILTIN_QUERY = "# show config"
+QUERIES = [
+    "# list the files in the current folder",
+    "# show the disk usage of the home folder",
+    "# find python files changed in the last day",
+    "# count the lines in all markdown files",
+]
+METRICS = ('total_ms', 'ttft_ms', 'bytes_per_s')
+
+
+def measure(args, text, env):
+    """プロセスを実行し、出力を受け取りながら時間を測る"""
+    start = time.perf_counter()
+    process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+    process.stdin.write(text.encode('utf-8'))
+    process.stdin.close()
+
+    output = b""
+    first_byte = None
+    response_start = 0
+    fd = process.stdout.fileno()
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        now = time.perf_counter()
+        output += data
+        marker = output.find(CLEAR_MARKER)
+        if marker >= 0:
+            response_start = marker + len(CLEAR_MARKER)
+        # 処理中メッセージの後に最初の応答が届いた時刻
+        if first_byte is None and len(output) > response_start and (marker >= 0 or PROGRESS not in output):
+            first_byte = now
+    process.wait()
+    end = time.perf_counter()
+
+    first_byte = first_byte if first_byte is not None else end
+    response_bytes = len(output) - response_start
+    streaming = end - first_byte
+    return {
+        'total_ms': (end - start) * 1000,
+        'ttft_ms': (first_byte - start) * 1000,
+        'bytes': response_bytes,
+        'bytes_per_s': response_bytes / streaming if streaming > 0 else None,
+        'exit_code': process.returncode,
+    }
+
+
+def summarize(samples):
+    """各指標の中央値、最小値、最大値（とp95）"""
+    summary = {'runs': len(samples), 'failures': sum(1 for s in samples if s['exit_code'] != 0)}
+    for metric in METRICS:
+        values = sorted(s[metric] for s in samples if s[metric] is not None)
+        if not values:
+            continue
+        summary[metric] = {
+            'median': round(statistics.median(values), 2),
+            'p95': round(values[min(len(values) - 1, int(len(values) * 0.95))], 2),
+            'min': round(values[0], 2),
+            'max': round(values[-1], 2),
+        }
+    summary['bytes'] = samples[-1]['bytes'] if samples else 0
+    return summary
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=str(ROOT), stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scenarios(env, runs, turns):
+    direct = [sys.executable, QUERY_SCRIPT]
+    client = [sys.executable, CLIENT_SCRIPT, "--shell", "bash"]
+    results = {}
+
+    results['builtin_direct'] = summarize([measure(direct, BUILTIN_QUERY, env) for _ in range(runs)])
+    results['query_direct'] = summarize([measure(direct, QUERIES[i % len(QUERIES)], env) for i in range(runs)])
+
+    # 常駐サーバーの起動は計測しない（codex_client.py --benchで計測できる）
+    measure(client, BUILTIN_QUERY, env)
+    results['builtin_daemon'] = summarize([measure(client, BUILTIN_QUERY, env) for _ in range(runs)])
+    results['query_daemon'] = summarize([measure(client, QUERIES[i % len(QUERIES)], env) for i in range(runs)])
+
+    measure(client, "# start multi-turn", env)
+    samples = []
+    for _ in range(runs):
+        measure(client, "# clear", env)
+        samples.extend(measure(client, QUERIES[i % len(QUERIES)], env) for i in range(turns))
+    measure(client, "# stop multi-turn", env)
+    results['multi_turn'] = summarize(samples)
+
+    subprocess.run(client + ["--stop"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """中央値がthreshold倍を超えて悪化した項目を返す"""
+    regressions = []
+    for name, summary in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        for metric in ('total_ms', 'ttft_ms'):
+            if metric in summary and metric in previous and previous[metric]['median'] > 0:
+                ratio = summary[metric]['median'] / previous[metric]['median']
+                if ratio > threshold:
+                    regressions.append("{} {}: {:.1f} -> {:.1f} ms ({:.2f}x)".format(
+                        name, metric, previous[metric]['median'], summary[metric]['median'], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end latency benchmark against a local fake OpenAI server")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--turns', type=int, default=4, help="queries per multi-turn session")
+    parser.add_argument('--chunk-chars', type=int, default=4)
+    parser.add_argument('--chunk-delay', type=float, default=0.005)
+    parser.add_argument('--first-token-delay', type=float, default=0.05)
+    parser.add_argument('--moderation-delay', type=float, default=0.02)
+    parser.add_argument('--response-chars', type=int, default=80)
+    parser.add_argument('--output', help="write the JSON results to this file (default: stdout)")
+    parser.add_argument('--compare', help="previous results to compare against")
+    parser.add_argument('--threshold', type=float, default=1.2)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(chunk_chars=args.chunk_chars, chunk_delay=args.chunk_delay,
+                              first_token_delay=args.first_token_delay, moderation_delay=args.moderation_delay,
+                              response_chars=args.response_chars).start()
+    temp_dir = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env.update({
+        'OPENAI_BASE_URL': server.base_url,
+        'OPENAI_API_KEY': 'benchmark',
+        'CODEX_CACHE_DIR': temp_dir,
+        'CODEX_DAEMON_DIR': temp_dir,
+        'CODEX_SESSION': 'benchmark',
+        'CODEX_NO_CACHE': '1',
+        'CODEX_HISTORY_LOOKUP': '0',
+        'CODEX_NO_DAEMON': '',
+    })
+    try:
+        scenarios = run_scenarios(env, args.runs, args.turns)
+    finally:
+        server.stop()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'runs': args.runs,
+            'turns': args.turns,
+            'server': {
+                'chunk_chars': args.chunk_chars,
+                'chunk_delay': args.chunk_delay,
+                'first_token_delay': args.first_token_delay,
+                'moderation_delay': args.moderation_delay,
+                'response_chars': args.response_chars,
+            },
+        },
+        'scenarios': scenarios,
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print("# regression: " + line, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ベンチマークとテスト用の、OpenAI互換のローカルHTTPサーバー
+
+/v1/chat/completions（ストリーミングと通常の応答）と /v1/moderations を実装し、
+応答を分割する文字数、差分の間隔、最初の差分までの遅延、モデレーションの遅延を
+変更できる。最初のN回のチャットのリクエストに429（Retry-After付き）を返したり、
+最初の差分を長く止めたりして、再試行とヘッジリクエストを試せる。OPENAI_BASE_URLをbase_urlに向けると、openaiライブラリから実際の
+HTTP通信を含めて呼び出せる。
+
+使い方:
+    python benchmarks/fake_openai_server.py --port 8765 --chunk-chars 4 --chunk-delay 0.01
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=dummy python src/codex_query_integrated.py
+
+テストからはスレッドで起動する:
+    server = FakeOpenAIServer(chunk_delay=0).start()
+    ...
+    server.stop()
+"""
+
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 応答のコマンド部分を指定の長さにするための埋め草
+FILLER = "abcdefghijklmnopqrstuvwxyz0123456789"
+
+
+def _estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+class FakeOpenAIServer:
+    def __init__(self, host='127.0.0.1', port=0, chunk_chars=4, chunk_delay=0.005, first_token_delay=0.05,
+                 moderation_delay=0.02, response_chars=80, flagged_words=(), pairs=1,
+                 rate_limit_count=0, retry_after=0.1, stall_count=0, stall_delay=5.0):
+        """
+        chunk_chars: ストリーミングの差分1つあたりの文字数
+        chunk_delay: 差分の間隔（秒）
+        first_token_delay: リクエストを受けてから最初の差分までの遅延（秒）
+        moderation_delay: モデレーションの応答までの遅延（秒）
+        response_chars: 応答のコマンド部分のおよその文字数
+        flagged_words: 入力に含まれるとモデレーションで不適切と判定する語
+        pairs: 応答に含めるコメントとコマンドの組の数
+        rate_limit_count: 最初のこの回数のチャットのリクエストに429を返す
+        retry_after: 429の応答のRetry-Afterヘッダーの秒数（Noneなら付けない）
+        stall_count: 429を返さなかった最初のこの回数のチャットのリクエストで最初の差分を止める
+        stall_delay: 止める場合の最初の差分までの遅延（秒）
+        """
+        self.chunk_chars = chunk_chars
+        self.chunk_delay = chunk_delay
+        self.first_token_delay = first_token_delay
+        self.moderation_delay = moderation_delay
+        self.response_chars = response_chars
+        self.flagged_words = tuple(flagged_words)
+        self.pairs = pairs
+        self.rate_limit_count = rate_limit_count
+        self.retry_after = retry_after
+        self.stall_count = stall_count
+        self.stall_delay = stall_delay
+        self._chats = 0
+        # 受け付けたリクエストの(パス, 受信時刻)
+        self.requests = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+        server = self
+
+        class Handler(_Handler):
+            fake = server
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{}:{}/v1".format(host, port)
+
+    def start(self):
+        """バックグラウンドのスレッドで起動する"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def record(self, path):
+        with self._lock:
+            self.requests.append((path, time.monotonic()))
+
+    def count(self, path):
+        """指定したパスへのリクエスト数"""
+        with self._lock:
+            return sum(1 for recorded, _ in self.requests if recorded.endswith(path))
+
+    def next_fault(self):
+        """
+        チャットのリクエストの順番から注入する障害を決める
+        Returns: 'rate_limit'、'stall'、またはNone
+        """
+        with self._lock:
+            number = self._chats
+            self._chats += 1
+        if number < self.rate_limit_count:
+            return 'rate_limit'
+        if number < self.rate_limit_count + self.stall_count:
+            return 'stall'
+        return None
+
+    def make_response(self, messages):
+        """最後のユーザーメッセージの最終行をコメントにした応答を作る（2組目以降は「# step N」）"""
+        prompt = messages[-1].get("content", "") if messages else ""
+        lines = [line for line in prompt.splitlines() if line.strip()]
+        comment = lines[-1] if lines else "# query"
+        if not comment.startswith('#'):
+            comment = '# ' + comment
+        filler = (FILLER * (self.response_chars // len(FILLER) + 1))[:max(0, self.response_chars - 5)]
+        response = "{}\necho {}\n".format(comment, filler)
+        for step in range(2, self.pairs + 1):
+            response += "# step {}\necho {}\n".format(step, filler)
+        return response
+
+
+def _truncate(content, request):
+    """
+    max_tokensと停止シーケンスで応答を切り詰める
+    Returns: (応答, finish_reason)
+    """
+    stops = request.get("stop") or []
+    if isinstance(stops, str):
+        stops = [stops]
+    positions = [content.find(stop) for stop in stops if stop and stop in content]
+    if positions:
+        content = content[:min(positions)]
+    max_tokens = request.get("max_tokens")
+    if max_tokens and _estimate_tokens(content) > max_tokens:
+        return content[:max_tokens * 4], "length"
+    return content, "stop"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントが接続を閉じた（ヘッジリクエストの遅い方など）
+            self.close_connection = True
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b""
+        return json.loads(body.decode('utf-8')) if body else {}
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        self.wfile.write("{:x}\r\n".format(len(data)).encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        self.fake.record(self.path)
+        request = self._read_json()
+        if self.path.endswith("/chat/completions"):
+            self._chat(request)
+        elif self.path.endswith("/moderations"):
+            self._moderation(request)
+        else:
+            self._send_json(404, {"error": {"message": "not found: " + self.path, "type": "invalid_request_error"}})
+
+    def _moderation(self, request):
+        fake = self.fake
+        time.sleep(fake.moderation_delay)
+        inputs = request.get("input", "")
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        results = []
+        for text in inputs:
+            results.append({
+                "flagged": any(word in text for word in fake.flagged_words),
+                "categories": {},
+                "category_scores": {},
+            })
+        self._send_json(200, {"id": "modr-fake", "model": "omni-moderation-latest", "results": results})
+
+    def _chat(self, request):
+        fake = self.fake
+        fault = fake.next_fault()
+        if fault == 'rate_limit':
+            headers = {} if fake.retry_after is None else {'Retry-After': str(fake.retry_after)}
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                            "code": "rate_limit_exceeded"}}, headers)
+            return
+        model = request.get("model", "gpt-4o")
+        content, finish_reason = _truncate(fake.make_response(request.get("messages", [])), request)
+        prompt_tokens = sum(_estimate_tokens(m.get("content", "")) for m in request.get("messages", []))
+        time.sleep(fake.stall_delay if fault == 'stall' else fake.first_token_delay)
+
+        if not request.get("stream"):
+            completion_tokens = _estimate_tokens(content)
+            self._send_json(200, {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": finish_reason}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def event(delta, finish_reason=None):
+            data = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            self._write_chunk(b"data: " + json.dumps(data, ensure_ascii=False).encode('utf-8') + b"\n\n")
+
+        try:
+            event({"role": "assistant", "content": ""})
+            step = max(1, fake.chunk_chars)
+            for start in range(0, len(content), step):
+                if start and fake.chunk_delay:
+                    time.sleep(fake.chunk_delay)
+                event({"content": content[start:start + step]})
+            event({}, finish_reason)
+            self._write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントがストリームを途中で閉じた
+            self.close_connection = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--chunk-chars', type=int, default=4)
+    parser.add_argument('--chunk-delay', type=float, default=0.005)
+    parser.add_argument('--first-token-delay', type=float, default=0.05)
+    parser.add_argument('--moderation-delay', type=float, default=0.02)
+    parser.add_argument('--response-chars', type=int, default=80)
+    parser.add_argument('--pairs', type=int, default=1)
+    parser.add_argument('--rate-limit-count', type=int, default=0)
+    parser.add_argument('--retry-after', type=float, default=0.1)
+    parser.add_argument('--stall-count', type=int, default=0)
+    parser.add_argument('--stall-delay', type=float, default=5.0)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(args.host, args.port, args.chunk_chars, args.chunk_delay, args.first_token_delay,
+                              args.moderation_delay, args.response_chars, pairs=args.pairs,
+                              rate_limit_count=args.rate_limit_count, retry_after=args.retry_after,
+                              stall_count=args.stall_count, stall_delay=args.stall_delay)
+    print("OPENAI_BASE_URL={}".format(server.base_url), flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ログ設定ごとの1クエリあたりのオーバーヘッドを比べるベンチマーク
+
+read_prompt_file、generate_response（APIの代わりに固定のストリームを返すクライアント）、
+add_input_output_pair を繰り返し、次の設定で1クエリあたりの時間を測る。
+    sync-debug     以前の設定（logging.basicConfigでDEBUGを同期的にファイルへ書き込む）
+    queue-debug    キュー経由、CODEX_LOG_LEVEL=DEBUG
+    queue-warning  キュー経由、CODEX_LOG_LEVEL=WARNING（デフォルト）
+    off            CODEX_LOG_LEVEL=OFF
+ルートロガーの設定はプロセス全体に影響するため、設定ごとに別プロセスで実行する。
+
+使い方: python benchmarks/logging_overhead.py [クエリ回数]
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+from pathlib import Path
+
+MODES = ('sync-debug', 'queue-debug', 'queue-warning', 'off')
+
+
+def run_child(queries, log_file):
+    """1つの設定でクエリを繰り返し、1クエリあたりのマイクロ秒を返す"""
+    import io
+    import time
+    import logging
+    from types import SimpleNamespace
+    from unittest.mock import patch
+
+    if os.environ['CODEX_LOG_MODE'] == 'sync-debug':
+        logging.basicConfig(filename=log_file, level=logging.DEBUG,
+                            format='%(asctime)s - %(levelname)s - %(message)s')
+
+    sys.path.append(str(Path(__file__).parent.parent / 'src'))
+    import codex_query_integrated as codex
+    from prompt_file import PromptFile
+    from log_config import stop_logging
+
+    deltas = ["# list", " files", "\n", "ls", " -la", "\n"] * 5
+
+    class FakeClient:
+        def __init__(self):
+            self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+        def create(self, **kwargs):
+            return [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=d))]) for d in deltas]
+
+    temp_dir = os.environ['CODEX_CACHE_DIR']
+    config = {'model': 'gpt-4o', 'temperature': 0, 'max_tokens': 300,
+              'shell': 'bash', 'multi_turn': 'on', 'token_count': 0, 'language': 'en'}
+    client = FakeClient()
+    with patch.object(PromptFile, 'default_file_path', os.path.join(temp_dir, "current_context.txt")), \
+            patch.object(PromptFile, 'default_config_path', os.path.join(temp_dir, "current_context.config")), \
+            patch('sys.stdout', io.StringIO()):
+        prompt_file = PromptFile("bash-context.txt", config, "default")
+        start = time.perf_counter()
+        for i in range(queries):
+            query = "# list the files changed in the last {} days".format(i)
+            prompt = prompt_file.read_prompt_file(query)
+            codex.generate_response(prompt + query, 'gpt-4o', client, 'en', 'bash')
+            prompt_file.add_input_output_pair(query, "find . -mtime -{}".format(i))
+        elapsed = time.perf_counter() - start
+        prompt_file.flush_config()
+    # キューに残ったログの書き込みは計測に含めない（プロセス終了時に行われる）
+    stop_logging()
+    return elapsed / queries * 1e6
+
+
+def main():
+    if os.environ.get('CODEX_LOG_MODE'):
+        print(json.dumps(run_child(int(sys.argv[1]), os.environ['CODEX_LOG_FILE'])))
+        return
+
+    queries = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    results = {'queries': queries, 'us_per_query': {}, 'log_bytes': {}}
+    for mode in MODES:
+        temp_dir = tempfile.mkdtemp()
+        log_file = os.path.join(temp_dir, "codex_debug.log")
+        env = dict(os.environ, CODEX_LOG_MODE=mode, CODEX_CACHE_DIR=temp_dir, CODEX_LOG_FILE=log_file,
+                   CODEX_LOG_LEVEL={'queue-debug': 'DEBUG', 'off': 'OFF'}.get(mode, 'WARNING'))
+        output = subprocess.run([sys.executable, __file__, str(queries)], env=env,
+                                stdout=subprocess.PIPE, check=True).stdout
+        results['us_per_query'][mode] = round(json.loads(output.decode('utf-8').strip().splitlines()[-1]), 1)
+        results['log_bytes'][mode] = os.path.getsize(log_file) if os.path.exists(log_file) else 0
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+シェル検出（detect_shell）の時間とpsutilの読み込みを比べるベンチマーク
+
+シナリオごとに新しいプロセスでdetect_shell()を1回呼び、かかった時間と
+psutilが読み込まれたかどうかを記録する。
+    process-psutil  /procが使えない環境（macOSなど）で親プロセスを調べる（以前は毎回これ）
+    process-proc    /procから親プロセス名を読む
+    cache-hit       親プロセスごとのキャッシュファイルを使う
+    env             プラグインが設定する環境変数CODEX_SHELLを使う
+
+使い方: python benchmarks/shell_detection.py [各シナリオの実行回数]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+SCENARIOS = ('process-psutil', 'process-proc', 'cache-hit', 'env')
+
+
+def run_child(scenario):
+    import builtins
+    from unittest.mock import patch
+
+    sys.path.append(str(Path(__file__).parent.parent / 'src'))
+    import codex_query_integrated as codex
+    import shell_cache
+
+    real_open = builtins.open
+
+    def open_without_proc(path, *args, **kwargs):
+        if str(path).startswith('/proc/'):
+            raise OSError("no /proc")
+        return real_open(path, *args, **kwargs)
+
+    if scenario == 'cache-hit':
+        shell_cache.store('bash', str(codex.PROMPT_CONTEXT))
+    elif scenario.startswith('process-'):
+        # 親プロセスを調べるシナリオではキャッシュを使わない
+        shell_cache.lookup = lambda *args, **kwargs: None
+
+    with patch('builtins.open', open_without_proc if scenario == 'process-psutil' else real_open):
+        start = time.perf_counter()
+        codex.detect_shell()
+        elapsed = time.perf_counter() - start
+    return {'ms': elapsed * 1000, 'psutil_imported': 'psutil' in sys.modules, 'shell': codex.SHELL}
+
+
+def main():
+    if os.environ.get('CODEX_BENCH_SCENARIO'):
+        print(json.dumps(run_child(os.environ['CODEX_BENCH_SCENARIO'])))
+        return
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    results = {'runs': runs, 'scenarios': {}}
+    for scenario in SCENARIOS:
+        temp_dir = tempfile.mkdtemp()
+        env = dict(os.environ, CODEX_BENCH_SCENARIO=scenario, CODEX_CACHE_DIR=temp_dir)
+        env.pop('CODEX_SHELL', None)
+        if scenario == 'env':
+            env['CODEX_SHELL'] = 'bash'
+        samples = []
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, __file__], env=env, stdout=subprocess.PIPE, check=True).stdout
+            samples.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        results['scenarios'][scenario] = {
+            'median_ms': round(statistics.median(s['ms'] for s in samples), 3),
+            'psutil_imported': any(s['psutil_imported'] for s in samples),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+組み込みコマンドの起動時間を計測するベンチマーク
+
+python -X importtime でcodex_query_integrated.pyを組み込みコマンドごとに実行し、
+インポート時間の合計と実行時間（プロセスの起動から終了まで）を予算と比べる。
+どれかが予算を超えた場合は終了コード1で終わる（CIで任意に実行する場合に使う）。
+
+使い方: python benchmarks/startup_budget.py [繰り返し回数]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent
+sys.path.append(str(PROJECT_ROOT / 'tests'))
+
+from test_startup_budget import parse_importtime
+
+# 起動予算（ミリ秒）。openaiを読み込むと単体で数百ミリ秒かかる
+IMPORT_BUDGET_MS = 150
+WALL_BUDGET_MS = 1500
+
+COMMANDS = ("# show config", "# start multi-turn", "# load context bash-context")
+
+
+def run(temp_dir, command):
+    env = dict(os.environ)
+    env.update({
+        'OPENAI_API_KEY': 'test_api_key',
+        'HOME': temp_dir,
+        'USERPROFILE': temp_dir,
+        'PYTHONDONTWRITEBYTECODE': '1',
+    })
+    script = os.path.join(temp_dir, 'src', 'codex_query_integrated.py')
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', script], input=command.encode('utf-8'),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=temp_dir, timeout=30)
+    wall_ms = (time.perf_counter() - start) * 1000
+    import_ms = sum(us for _, us in parse_importtime(result.stderr.decode('utf-8', errors='replace'))) / 1000
+    return import_ms, wall_ms
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    # リポジトリのファイルを書き換えないよう、一時ディレクトリにコピーして実行する
+    temp_dir = tempfile.mkdtemp()
+    shutil.copytree(PROJECT_ROOT / 'src', os.path.join(temp_dir, 'src'), ignore=shutil.ignore_patterns('__pycache__'))
+    shutil.copytree(PROJECT_ROOT / 'contexts', os.path.join(temp_dir, 'contexts'))
+
+    results = {}
+    try:
+        for command in COMMANDS:
+            # 最も速い回を使う（他のプロセスの負荷の影響を減らす）
+            samples = [run(temp_dir, command) for _ in range(repeat)]
+            import_ms = min(sample[0] for sample in samples)
+            wall_ms = min(sample[1] for sample in samples)
+            results[command] = {
+                'import_ms': round(import_ms, 1),
+                'wall_ms': round(wall_ms, 1),
+                'within_budget': import_ms < IMPORT_BUDGET_MS and wall_ms < WALL_BUDGET_MS,
+            }
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    print(json.dumps({'import_budget_ms': IMPORT_BUDGET_MS, 'wall_budget_ms': WALL_BUDGET_MS,
+                      'commands': results}, indent=2, ensure_ascii=False))
+    sys.exit(0 if all(result['within_budget'] for result in results.values()) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ストリーミング出力のwrite回数と時間を比較するベンチマーク
+
+2,000個の差分からなる応答を、以前の方式（差分ごとにprint(flush=True)し
+文字列を+=で連結）と、OutputSinkを使う現在の_print_streamで出力し、
+パイプへのwrite呼び出し回数と所要時間を比べる。
+パイプの先が遅い場合（zshプラグインなど）を再現するため、write 1回ごとに
+--delay秒待つこともできる。
+
+使い方:
+    python benchmarks/stream_output.py [--chunks 2000] [--delay 0.0001] [--stream recorded.json]
+    （--streamには差分の文字列のJSON配列を指定する）
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+os.environ.setdefault('CODEX_OUTPUT_MODE', 'line')
+
+import codex_query_integrated as codex
+
+# 実際の応答を差分に分けたときによく現れる断片
+PIECES = ["#", " List", " the", " 10", " largest", " files", " in", " the", " current", " directory", "\n",
+          "find", " .", " -type", " f", " -exec", " du", " -h", " {}", " +", " |", " sort", " -rh",
+          " |", " head", " -n", " 10", "\n"]
+
+
+class CountingPipe(io.RawIOBase):
+    """write回数を数え、必要なら1回ごとに待つ出力先"""
+
+    def __init__(self, delay=0.0):
+        self.writes = 0
+        self.delay = delay
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.writes += 1
+        if self.delay:
+            time.sleep(self.delay)
+        return len(data)
+
+
+def make_stream(chunks):
+    return [PIECES[i % len(PIECES)] for i in range(chunks)]
+
+
+def baseline(contents):
+    """変更前の_print_stream"""
+    print("\r                 \r", end="", flush=True)
+    full_response = ""
+    for content in contents:
+        if content is not None:
+            print(content, end="", flush=True)
+            full_response += content
+    if not full_response.endswith('\n'):
+        print()
+    return full_response
+
+
+def measure(function, contents, delay):
+    pipe = CountingPipe(delay)
+    stream = io.TextIOWrapper(io.BufferedWriter(pipe), encoding='utf-8')
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(stream):
+        function(contents)
+        stream.flush()
+    elapsed = time.perf_counter() - start
+    return {'writes': pipe.writes, 'wall_ms': round(elapsed * 1000, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=2000)
+    parser.add_argument('--delay', type=float, default=0.0)
+    parser.add_argument('--stream')
+    args = parser.parse_args()
+
+    if args.stream:
+        with open(args.stream, 'r', encoding='utf-8') as f:
+            contents = json.load(f)
+    else:
+        contents = make_stream(args.chunks)
+
+    result = {
+        'chunks': len(contents),
+        'delay_s': args.delay,
+        'before': measure(baseline, contents, args.delay),
+        'after': measure(codex._print_stream, contents, args.delay),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
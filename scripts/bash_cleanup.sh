@@ -14,6 +14,8 @@ if [ -f "$HOME/.codexclirc" ]; then
     # Get the path to src/openaiapirc
     if [ -f "$HOME/.codexclirc" ]; then
         CODEX_CLI_PATH=$(grep "CODEX_CLI_PATH=" $HOME/.codexclirc | cut -d'"' -f2)
+        # Stop the background server if it is running
+        python3 "$CODEX_CLI_PATH/src/codex_client.py" --shell bash --stop 2>/dev/null || true
         if [ -f "$CODEX_CLI_PATH/src/openaiapirc" ]; then
             echo "*** Removing $CODEX_CLI_PATH/src/openaiapirc ***"
             rm "$CODEX_CLI_PATH/src/openaiapirc"
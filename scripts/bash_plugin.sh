@@ -3,6 +3,10 @@
 ##         loaded by $HOME/.codexclirc        ##
 ################################################
 
+# Tell the Python scripts which shell this is, so they don't have to
+# inspect the parent process on every completion.
+export CODEX_SHELL=bash
+
 create_completion()
 {
     # Check settings in case the CLI has just been uninstalled
@@ -19,9 +23,16 @@ create_completion()
     fi
     # Get the text typed until now
     text=${READLINE_LINE}
-    completion=$(echo -n "$text" | $CODEX_CLI_PATH/src/codex_query.py)
+    # codex_client.py talks to a background server that keeps the OpenAI
+    # client warm, starting it on first use.
+    completion=$(echo -n "$text" | $CODEX_CLI_PATH/src/codex_client.py --shell bash)
+    local codex_status=$?
     # Add completion to the current buffer
     READLINE_LINE="${text}${completion}"
     # Put the cursor at the end of the line
     READLINE_POINT=${#READLINE_LINE}
+    # 124 means the query hit a timeout; whatever arrived before it is kept
+    if (( codex_status == 124 )); then
+        echo "Codex CLI: timed out, the answer may be incomplete" >&2
+    fi
 }
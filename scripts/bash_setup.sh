@@ -95,7 +95,7 @@ configureApp()
     echo "secret_key=$SECRET_KEY" >> $OPENAI_RC_FILE
     echo "model=$MODEL_NAME" >> $OPENAI_RC_FILE
     echo "language=$LANGUAGE" >> $OPENAI_RC_FILE
-    chmod +x "$CODEX_CLI_PATH/src/codex_query.py"
+    chmod +x "$CODEX_CLI_PATH/src/codex_query_integrated.py" "$CODEX_CLI_PATH/src/codex_client.py"
 }
 
 # Create and load ~/.codexclirc to setup bash 'Ctrl + G' binding
@@ -6,6 +6,9 @@ $OutputEncoding = [System.Text.Encoding]::UTF8
 
 $nl_cli_script = "{{codex_query_path}}"
 
+# シェルの種類を伝え、実行のたびに親プロセスを調べなくて済むようにする
+$env:CODEX_SHELL = "powershell"
+
 # この関数はバッファからの入力を取得しcodex_query_integrated.pyに渡します
 function global:SendToCodex {
     param (
@@ -34,6 +37,8 @@ function global:SendToCodex {
         
         # 直接--fileオプションでPythonスクリプトに渡す
         $output = & python -u $nl_cli_script "--file" "$tempFile" 2>&1
+        # 終了コード124はタイムアウト（それまでに届いた部分は出力に残る）
+        $timedOut = ($LASTEXITCODE -eq 124)
         
         # 一時ファイルを削除
         if (Test-Path $tempFile) {
@@ -45,7 +50,12 @@ function global:SendToCodex {
             return "# 警告: 応答が空でした。再試行してください。"
         }
         
-        Write-Host "# 出力を受信しました" -ForegroundColor Green
+        if ($timedOut) {
+            Write-Host "# タイムアウトしました。応答が途中までの可能性があります" -ForegroundColor Yellow
+        }
+        else {
+            Write-Host "# 出力を受信しました" -ForegroundColor Green
+        }
         return $output
     }
     catch {
@@ -108,7 +118,10 @@ function global:Invoke-Codex {
             python $codexPath "--file" $tempQueryFile
             
             # エラー処理
-            if ($LASTEXITCODE -ne 0) {
+            if ($LASTEXITCODE -eq 124) {
+                Write-Host "# タイムアウトしました。応答が途中までの可能性があります" -ForegroundColor Yellow
+            }
+            elseif ($LASTEXITCODE -ne 0) {
                 Write-Host "# エラー: Codex CLIの実行に失敗しました (終了コード: $LASTEXITCODE)" -ForegroundColor Red
             }
         }
@@ -13,6 +13,9 @@ codexCliJsonPath="$HOME/.openai/codex-cli.json"
 sed -i '' '/### Codex CLI setup - start/,/### Codex CLI setup - end/d' $zshrcPath
 echo "Removed settings in $zshrcPath if present"
 
+# Stop the background server if it is running
+python3 "$CODEX_CLI_PATH/src/codex_client.py" --shell zsh --stop 2>/dev/null || true
+
 # 2. Remove opanaiapirc in /.config
 rm -f $openAIConfigPath
 echo "Removed $openAIConfigPath"
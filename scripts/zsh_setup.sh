@@ -67,9 +67,9 @@ configureApp()
     
     echo "Updated OpenAI configuration file ($openAIConfigPath) with secrets"
 
-    # Change file mode of codex_query.py to allow execution
-    chmod +x "$CODEX_CLI_PATH/src/codex_query.py"
-    echo "Allow execution of $CODEX_CLI_PATH/src/codex_query.py"
+    # Change file mode of the scripts to allow execution
+    chmod +x "$CODEX_CLI_PATH/src/codex_query_integrated.py" "$CODEX_CLI_PATH/src/codex_client.py"
+    echo "Allow execution of $CODEX_CLI_PATH/src/codex_query_integrated.py and codex_client.py"
 }
 
 # Start installation
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+多数のクエリをまとめて処理するバッチモード
+
+ファイルまたは標準入力からクエリ（1行に1つ、またはJSONL）を読み込み、
+AsyncOpenAIで同時に最大CODEX_BATCH_CONCURRENCY件ずつモデレーションと生成を行う。
+再試行は対話モードと同じretry.call_asyncで行い、レート制限（429）を受けた場合は
+待ち時間の間すべてのワーカーの送信を止める。各クエリには対話モードと同じ
+クエリ全体の締め切り（timeouts）があり、接続と読み込みのタイムアウトはクライアントに設定する。
+結果は入力と同じ順にJSONLで書き出し、各行に所要時間とトークン使用量を含める。
+
+使い方:
+    codex_query_integrated.py --batch queries.txt > results.jsonl
+    cat queries.jsonl | codex_query_integrated.py --batch --concurrency 4
+"""
+
+import sys
+import json
+import time
+import asyncio
+import logging
+
+import retry
+import timeouts
+import response_cache
+import rate_limiter
+import moderation_cache
+from response_parser import ResponseParser
+from tokenizer import count_tokens
+from env_config import env_int, env_float
+
+# 同時に処理するクエリの最大数
+BATCH_CONCURRENCY = env_int('CODEX_BATCH_CONCURRENCY', 8)
+# レート制限やサーバーエラーを受けたときの再試行回数
+BATCH_MAX_RETRIES = env_int('CODEX_BATCH_MAX_RETRIES', 5)
+# Retry-Afterがない場合の待ち時間の基準（秒、再試行ごとに2倍、retry.pyと同じくジッター付き）
+BATCH_BACKOFF = env_float('CODEX_BATCH_BACKOFF', 1.0)
+
+
+def read_queries(text):
+    """
+    クエリの一覧を読み込む
+    各行はクエリの文字列、または{"query": ..., "id": ...}のJSON（idは省略可）
+    Returns: {"index", "id", "query"}のリスト
+    """
+    items = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        item_id = None
+        if line.startswith('{'):
+            try:
+                data = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{number}行目のJSONを読み込めません: {str(e)}")
+            query = data.get("query", data.get("input", ""))
+            item_id = data.get("id")
+        else:
+            query = line
+        query = query.strip()
+        if not query:
+            continue
+        # 対話モードと同じく「# 」で始まるクエリにする
+        if not query.startswith('#'):
+            query = '# ' + query
+        items.append({"index": len(items), "id": item_id, "query": query})
+    return items
+
+
+def _is_rate_limited(error):
+    return getattr(error, 'status_code', None) == 429
+
+
+class BatchRunner:
+    def __init__(self, client, config, context, system_prompt, concurrency=BATCH_CONCURRENCY,
+                 use_cache=True, max_retries=BATCH_MAX_RETRIES, backoff=BATCH_BACKOFF, limiter=None):
+        """
+        client: AsyncOpenAI（または同じインターフェースのオブジェクト）
+        context: すべてのクエリで共通のプロンプト（シェルのプレフィックスと会話履歴）
+        limiter: 他のシェルと共有するレート制限（省略時はCODEX_RPM/CODEX_TPMの設定）
+        """
+        self.client = client
+        self.config = config
+        self.context = context
+        self.system_prompt = system_prompt
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cache = response_cache.ResponseCache() if use_cache and response_cache.cache_enabled() else None
+        self.moderation_cache = moderation_cache.get_cache()
+        self.limiter = limiter or rate_limiter.get_limiter()
+        # すべてのクエリで共通の部分のトークン数（レート制限が有効な場合に最初の予約で数える）
+        self._base_tokens = None
+        # レート制限を受けたとき、この時刻（time.monotonic）まで全体の送信を止める
+        self._resume_at = 0.0
+        self.rate_limited = 0
+        # 他のプロセスに送信の停止を伝える書き込み（別スレッドで実行し、終了前に待つ）
+        self._pauses = []
+
+    async def _wait_for_rate_limit(self):
+        while True:
+            delay = self._resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def _on_retry(self, error, delay):
+        """retry.call_asyncの再試行ごとに呼ばれ、レート制限の場合は他のワーカーとプロセスの送信も止める"""
+        if not _is_rate_limited(error):
+            return
+        self.rate_limited += 1
+        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        # SQLiteへの書き込みでイベントループを止めないよう別スレッドで行う
+        if self.limiter.enabled:
+            self._pauses.append(asyncio.get_running_loop().run_in_executor(None, self.limiter.pause, delay))
+
+    async def _call(self, create, deadline, **kwargs):
+        """APIを呼び出す（対話モードと同じく締め切りまで再試行し、レート制限の間は送信しない）"""
+        async def attempt():
+            await self._wait_for_rate_limit()
+            return await create(**kwargs)
+        return await retry.call_async(attempt, self.max_retries, self.backoff, deadline.expires, self._on_retry)
+
+    async def _moderate(self, query, deadline):
+        flagged = self.moderation_cache.lookup(query)
+        if flagged is None:
+            response = await self._call(self.client.moderations.create, deadline, input=query)
+            flagged = response.results[0].flagged
+            self.moderation_cache.store(query, flagged)
+        return flagged
+
+    async def _reserve(self, query, deadline):
+        """他のプロセスと共有する予算を予約し、順番が来るまで待つ"""
+        if not self.limiter.enabled:
+            return
+        if self._base_tokens is None:
+            self._base_tokens = count_tokens(self.system_prompt) + count_tokens(self.context)
+        tokens = self._base_tokens + count_tokens(query) + self.config['max_tokens']
+        # 他のプロセスがSQLiteのロックを持っている間もイベントループを止めないよう別スレッドで予約する
+        wait = await asyncio.get_running_loop().run_in_executor(
+            None, self.limiter.reserve, tokens, deadline.bound(None))
+        if wait is None:
+            raise timeouts.QueryTimeout('rate_limit', deadline.seconds)
+        if wait:
+            await asyncio.sleep(wait)
+
+    async def _generate(self, query, deadline):
+        await self._reserve(query, deadline)
+        response = await self._call(
+            self.client.chat.completions.create,
+            deadline,
+            model=self.config['model'],
+            messages=[
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": self.context + query},
+            ],
+            temperature=self.config['temperature'],
+            max_tokens=self.config['max_tokens'],
+        )
+        usage = getattr(response, 'usage', None)
+        usage = {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "total_tokens": usage.total_tokens,
+        } if usage is not None else None
+        return response.choices[0].message.content or "", usage
+
+    async def _moderate_and_generate(self, query, deadline):
+        """
+        モデレーションと生成を並行して実行する
+        不適切と判定された場合やモデレーションが失敗した場合は、生成を取り消す
+        Returns: (応答, 使用量)、不適切な場合はNone
+        """
+        moderation = asyncio.ensure_future(self._moderate(query, deadline))
+        generation = asyncio.ensure_future(self._generate(query, deadline))
+        try:
+            if await moderation:
+                return None
+            return await generation
+        finally:
+            await _discard(moderation, generation)
+
+    async def run_item(self, item):
+        """1件のクエリを処理して結果の辞書を返す"""
+        start = time.perf_counter()
+        query = item["query"]
+        result = {"index": item["index"]}
+        if item["id"] is not None:
+            result["id"] = item["id"]
+        result["query"] = query
+        result.update(status="ok", response=None, usage=None, cached=False)
+        # 対話モードと同じクエリ全体の締め切り（順番が来てから数える）
+        deadline = timeouts.Deadline()
+        try:
+            key = None
+            if self.cache is not None:
+                key = response_cache.make_key(
+                    self.config['model'], self.config['temperature'], self.config['shell'],
+                    self.config['language'], self.system_prompt, self.context, query
+                )
+                cached = self.cache.get(key)
+                if cached is not None:
+                    result.update(response=cached, cached=True)
+                    return result
+
+            try:
+                generated = await asyncio.wait_for(self._moderate_and_generate(query, deadline),
+                                                   deadline.bound(None))
+            except asyncio.TimeoutError:
+                raise timeouts.QueryTimeout('query', deadline.seconds) from None
+            if generated is None:
+                result["status"] = "flagged"
+                return result
+
+            text, usage = generated
+            parser = ResponseParser(self.config['shell'])
+            parser.feed(text)
+            parser.close()
+            result.update(response=parser.text(), usage=usage)
+            if key is not None:
+                self.cache.put(key, result["response"])
+            return result
+        except timeouts.QueryTimeout as e:
+            logging.error("バッチ: %s件目がタイムアウトしました: %s", item['index'], e)
+            result.update(status="timeout", error=str(e))
+            return result
+        except Exception as e:
+            logging.error("バッチ: %s件目の処理に失敗しました: %s", item['index'], e)
+            result.update(status="error", error=str(e))
+            return result
+        finally:
+            result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    async def run(self, items, out):
+        """すべてのクエリを処理し、入力の順に1行ずつoutへ書き出す"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        done = {}
+        next_index = 0
+
+        async def worker(item):
+            async with semaphore:
+                return await self.run_item(item)
+
+        tasks = [asyncio.ensure_future(worker(item)) for item in items]
+        results = []
+        for task in asyncio.as_completed(tasks):
+            result = await task
+            done[result["index"]] = result
+            # 先頭から揃った分だけ書き出す
+            while next_index in done:
+                line = done.pop(next_index)
+                results.append(line)
+                out.write(json.dumps(line, ensure_ascii=False) + '\n')
+                out.flush()
+                next_index += 1
+        if self._pauses:
+            await asyncio.wait(self._pauses)
+        return results
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+
+
+async def _discard(*tasks):
+    """終わっていないタスクを取り消し、終わるまで待つ（結果と例外は使わない）"""
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+    await asyncio.wait(tasks)
+    for task in tasks:
+        if not task.cancelled():
+            task.exception()
+
+
+def run_batch(text, prompt_file, client, concurrency=BATCH_CONCURRENCY, use_cache=True, out=None):
+    """
+    クエリの一覧を処理してJSONLを書き出す
+    会話履歴は読み取るだけで、バッチの応答は追加しない
+    Returns: 失敗した件数
+    """
+    import codex_query_integrated as codex
+    out = out if out is not None else sys.stdout
+    items = read_queries(text)
+    if not items:
+        return 0
+
+    config = prompt_file.config
+    # 全クエリで同じコンテキストを使う（最も長いクエリの分を空けておく）
+    longest = max((item["query"] for item in items), key=len)
+    context = codex.shell_prefix(config['shell']) + (prompt_file.read_prompt_file(longest) or "")
+    system_prompt = codex.format_system_prompt(config['language'], config['shell'])
+
+    runner = BatchRunner(client, config, context, system_prompt, concurrency, use_cache)
+
+    async def run_and_close():
+        try:
+            return await runner.run(items, out)
+        finally:
+            # AsyncOpenAIの接続はイベントループを閉じる前に閉じる
+            close = getattr(client, 'close', None)
+            if close is not None and asyncio.iscoroutinefunction(close):
+                await close()
+
+    start = time.perf_counter()
+    try:
+        results = asyncio.run(run_and_close())
+    finally:
+        runner.close()
+    failed = sum(1 for result in results if result["status"] != "ok")
+    logging.info("バッチ: %s件を%.1f秒で処理しました（失敗%s件, レート制限%s回）",
+                 len(results), time.perf_counter() - start, failed, runner.rate_limited)
+    return failed
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+ローカルキャッシュ用SQLiteデータベースの共通処理
+
+キャッシュファイルはリポジトリ直下のcacheフォルダ
+（環境変数CODEX_CACHE_DIRで変更可能）に保存される。
+"""
+
+import os
+import sqlite3
+
+
+def cache_dir():
+    """キャッシュフォルダのパスを返す"""
+    return os.environ.get('CODEX_CACHE_DIR') or os.path.join(os.path.dirname(__file__), "..", "cache")
+
+
+def cache_path(filename):
+    """キャッシュフォルダ内のファイルパスを返す"""
+    return os.path.join(cache_dir(), filename)
+
+
+def connect(path):
+    """
+    データベースに接続する
+    複数のシェルから同時に使われるためWALモードで開く
+    常駐サーバーでは接続をスレッド間で使い回すため、同時に使う場合は呼び出し側でロックする
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    return conn
+
+
+def increment(conn, name, amount=1):
+    """カウンターを加算する"""
+    with conn:
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount),
+        )
+
+
+def read_counters(conn):
+    """すべてのカウンターを辞書で返す"""
+    return dict(conn.execute("SELECT name, value FROM counters"))
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+codex_query_integrated.pyの常駐サーバーに接続する軽量クライアント
+
+シェルプラグインから呼び出され、標準入力のテキストをUnixソケット経由で
+サーバーに送り、応答をそのまま標準出力に書き出す。
+サーバーが起動していない場合は自動的に起動する。
+
+使い方:
+    echo -n "# 現在の時刻" | codex_client.py --shell zsh
+    codex_client.py --shell zsh --no-cache   # 応答キャッシュを使わない
+    codex_client.py --shell zsh --events     # コメントとコマンドの組をJSONの1行ずつ出力
+    codex_client.py --shell zsh --stop       # サーバーを停止
+    codex_client.py --shell zsh --bench 5    # コールド/ウォームの遅延を計測
+"""
+
+import os
+import sys
+import io
+import json
+import socket
+import stat
+import struct
+import subprocess
+import tempfile
+import time
+
+from session import session_id
+from env_config import env_float
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "codex_query_integrated.py")
+
+# サーバー起動を待つ最大秒数
+SPAWN_TIMEOUT = 10.0
+# サーバーからの出力がこの秒数途切れたら諦める（サーバー側のタイムアウトが働かない場合の予備）
+RESPONSE_TIMEOUT = env_float('CODEX_CLIENT_TIMEOUT', 300)
+# タイムアウトの終了コード（timeouts.EXIT_CODEと同じ。クライアントを軽くするため読み込まない）
+TIMEOUT_EXIT_CODE = 124
+# Ctrl-Cで中断した場合の終了コード（codex_query_integrated.INTERRUPTED_EXIT_CODEと同じ）
+INTERRUPTED_EXIT_CODE = 130
+# 計測に使用する組み込みコマンド（APIを呼び出さない）
+BENCH_QUERY = "# show config"
+
+
+class UntrustedSocket(OSError):
+    """ソケットのディレクトリまたは接続先のサーバーが他のユーザーのもの"""
+
+
+def _uid():
+    return os.getuid() if hasattr(os, 'getuid') else 0
+
+
+def socket_dir():
+    """このユーザーのソケットを置くディレクトリを返す"""
+    base = os.environ.get('CODEX_DAEMON_DIR') or os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(base, f"codex-cli-{_uid()}")
+
+
+def socket_path(shell):
+    """シェルごとのソケットパスを返す"""
+    return os.path.join(socket_dir(), f"{shell}.sock")
+
+
+def secure_dir(path):
+    """
+    ディレクトリを所有者だけが使えるモード0700で作成し、
+    このユーザーが所有していて他のユーザーが書き込めないことを確かめる
+    （/tmpのような共有の場所で、他のユーザーが先に作ったディレクトリやソケットを使わないため）
+    """
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        st = os.lstat(path)
+    except OSError:
+        return False
+    # シンボリックリンクは辿らない
+    if not stat.S_ISDIR(st.st_mode):
+        return False
+    return st.st_uid == _uid() and stat.S_IMODE(st.st_mode) & 0o077 == 0
+
+
+def _owned_by_user(sock, path):
+    """接続先のサーバーがこのユーザーのプロセスか（SO_PEERCREDがなければソケットファイルの所有者で判定）"""
+    peercred = getattr(socket, 'SO_PEERCRED', None)
+    if peercred is not None:
+        try:
+            creds = sock.getsockopt(socket.SOL_SOCKET, peercred, struct.calcsize('3i'))
+            return struct.unpack('3i', creds)[1] == _uid()
+        except OSError:
+            pass
+    try:
+        return os.stat(path).st_uid == _uid()
+    except OSError:
+        return False
+
+
+def daemon_available():
+    """常駐サーバーを利用できるか（Unixソケット対応かつ無効化されていない）"""
+    return hasattr(socket, 'AF_UNIX') and os.environ.get('CODEX_NO_DAEMON', '') in ('', '0')
+
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    if not _owned_by_user(sock, path):
+        sock.close()
+        raise UntrustedSocket(f"他のユーザーのサーバーです: {path}")
+    return sock
+
+
+def _spawn_server(shell):
+    """サーバーをバックグラウンドで起動する（端末から切り離す）。起動したプロセスを返す"""
+    return subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, "--serve", "--shell", shell],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+        close_fds=True,
+    )
+
+
+def connect(shell, spawn=True):
+    """
+    サーバーに接続する。未起動なら起動して待つ
+    接続できない場合や、ディレクトリまたはサーバーが他のユーザーのものであればNone
+    """
+    path = socket_path(shell)
+    if not secure_dir(os.path.dirname(path)):
+        return None
+    try:
+        return _connect(path)
+    except UntrustedSocket:
+        return None
+    except OSError:
+        if not spawn:
+            return None
+
+    process = _spawn_server(shell)
+    deadline = time.monotonic() + SPAWN_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(0.02)
+        # 起動中に終了した場合（APIキーがない、インポートエラーなど）は待たずに直接実行する
+        # （同時に起動した他のサーバーがソケットを作っていれば、それに接続する）
+        exited = process.poll() is not None
+        try:
+            return _connect(path)
+        except UntrustedSocket:
+            return None
+        except OSError:
+            if exited:
+                return None
+    return None
+
+
+def run_direct(text, out, no_cache=False, events=False):
+    """サーバーを使わずにcodex_query_integrated.pyを直接実行する"""
+    args = [sys.executable, SERVER_SCRIPT] + (["--no-cache"] if no_cache else []) + (["--events"] if events else [])
+    result = subprocess.run(args, input=text.encode('utf-8'), stdout=subprocess.PIPE)
+    out.write(result.stdout)
+    out.flush()
+    return result.returncode
+
+
+def send_request(sock, request, out):
+    """リクエストを送り、応答をoutへ逐次書き出して終了コードを返す"""
+    sock.sendall(json.dumps(request, ensure_ascii=False).encode('utf-8') + b"\n")
+    if RESPONSE_TIMEOUT > 0:
+        sock.settimeout(RESPONSE_TIMEOUT)
+
+    # 応答の末尾は "\0<終了コード>"
+    trailer = None
+    while True:
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            out.write("\n# タイムアウト: サーバーから応答がありません\n".encode('utf-8'))
+            out.flush()
+            return TIMEOUT_EXIT_CODE
+        if not data:
+            break
+        if trailer is not None:
+            trailer += data
+            continue
+        index = data.find(b"\0")
+        if index >= 0:
+            out.write(data[:index])
+            trailer = data[index + 1:]
+        else:
+            out.write(data)
+        out.flush()
+
+    if trailer is None:
+        # サーバーが途中で終了した
+        return 1
+    try:
+        return int(trailer.decode('ascii') or 0)
+    except ValueError:
+        return 1
+
+
+def send_query(text, shell, out, no_cache=False, events=False):
+    """クエリをサーバーで処理する（使えない場合は直接実行）"""
+    if not daemon_available():
+        return run_direct(text, out, no_cache, events)
+
+    sock = connect(shell)
+    if sock is None:
+        return run_direct(text, out, no_cache, events)
+    with sock:
+        # サーバーは複数の端末で共有されるため、この端末のセッションを伝える
+        request = {"input": text, "no_cache": no_cache, "session": session_id()}
+        if events:
+            request["events"] = True
+        return send_request(sock, request, out)
+
+
+def stop_server(shell):
+    """起動中のサーバーを停止する"""
+    if not daemon_available():
+        return False
+    sock = connect(shell, spawn=False)
+    if sock is None:
+        return False
+    with sock:
+        send_request(sock, {"command": "shutdown"}, io.BytesIO())
+    return True
+
+
+def bench(shell, runs, out):
+    """直接実行（コールド）とサーバー経由（初回/ウォーム）の遅延を計測する"""
+    devnull = io.BytesIO()
+
+    def measure(func):
+        start = time.perf_counter()
+        func()
+        return (time.perf_counter() - start) * 1000
+
+    cold = sorted(measure(lambda: run_direct(BENCH_QUERY, devnull)) for _ in range(runs))
+    stop_server(shell)
+    first = measure(lambda: send_query(BENCH_QUERY, shell, devnull))
+    warm = sorted(measure(lambda: send_query(BENCH_QUERY, shell, devnull)) for _ in range(runs))
+
+    out.write(f"# cold (direct process, median of {runs}): {cold[len(cold) // 2]:.1f} ms\n".encode('utf-8'))
+    out.write(f"# first request (server spawn): {first:.1f} ms\n".encode('utf-8'))
+    out.write(f"# warm (server, median of {runs}): {warm[len(warm) // 2]:.1f} ms\n".encode('utf-8'))
+    out.flush()
+
+
+def main():
+    args = sys.argv[1:]
+    shell = os.environ.get('CODEX_SHELL') or os.path.basename(os.environ.get('SHELL', '')) or "bash"
+    if "--shell" in args and args.index("--shell") + 1 < len(args):
+        shell = args[args.index("--shell") + 1]
+
+    out = sys.stdout.buffer
+    if "--stop" in args:
+        stop_server(shell)
+        return 0
+    if "--bench" in args:
+        index = args.index("--bench")
+        runs = int(args[index + 1]) if index + 1 < len(args) else 5
+        bench(shell, runs, out)
+        return 0
+
+    # サーバーは起動時の環境変数を使うため、キャッシュの無効化はリクエストごとに伝える
+    no_cache = "--no-cache" in args or os.environ.get('CODEX_NO_CACHE', '') not in ('', '0')
+    text = sys.stdin.buffer.read().decode('utf-8', errors='replace')
+    try:
+        return send_query(text, shell, out, no_cache, "--events" in args)
+    except KeyboardInterrupt:
+        # 接続を閉じると、サーバーは次の差分を書き出す時点でAPIのストリームを閉じる
+        out.write("\n# 中断しました\n".encode('utf-8'))
+        out.flush()
+        return INTERRUPTED_EXIT_CODE
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,41 +3,37 @@
 
 import os
 import sys
-import configparser
 import json
-import logging
-import re
 import time
+import logging
 from pathlib import Path
 
-# ログ設定
-LOG_FILE = os.path.join(os.path.dirname(__file__), "..", "codex_debug.log")
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-
-# OpenAIライブラリをインポート
-try:
-    import openai
-    logging.debug(f"OpenAIライブラリバージョン: {openai.__version__}")
-except Exception as e:
-    logging.error(f"OpenAIライブラリのインポート中にエラーが発生しました: {str(e)}")
-    print(f"エラー: OpenAIライブラリのインポートに失敗しました - {str(e)}")
-    sys.exit(1)
-
-# 必要に応じてpsutilをインポート（シェル検出用）
-try:
-    import psutil
-    HAS_PSUTIL = True
-except ImportError:
-    HAS_PSUTIL = False
-    logging.warning("psutilモジュールが見つかりません。シェル検出機能が制限されます。")
+# ログ設定（キュー経由で書き込み、CODEX_LOG_LEVELで出力するレベルを指定する）
+from log_config import LOG_FILE, setup_logging
+setup_logging()
+
+# openaiとpsutilは読み込みに時間がかかるため、必要になった時点でインポートする
+# （組み込みコマンドだけを実行する場合は読み込まない）
+openai = None
+psutil = None
+HAS_PSUTIL = None  # None: 未確認
 
 from prompt_file import PromptFile
+from context_config import ContextConfig
+from output_sink import OutputSink
+from response_parser import ResponseParser
 from commands import get_command_result
+from text_reader import decode, read_text
+from tokenizer import count_tokens
+from env_config import env_int
+import response_cache
+import history_lookup
+import retry
+import rate_limiter
+import timeouts
+import shell_cache
+import timing
+import moderation_cache
 
 # グローバル設定
 MULTI_TURN = "off"
@@ -47,12 +43,90 @@ TEMPERATURE = 0.7
 MAX_TOKENS = 300
 DEBUG_MODE = False
 
+# モデレーション結果を待つ間に保持する応答の最大文字数（超えたら結果を待つ）
+MODERATION_BUFFER_CHARS = 2048
+
+def parse_stop_sequences(value):
+    """
+    CODEX_STOPの値を停止シーケンスのリストにする
+    JSONのリスト（["\\n\\n\\n", "# end"]）または1つの文字列（「\\n」は改行）を受け付ける
+    """
+    if not value:
+        return []
+    if value.lstrip().startswith('['):
+        try:
+            sequences = [str(item) for item in json.loads(value)]
+        except ValueError:
+            logging.warning("CODEX_STOPを解析できないため無視します")
+            return []
+    else:
+        sequences = [value.replace('\\n', '\n')]
+    if len(sequences) > 4:
+        # APIが受け付けるのは4つまで
+        logging.warning("停止シーケンスは4つまでのため、5つ目以降は使用しません")
+    return sequences[:4]
+
+# 応答の生成を止める文字列
+STOP_SEQUENCES = parse_stop_sequences(os.environ.get('CODEX_STOP', ''))
+# コメントとコマンドの組がこの数だけそろったらストリームを閉じる（0は無効）
+MAX_PAIRS = env_int('CODEX_MAX_PAIRS', 0)
+# Ctrl-Cで中断した応答の出力済みの部分を、マルチターンの会話履歴に保存する
+SAVE_PARTIAL = os.environ.get('CODEX_SAVE_PARTIAL', '') not in ('', '0')
+# 会話履歴に保存する中断した応答の末尾に付ける（打ち切られた応答であることをモデルに伝える）
+INTERRUPTED_MARK = "# (interrupted)"
+# Ctrl-Cで中断した場合の終了コード（128 + SIGINT）
+INTERRUPTED_EXIT_CODE = 130
+
 # 設定ファイルのパス
 CONFIG_FILE_PATH = os.path.join(os.path.expanduser("~"), ".openai", "codex-cli.json")
 PROMPT_CONTEXT = Path(__file__).parent / "current_context.txt"
 
-def load_config():
-    """設定を読み込む（環境変数のみをサポート）"""
+def _load_openai():
+    """OpenAIライブラリをインポートする（初回のみ）"""
+    global openai
+    if openai is None:
+        try:
+            import openai as openai_module
+            logging.debug("OpenAIライブラリバージョン: %s", openai_module.__version__)
+        except Exception as e:
+            logging.error("OpenAIライブラリのインポート中にエラーが発生しました: %s", e)
+            print(f"エラー: OpenAIライブラリのインポートに失敗しました - {str(e)}")
+            sys.exit(1)
+        openai = openai_module
+    return openai
+
+def _load_psutil():
+    """psutilをインポートする（シェル検出用、見つからなければNone）"""
+    global psutil
+    global HAS_PSUTIL
+    if HAS_PSUTIL is None:
+        try:
+            import psutil as psutil_module
+            psutil = psutil_module
+            HAS_PSUTIL = True
+        except ImportError:
+            HAS_PSUTIL = False
+            logging.warning("psutilモジュールが見つかりません。シェル検出機能が制限されます。")
+    return psutil if HAS_PSUTIL else None
+
+def _parent_process_name():
+    """親プロセス名を取得する（/procが使える場合はpsutilを読み込まない）"""
+    try:
+        with open(f"/proc/{os.getppid()}/comm", 'r', encoding='utf-8') as f:
+            return f.read().strip().lower()
+    except OSError:
+        pass
+
+    process_util = _load_psutil()
+    if process_util is None:
+        return None
+    return process_util.Process(os.getppid()).name().lower()
+
+def load_config(require_key=True):
+    """
+    設定を読み込む（環境変数のみをサポート）
+    require_key=FalseではAPIキーがなくても終了しない（組み込みコマンドはキーなしで実行できる）
+    """
     try:
         # 環境変数から設定を読み込む
         api_key = os.environ.get('OPENAI_API_KEY')
@@ -61,32 +135,37 @@ def load_config():
         language = "ja"  # デフォルト言語は日本語
         
         # 設定ファイルをチェック（言語設定のみ）
-        logging.debug(f"設定ファイルを確認中: {CONFIG_FILE_PATH}")
+        logging.debug("設定ファイルを確認中: %s", CONFIG_FILE_PATH)
         
         if os.path.exists(CONFIG_FILE_PATH):
-            logging.debug(f"設定ファイル発見: {CONFIG_FILE_PATH}")
+            logging.debug("設定ファイル発見: %s", CONFIG_FILE_PATH)
             try:
                 with open(CONFIG_FILE_PATH, 'r', encoding='utf-8') as file:
                     config = json.load(file)
-                # 言語設定のみファイルから読み込む
+                # 言語設定とタイムアウトをファイルから読み込む
                 language = config.get("language", "ja")
-                logging.debug(f"言語設定: {language}")
+                logging.debug("言語設定: %s", language)
+                timeouts.configure(config.get("timeouts"))
             except Exception as load_err:
-                logging.error(f"設定ファイル読み込みエラー: {str(load_err)}")
+                logging.error("設定ファイル読み込みエラー: %s", load_err)
         
-        if not api_key:
-            # APIキーがない場合はテンプレート作成
-            logging.warning("APIキーが環境変数に設定されていません。")
-            create_template_config()
-            sys.exit(1)
-            
+        if require_key:
+            require_api_key(api_key)
+
         logging.info("設定読み込み成功")
         return api_key, organization, model_name, language
     except Exception as e:
-        logging.error(f"設定の読み込み中にエラーが発生しました: {str(e)}")
+        logging.error("設定の読み込み中にエラーが発生しました: %s", e)
         print(f"エラー: 設定の読み込みに失敗しました - {str(e)}")
         sys.exit(1)
 
+def require_api_key(api_key):
+    """APIキーがない場合はテンプレートを作成して終了する"""
+    if not api_key:
+        logging.warning("APIキーが環境変数に設定されていません。")
+        create_template_config()
+        sys.exit(1)
+
 def create_template_config():
     """設定ファイルのテンプレートを作成（環境変数のヒントあり）"""
     home = os.path.expanduser("~")
@@ -95,9 +174,9 @@ def create_template_config():
     if not os.path.exists(os.path.dirname(codex_cli_path)):
         try:
             os.makedirs(os.path.dirname(codex_cli_path))
-            logging.debug(f".openaiフォルダを作成しました: {os.path.dirname(codex_cli_path)}")
+            logging.debug(".openaiフォルダを作成しました: %s", os.path.dirname(codex_cli_path))
         except Exception as e:
-            logging.error(f".openaiフォルダの作成に失敗しました: {str(e)}")
+            logging.error(".openaiフォルダの作成に失敗しました: %s", e)
     
     if not os.path.exists(codex_cli_path):
         try:
@@ -110,7 +189,7 @@ def create_template_config():
             with open(codex_cli_path, 'w', encoding='utf-8') as file:
                 json.dump(template_config, file, ensure_ascii=False, indent=2)
             
-            logging.info(f"設定ファイルを作成しました: {codex_cli_path}")
+            logging.info("設定ファイルを作成しました: %s", codex_cli_path)
             
             print(f'# 環境変数が設定されていません')
             print(f'# 以下の環境変数を設定してください:')
@@ -129,79 +208,118 @@ def create_template_config():
             
             return template_config
         except Exception as e:
-            logging.error(f"設定ファイルの作成に失敗しました: {str(e)}")
+            logging.error("設定ファイルの作成に失敗しました: %s", e)
             print(f'# エラー: 設定ファイルの作成に失敗しました: {str(e)}')
             sys.exit(1)
     
     return None
 
+def _shell_name(value):
+    """"/bin/zsh"や"pwsh"のような指定をシェルの種類に変換する"""
+    value = os.path.basename(value.strip().lower())
+    if 'powershell' in value or 'pwsh' in value:
+        return "powershell"
+    elif 'zsh' in value:
+        return "zsh"
+    elif 'bash' in value:
+        return "bash"
+    return value
+
+def _detect_from_process():
+    """親プロセス名と環境変数SHELLからシェルの種類を判定する"""
+    # プロセス情報が取得できる場合は親プロセス名から詳細な検出を行う
+    parent_process_name = _parent_process_name() if HAS_PSUTIL is not False else None
+
+    if parent_process_name is not None:
+        # Unix系の場合は親プロセスを確認
+        logging.debug("親プロセス名: %s", parent_process_name)
+        
+        # シェルタイプの検出
+        POWERSHELL_MODE = 'powershell' in parent_process_name or 'pwsh' in parent_process_name
+        BASH_MODE = 'bash' in parent_process_name
+        ZSH_MODE = 'zsh' in parent_process_name
+        
+        # 環境変数からもシェルタイプを確認（バックアップ手段）
+        if not (POWERSHELL_MODE or BASH_MODE or ZSH_MODE):
+            shell_env = os.environ.get('SHELL', '').lower()
+            if 'powershell' in shell_env or 'pwsh' in shell_env:
+                POWERSHELL_MODE = True
+            elif 'bash' in shell_env:
+                BASH_MODE = True
+            elif 'zsh' in shell_env:
+                ZSH_MODE = True
+        
+        # シェルタイプの決定
+        return "powershell" if POWERSHELL_MODE else "bash" if BASH_MODE else "zsh" if ZSH_MODE else "bash"
+
+    # プロセス情報がない場合はより単純な検出
+    shell_env = os.environ.get('SHELL', '').lower()
+    if 'powershell' in shell_env or 'pwsh' in shell_env:
+        return "powershell"
+    elif 'bash' in shell_env:
+        return "bash"
+    elif 'zsh' in shell_env:
+        return "zsh"
+    # デフォルト
+    return "bash" if os.name != 'nt' else "powershell"
+
 def detect_shell():
-    """シェルの種類を検出する"""
+    """
+    シェルの種類を検出する
+    プラグインが設定する環境変数CODEX_SHELL、親プロセスごとのキャッシュの順に調べ、
+    どちらもない場合だけ親プロセスを調べる（psutilはこのときだけ読み込む）
+    """
     global SHELL
     global PROMPT_CONTEXT
     
     try:
+        cached = shell_cache.lookup()
+        env_shell = _shell_name(os.environ.get('CODEX_SHELL') or '')
+
         # Windowsの場合は特別な処理
         if os.name == 'nt':
             # PowerShellを使用していると仮定
             SHELL = "powershell"
             logging.debug("Windows環境を検出: PowerShellを使用")
-        elif HAS_PSUTIL:
-            # psutilが利用可能な場合は詳細な検出を行う
-            # Unix系の場合は親プロセスを確認
-            parent_process_name = psutil.Process(os.getppid()).name().lower()
-            logging.debug(f"親プロセス名: {parent_process_name}")
-            
-            # シェルタイプの検出
-            POWERSHELL_MODE = 'powershell' in parent_process_name or 'pwsh' in parent_process_name
-            BASH_MODE = 'bash' in parent_process_name
-            ZSH_MODE = 'zsh' in parent_process_name
-            
-            # 環境変数からもシェルタイプを確認（バックアップ手段）
-            if not (POWERSHELL_MODE or BASH_MODE or ZSH_MODE):
-                shell_env = os.environ.get('SHELL', '').lower()
-                if 'powershell' in shell_env or 'pwsh' in shell_env:
-                    POWERSHELL_MODE = True
-                elif 'bash' in shell_env:
-                    BASH_MODE = True
-                elif 'zsh' in shell_env:
-                    ZSH_MODE = True
-            
-            # シェルタイプの決定
-            SHELL = "powershell" if POWERSHELL_MODE else "bash" if BASH_MODE else "zsh" if ZSH_MODE else "bash"
+        elif env_shell:
+            SHELL = env_shell
+        elif cached is not None:
+            SHELL = cached[0]
         else:
-            # psutilがない場合はより単純な検出
-            shell_env = os.environ.get('SHELL', '').lower()
-            if 'powershell' in shell_env or 'pwsh' in shell_env:
-                SHELL = "powershell"
-            elif 'bash' in shell_env:
-                SHELL = "bash"
-            elif 'zsh' in shell_env:
-                SHELL = "zsh"
-            else:
-                # デフォルト
-                SHELL = "bash" if os.name != 'nt' else "powershell"
+            SHELL = _detect_from_process()
             
-        logging.debug(f"検出されたシェル: {SHELL}")
-
-        # コンテキストファイルのパスを設定
-        shell_prompt_file = Path(os.path.join(os.path.dirname(__file__), "..", "contexts", f"{SHELL}-context.txt"))
+        logging.debug("検出されたシェル: %s", SHELL)
 
-        if shell_prompt_file.is_file():
-            PROMPT_CONTEXT = shell_prompt_file
-            logging.debug(f"シェル用コンテキストファイルを使用: {PROMPT_CONTEXT}")
+        # コンテキストファイルのパスを設定（同じシェルの検出結果が保存されていれば使う）
+        if cached is not None and cached[0] == SHELL and cached[1]:
+            PROMPT_CONTEXT = Path(cached[1])
         else:
-            logging.warning(f"シェル用コンテキストファイルが見つかりません: {shell_prompt_file}")
+            set_shell(SHELL)
+            shell_cache.store(SHELL, PROMPT_CONTEXT)
     except Exception as e:
         # 検出に失敗した場合はデフォルト値を使用
         SHELL = "powershell" if os.name == 'nt' else "bash"
-        logging.error(f"シェル検出中にエラーが発生しました: {str(e)}。デフォルト: {SHELL}")
+        logging.error("シェル検出中にエラーが発生しました: %s。デフォルト: %s", e, SHELL)
         
         # デフォルトコンテキストファイルを使用
         default_context = Path(os.path.join(os.path.dirname(__file__), "..", "contexts", f"{SHELL}-context.txt"))
         if default_context.is_file():
             PROMPT_CONTEXT = default_context
 
+def set_shell(shell):
+    """シェルの種類を設定し、対応するコンテキストファイルを選択する"""
+    global SHELL
+    global PROMPT_CONTEXT
+
+    SHELL = shell
+    shell_prompt_file = Path(os.path.join(os.path.dirname(__file__), "..", "contexts", f"{SHELL}-context.txt"))
+
+    if shell_prompt_file.is_file():
+        PROMPT_CONTEXT = shell_prompt_file
+        logging.debug("シェル用コンテキストファイルを使用: %s", PROMPT_CONTEXT)
+    else:
+        logging.warning("シェル用コンテキストファイルが見つかりません: %s", shell_prompt_file)
+
 def format_system_prompt(language, shell_type):
     """システムプロンプトを言語設定に基づいて生成"""
     # OSの種類を検出
@@ -231,30 +349,63 @@ If multiple commands are necessary, display them on separate lines.
 Avoid lengthy explanations, focus on concise comments and practical commands.
 The current OS is {os_type}."""
 
+def create_prompt_file(model_name, language, session=None):
+    """PromptFileを作成する（OpenAIライブラリは読み込まない）"""
+    # 保存済みのcurrent_context.configがあれば、PromptFileがその値で上書きする
+    prompt_config = ContextConfig(
+        model=model_name,
+        temperature=TEMPERATURE,
+        max_tokens=MAX_TOKENS,
+        shell=SHELL,
+        multi_turn=MULTI_TURN,
+        token_count=0,
+        language=language,
+    )
+    
+    return PromptFile(PROMPT_CONTEXT.name, prompt_config, session)
+
+def create_client(api_key, org_id):
+    """OpenAI APIクライアントを作成する（ここで初めてopenaiをインポート）"""
+    # 再試行はretry.pyで行う（ライブラリの再試行と重ならないようにする）
+    # タイムアウトの既定値はモデレーションなどに使い、応答の生成ではリクエストごとに締め切りまでに縮める
+    openai = _load_openai()
+    return openai.OpenAI(
+        api_key=api_key,
+        organization=org_id,
+        max_retries=0,
+        timeout=_request_timeout(openai)
+    )
+
+def create_async_client(api_key, org_id):
+    """AsyncOpenAIクライアントを作成する（再試行とタイムアウトはcreate_clientと同じ）"""
+    openai = _load_openai()
+    return openai.AsyncOpenAI(
+        api_key=api_key,
+        organization=org_id,
+        max_retries=0,
+        timeout=_request_timeout(openai)
+    )
+
+def _is_async_client(client):
+    """AsyncOpenAIのクライアントか（retry.pyと同じくクラス名で判定する）"""
+    return any(cls.__name__ == 'AsyncOpenAI' for cls in type(client).__mro__)
+
+def _request_timeout(openai, deadline=None):
+    """timeoutsの設定からopenaiのTimeoutを作る（どれも無効ならNone）"""
+    read, connect = timeouts.request_timeouts(deadline)
+    if read is None and connect is None:
+        return None
+    return openai.Timeout(read, connect=connect)
+
 def initialize():
     """OpenAIとシェルモードを初期化"""
-    global MODEL
-
     # 設定ファイルの確認
     api_key, org_id, model_name, language = load_config()
 
     # 新しいOpenAI APIクライアント初期化方法
-    client = openai.OpenAI(
-        api_key=api_key,
-        organization=org_id
-    )
-
-    prompt_config = {
-        'model': model_name,
-        'temperature': TEMPERATURE,
-        'max_tokens': MAX_TOKENS,
-        'shell': SHELL,
-        'multi_turn': MULTI_TURN,
-        'token_count': 0,
-        'language': language
-    }
+    client = create_client(api_key, org_id)
     
-    return PromptFile(PROMPT_CONTEXT.name, prompt_config), client, language
+    return create_prompt_file(model_name, language), client, language
 
 def is_sensitive_content(content, client):
     """コンテンツが不適切かチェック（OpenAIのモデレーション API使用）"""
@@ -262,15 +413,134 @@ def is_sensitive_content(content, client):
         return False
     
     try:
-        # OpenAI APIのモデレーション呼び出し
-        response = client.moderations.create(input=content)
-        return response.results[0].flagged
+        with timing.span("moderation"):
+            # 許可リストに一致するか、最近同じクエリを判定済みならAPIを呼び出さない
+            cache = moderation_cache.get_cache()
+            flagged = cache.lookup(content)
+            if flagged is not None:
+                logging.debug("モデレーションAPIの呼び出しを省略しました: flagged=%s", flagged)
+                return flagged
+
+            # OpenAI APIのモデレーション呼び出し
+            response = retry.call(lambda: client.moderations.create(input=content))
+            flagged = response.results[0].flagged
+            cache.store(content, flagged)
+            return flagged
     except Exception as e:
-        logging.error(f"モデレーションチェックエラー: {e}")
+        logging.error("モデレーションチェックエラー: %s", e)
         print(f"モデレーションチェックエラー: {e}")
         # チェックに失敗した場合、安全と仮定して処理を続行
         return False
 
+async def is_sensitive_content_async(content, client):
+    """is_sensitive_contentのasyncio版（clientはAsyncOpenAI）"""
+    if len(content) == 0:
+        return False
+
+    try:
+        with timing.span("moderation"):
+            cache = moderation_cache.get_cache()
+            flagged = cache.lookup(content)
+            if flagged is not None:
+                logging.debug("モデレーションAPIの呼び出しを省略しました: flagged=%s", flagged)
+                return flagged
+
+            response = await retry.call_async(lambda: client.moderations.create(input=content))
+            flagged = response.results[0].flagged
+            cache.store(content, flagged)
+            return flagged
+    except Exception as e:
+        logging.error("モデレーションチェックエラー: %s", e)
+        print(f"モデレーションチェックエラー: {e}")
+        # チェックに失敗した場合、安全と仮定して処理を続行
+        return False
+
+_moderation_executor = None
+
+def start_moderation(content, client):
+    """モデレーションをバックグラウンドで開始し、結果（flagged）のFutureを返す"""
+    global _moderation_executor
+    if _moderation_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _moderation_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="moderation")
+    return _moderation_executor.submit(is_sensitive_content, content, client)
+
+class _ContentFlagged(Exception):
+    """モデレーションで入力が不適切と判定された"""
+
+class GenerationInterrupted(KeyboardInterrupt):
+    """応答の生成中にCtrl-Cで中断された（partialは出力済みの部分）"""
+
+    def __init__(self, partial=""):
+        super().__init__()
+        self.partial = partial
+
+def _moderation_result(moderation, deadline):
+    """モデレーションの結果を締め切りまで待つ"""
+    from concurrent.futures import TimeoutError
+    with timing.span("moderation_wait"):
+        try:
+            return moderation.result(timeout=deadline.bound(None) if deadline is not None else None)
+        except TimeoutError:
+            raise timeouts.QueryTimeout('moderation', deadline.seconds) from None
+
+async def _wait_within(awaitable, seconds):
+    """
+    awaitableの結果をseconds秒（Noneは無制限）まで待つ（超えたら取り消してasyncio.TimeoutError）
+    asyncio.wait_forと違い、結果が届くのと同時にキャンセル（Ctrl-C）されてもキャンセルを優先する
+    """
+    import asyncio
+    task = asyncio.ensure_future(awaitable)
+    try:
+        done, _ = await asyncio.wait({task}, timeout=seconds)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    if not done:
+        task.cancel()
+        raise asyncio.TimeoutError()
+    return task.result()
+
+async def _moderation_result_async(moderation, deadline):
+    """_moderation_resultのasyncio版（moderationはタスク）"""
+    import asyncio
+    with timing.span("moderation_wait"):
+        try:
+            return await _wait_within(moderation, deadline.bound(None) if deadline is not None else None)
+        except asyncio.TimeoutError:
+            raise timeouts.QueryTimeout('moderation', deadline.seconds) from None
+
+def _hold_until_moderated(contents, moderation, buffer_limit=MODERATION_BUFFER_CHARS, deadline=None):
+    """
+    モデレーション結果が出るまで応答の差分を保持し、問題なければ順に返す
+    不適切と判定された場合は_ContentFlaggedを送出する
+    """
+    pending = []
+    size = 0
+    for content in contents:
+        if content is None:
+            continue
+        if pending is None:
+            yield content
+            continue
+
+        pending.append(content)
+        size += len(content)
+        if not moderation.done() and size < buffer_limit:
+            continue
+        flagged = _moderation_result(moderation, deadline)
+        if flagged:
+            raise _ContentFlagged()
+        yield from pending
+        pending = None
+
+    # 結果より先にストリームが終わった場合
+    if pending is not None:
+        flagged = _moderation_result(moderation, deadline)
+        if flagged:
+            raise _ContentFlagged()
+        yield from pending
+
 def get_query(prompt_file):
     """
     stdin、ファイル、コマンドライン引数から入力を取得し、
@@ -282,44 +552,17 @@ def get_query(prompt_file):
         if len(sys.argv) > 1:
             if sys.argv[1] == "--file" and len(sys.argv) > 2:
                 input_file = sys.argv[2]
-                logging.debug(f"--fileオプションでファイルパスを検出: {input_file}")
+                logging.debug("--fileオプションでファイルパスを検出: %s", input_file)
             elif os.path.exists(sys.argv[1]):
                 input_file = sys.argv[1]
-                logging.debug(f"コマンドライン引数からファイルパスを検出: {input_file}")
+                logging.debug("コマンドライン引数からファイルパスを検出: %s", input_file)
         
         if DEBUG_MODE:
             entry = input("prompt: ") + '\n'
         elif input_file:
-            # ファイルから入力を読み込む
-            try:
-                # まずUTF-8で試す
-                with open(input_file, 'r', encoding='utf-8') as f:
-                    entry = f.read()
-                logging.debug(f"UTF-8でファイルを読み込みました: {input_file}")
-            except UnicodeDecodeError:
-                # UTF-8で失敗した場合はcp932を試す
-                try:
-                    with open(input_file, 'r', encoding='cp932') as f:
-                        entry = f.read()
-                    logging.debug(f"cp932でファイルを読み込みました: {input_file}")
-                except UnicodeDecodeError:
-                    # それも失敗した場合は、バイナリモードで読み込んで適切なエンコーディングを推測
-                    with open(input_file, 'rb') as f:
-                        content = f.read()
-                    
-                    # エンコーディングを推測
-                    encodings = ['utf-8', 'cp932', 'cp1252', 'ascii']
-                    for enc in encodings:
-                        try:
-                            entry = content.decode(enc)
-                            logging.debug(f"エンコーディング {enc} で成功")
-                            break
-                        except UnicodeDecodeError:
-                            continue
-                    else:
-                        # すべて失敗した場合
-                        entry = content.decode('ascii', errors='replace')
-                        logging.error("すべてのエンコーディングが失敗、ASCIIで代替")
+            # ファイルから入力を読み込む（1回だけ読み込み、BOMとUTF-8、cp932などから文字コードを判定）
+            entry, encoding = read_text(input_file)
+            logging.debug("%sでファイルを読み込みました: %s", encoding, input_file)
         else:
             # 標準入力から読み込む
             if os.name == 'nt':
@@ -346,7 +589,7 @@ def get_query(prompt_file):
                                 entry = input().strip() + "\n"
                         except Exception as e:
                             # パイプ読み込み失敗時
-                            logging.error(f"パイプ入力エラー: {str(e)}")
+                            logging.error("パイプ入力エラー: %s", e)
                             print("# 直接入力を試みます...")
                             print("# コマンドを入力してください:")
                             entry = input().strip() + "\n"
@@ -354,27 +597,15 @@ def get_query(prompt_file):
                     # fallback
                     import io
                     stdin_bytes = sys.stdin.buffer.read()
-                    try:
-                        entry = stdin_bytes.decode('utf-8', errors='replace') + "\n"
-                    except UnicodeDecodeError:
-                        # 失敗した場合は別のエンコーディングを試す
-                        fallback_encodings = ['cp932', 'cp1252']
-                        for enc in fallback_encodings:
-                            try:
-                                entry = stdin_bytes.decode(enc, errors='replace') + "\n"
-                                break
-                            except UnicodeDecodeError:
-                                continue
-                        else:
-                            # すべて失敗した場合
-                            entry = stdin_bytes.decode('ascii', errors='replace') + "\n"
+                    entry = decode(stdin_bytes)[0] + "\n"
             else:
                 # Unix系の場合
                 print("# コマンドを入力してください (Ctrl+Cで終了):")
                 entry = sys.stdin.read()
         
         if entry:
-            logging.debug(f"入力文字列（最初の50文字）: {entry[:50]}")
+            # クエリの内容はログに残さない
+            logging.debug("入力文字列: %s文字", len(entry))
         else:
             logging.error("入力が空です")
             entry = ""
@@ -390,133 +621,722 @@ def get_query(prompt_file):
         else:
             sys.exit(0)
     except UnicodeError as e:
-        logging.error(f'Unicode encoding error: {str(e)}')
+        logging.error('Unicode encoding error: %s', e)
         print('\n\n# Codex CLI error: 文字エンコーディングエラー。マルチバイト文字や絵文字を含む可能性があります - ' + str(e))
         sys.exit(1)
 
-def generate_response(prompt, model, client, language, shell):
-    """ストリーミングレスポンスを生成（codex_query_fixed.pyの方式を採用）"""
-    logging.debug(f"APIリクエスト: モデル={model}, プロンプト長={len(str(prompt))}")
+class _StreamPrinter:
+    """
+    ストリーミングの差分を順に出力する
+    events=Trueの場合は、コメントとコマンドの組が確定するたびにJSONの1行として出力する
+    """
+
+    def __init__(self, events=False, max_pairs=0, shell=None):
+        self.events = events
+        self.max_pairs = max_pairs
+        # 処理中メッセージは最初の差分が届いた時点でクリアする（リクエストの送信は読み込みと同時に始まる）
+        self.cleared = events
+        # 応答を出力（端末以外では改行ごと・一定時間ごとにまとめて書き出す）
+        self.sink = OutputSink()
+        # バッククォートの扱いはシェルによって異なる（省略時は検出したシェル）
+        self.parser = ResponseParser(shell or SHELL)
+        self.completed = 0
+        self.response = None
+
+    def clear(self):
+        if not self.cleared:
+            print("\r                 \r", end="", flush=True)
+            self.cleared = True
+
+    def emit(self, text, pairs):
+        if self.events:
+            for pair in pairs:
+                self.sink.write(json.dumps(pair._asdict(), ensure_ascii=False) + '\n')
+        else:
+            self.sink.write(text)
+
+    def write(self, content):
+        """
+        差分を出力する
+        Returns: max_pairsの数の組がそろった（読み込みをやめる）場合はTrue
+        """
+        if content is None:
+            return False
+        self.clear()
+        # 組の数で止める場合は1行ずつ渡し、組がそろった行の直後で止める
+        for piece in (content.splitlines(keepends=True) if self.max_pairs else [content]):
+            text, pairs = self.parser.feed(piece)
+            self.emit(text, pairs)
+            self.completed += len(pairs)
+            if self.max_pairs and self.completed >= self.max_pairs:
+                return True
+        return False
+
+    def close(self):
+        """残りを出力し、フェンスとバッククォートを除いた応答全体を返す（2回目以降は同じ応答を返す）"""
+        if self.response is not None:
+            return self.response
+        self.clear()
+        self.emit(*self.parser.close())
+        self.response = self.parser.text()
+        # 改行を追加
+        if not self.events and not self.response.endswith('\n'):
+            self.sink.write('\n')
+        self.sink.flush()
+        timing.add("output_write", self.sink.flush_time())
+        logging.debug("出力: %s回の書き出し, %.1fms", len(self.sink.flushes), self.sink.flush_time() * 1000)
+        return self.response
+
+def _print_stream(contents, events=False, max_pairs=0, on_stop=None, shell=None):
+    """
+    ストリーミングの差分を順に出力し、応答全体を返す
+    events=Trueの場合は、コメントとコマンドの組が確定するたびにJSONの1行として出力する
+    max_pairsを指定すると、その数の組がそろった時点でon_stop(出力した組の数)を呼んで読み込みをやめる
+    Ctrl-Cで中断された場合は、出力済みの部分を持つGenerationInterruptedを送出する
+    """
+    printer = _StreamPrinter(events, max_pairs, shell)
+    try:
+        for content in contents:
+            if printer.write(content):
+                if on_stop is not None:
+                    on_stop(printer.completed)
+                break
+    except KeyboardInterrupt:
+        raise GenerationInterrupted(printer.close()) from None
+    finally:
+        printer.close()
+    return printer.response
+
+def replay_response(response, events=False):
+    """キャッシュされた応答をストリーミング時と同じ形式で出力する"""
+    if not events:
+        print("\n#   処理中...", end="", flush=True)
+    return _print_stream([response], events)
+
+def _chat_messages(prompt, language, shell):
+    """システムプロンプトとチャットのメッセージ"""
+    system_prompt = format_system_prompt(language, shell)
+    return system_prompt, [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ]
+
+def _chat_options(max_tokens, stop):
+    """生成するトークン数の上限と停止シーケンス（省略時はCODEX_STOP）のリクエストの引数"""
+    options = {}
+    if max_tokens:
+        options['max_tokens'] = max_tokens
+    stop = STOP_SEQUENCES if stop is None else stop
+    if stop:
+        options['stop'] = stop
+    return options
+
+def _reserved_tokens(prompt, system_prompt, max_tokens, prompt_tokens):
+    """レート制限で予約するトークン数（プロンプトと生成の上限）"""
+    return (count_tokens(prompt) if prompt_tokens is None else prompt_tokens) \
+        + count_tokens(system_prompt) + (max_tokens or MAX_TOKENS)
+
+def _retry_until(deadline):
+    """再試行は最初のトークンの制限時間とクエリ全体の締め切りまで"""
+    retry_until = deadline.expires
+    first_token = timeouts.limit('first_token')
+    if first_token:
+        retry_until = min(filter(None, (retry_until, time.monotonic() + first_token)))
+    return retry_until
+
+def _report_finish(finish, response, max_tokens):
+    """早期終了で節約できた量、またはmax_tokensでの打ち切りを記録する"""
+    if 'early' in finish:
+        pairs, elapsed = finish['early']
+        received = count_tokens(response)
+        # 残りのトークンを上限まで同じ速さで生成した場合の時間（節約できた最大の量）
+        saved_tokens = max(0, (max_tokens or 0) - received)
+        saved_ms = saved_tokens * elapsed * 1000 / received if received else 0.0
+        timing.annotate(early_stop=pairs, tokens_saved=saved_tokens, ms_saved=round(saved_ms, 1))
+        logging.info("%s組がそろったためストリームを閉じました: %sトークン受信, 最大%sトークン・約%.0fms節約",
+                     pairs, received, saved_tokens, saved_ms)
+    elif finish.get('reason') == 'length':
+        logging.warning("応答がmax_tokens（%s）で打ち切られました", max_tokens)
+
+def generate_response(prompt, model, client, language, shell, moderation=None, events=False,
+                      max_tokens=None, stop=None, max_pairs=None, deadline=None, prompt_tokens=None,
+                      temperature=None):
+    """
+    ストリーミングレスポンスを生成（codex_query_fixed.pyの方式を採用）
+    moderationにstart_moderation()のFutureを渡すと、判定が出るまで出力を保留し、
+    不適切と判定された場合はストリームを中断してNoneを返す
+    events=Trueの場合は、コメントとコマンドの組をJSONの1行ずつ出力する
+    temperatureは送信する温度（省略時はTEMPERATURE。応答キャッシュのキーと同じ値を渡す）、
+    max_tokensは生成するトークン数の上限、stopは停止シーケンス（省略時はCODEX_STOP）、
+    max_pairsはそろったらストリームを閉じる組の数（省略時はCODEX_MAX_PAIRS、0は無効）
+    deadlineはクエリ全体の締め切り（省略時はここから）。接続、最初のトークン、差分の間隔、
+    全体のいずれかの制限時間を超えた場合は、出力済みの部分を残してtimeouts.QueryTimeoutを送出する
+    prompt_tokensはpromptのトークン数（PromptFileが数えた値、省略時はここで数える）で、
+    レート制限（CODEX_RPM/CODEX_TPM）が有効な場合は送信前にmax_tokensと合わせて予約する
+    Ctrl-Cではストリームを閉じ、出力済みの部分を持つGenerationInterruptedを送出する
+    """
+    logging.debug("APIリクエスト: モデル=%s, プロンプト長=%s", model, len(str(prompt)))
+    openai = _load_openai()
+    deadline = deadline or timeouts.Deadline()
     
     try:
         # システムプロンプトの準備
-        system_prompt = format_system_prompt(language, shell)
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": prompt}
-        ]
+        system_prompt, messages = _chat_messages(prompt, language, shell)
         
         # 処理中メッセージを表示
-        print("\n#   処理中...", end="", flush=True)
-        
-        # ストリーミング応答の生成
-        stream = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=TEMPERATURE,
-            stream=True
-        )
-        
-        # 処理中メッセージをクリア
-        print("\r                 \r", end="", flush=True)
+        if not events:
+            print("\n#   処理中...", end="", flush=True)
         
-        # 応答をリアルタイムで出力
-        full_response = ""
-        for chunk in stream:
-            content = chunk.choices[0].delta.content
-            if content is not None:
-                print(content, end="", flush=True)
-                full_response += content
-        
-        # 改行を追加
-        if not full_response.endswith('\n'):
-            print()
-        
-        return full_response
-    
-    except openai.RateLimitError as e:
-        # 処理中メッセージをクリア
-        print("\r                 \r", end="", flush=True)
+        options = _chat_options(max_tokens, stop)
+        max_pairs = MAX_PAIRS if max_pairs is None else max_pairs
+        temperature = TEMPERATURE if temperature is None else temperature
+
+        # 同じマシンの他のシェルと共有する予算を予約し、足りなければ順番が来るまで待つ
+        limiter = rate_limiter.get_limiter()
+        if limiter.enabled:
+            tokens = _reserved_tokens(prompt, system_prompt, max_tokens, prompt_tokens)
+            with timing.span("rate_limit"):
+                waited = limiter.acquire(tokens, deadline.bound(None), None if events else _show_wait)
+            if waited is None:
+                raise timeouts.QueryTimeout('rate_limit', deadline.seconds)
+            if waited and not events:
+                print("\r" + " " * 24 + "\r#   処理中...", end="", flush=True)
+
+        # ストリーミング応答の生成（接続と応答ヘッダーの受信まで、ヘッジする場合は最初のトークンまで）
+        # レート制限やサーバーエラーの場合は待ってから再試行する。リクエストから読み込みまでを
+        # timeouts.watchのスレッドで行い、最初のトークンと差分の間隔の制限時間を判定する
+        started = time.perf_counter()
+        retry_until = _retry_until(deadline)
+
+        def create():
+            timeout = _request_timeout(openai, deadline)
+            return client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+                **(dict(options, timeout=timeout) if timeout is not None else options)
+            )
+
+        opened = {}
+        finish = {}
+
+        def close_stream():
+            # 読み込みスレッドと重ねて閉じないよう、取り出してから1回だけ閉じる
+            close = getattr(opened.pop('stream', None), 'close', None)
+            if close is not None:
+                close()
+
+        def read_chunks(stream):
+            for chunk in stream:
+                choice = chunk.choices[0]
+                finish['reason'] = getattr(choice, 'finish_reason', None)
+                yield choice.delta.content
+
+        def request():
+            with timing.span("request"):
+                stream = retry.open_stream(create, deadline=retry_until, on_retry=limiter.on_retry)
+            opened['stream'] = stream
+            if isinstance(stream, retry.HedgedStream) and stream.attempt:
+                timing.annotate(hedged=True)
+            try:
+                yield from timing.timed_stream(read_chunks(stream))
+            except GeneratorExit:
+                # 途中で読み込みをやめた（タイムアウトや早期終了）
+                close_stream()
+                raise
+
+        contents = timeouts.watch(request(), deadline)
+        if moderation is not None:
+            contents = _hold_until_moderated(contents, moderation, deadline=deadline)
+
+        def stop_early(pairs):
+            # 必要な組がそろったので、残りの生成を待たずにストリームを閉じる
+            elapsed = time.perf_counter() - started
+            contents.close()
+            close_stream()
+            finish['early'] = (pairs, elapsed)
+
+        try:
+            response = _print_stream(contents, events, max_pairs, stop_early, shell)
+        except _ContentFlagged:
+            # 生成中のストリームを中断する
+            close_stream()
+            return _report_flagged()
+        except BaseException:
+            # タイムアウト、Ctrl-C、出力先の切断（常駐サーバーのクライアントの中断など）では接続を切る
+            close_stream()
+            raise
+
+        _report_finish(finish, response, max_tokens)
+        return response
+
+    except KeyboardInterrupt as e:
+        _report_interrupt()
+        if isinstance(e, GenerationInterrupted):
+            raise
+        raise GenerationInterrupted() from None
+
+    except Exception as e:
+        return _report_error(openai, e)
+
+def _report_flagged():
+    """不適切と判定された応答を破棄したことを表示する"""
+    logging.warning("モデレーションで不適切と判定されたため応答を破棄しました")
+    print("\n#   不適切なコンテンツが検出されました。応答を制限します。")
+    return None
+
+def _report_error(openai, e):
+    """
+    応答の生成中のエラーを表示してNoneを返す
+    タイムアウトの場合は表示してからtimeouts.QueryTimeoutを送出する
+    """
+    if isinstance(e, timeouts.QueryTimeout):
+        _report_timeout(e)
+        raise e
+
+    if isinstance(e, openai.APITimeoutError):
+        # 再試行しても接続（またはHTTPの読み込み）が制限時間内に終わらなかった
+        phase = 'connect' if 'Connect' in type(e.__cause__).__name__ else 'idle'
+        error = timeouts.QueryTimeout(phase, timeouts.limit(phase) or 0)
+        _report_timeout(error)
+        raise error from e
+
+    # 処理中メッセージをクリア
+    print("\r                 \r", end="", flush=True)
+    if isinstance(e, openai.RateLimitError):
         # レート制限エラー
-        logging.error(f"OpenAI レート制限エラー: {str(e)}")
+        logging.error("OpenAI レート制限エラー: %s", e)
         print(f"\n# エラー: APIレート制限に達しました。しばらく待ってから再試行してください。")
-        return None
-    
-    except openai.APIError as e:
-        # 処理中メッセージをクリア
-        print("\r                 \r", end="", flush=True)
+    elif isinstance(e, openai.APIError):
         # 一般的なAPI エラー
-        logging.error(f"OpenAI API エラー: {str(e)}")
+        logging.error("OpenAI API エラー: %s", e)
         print(f"\n# エラー: API呼び出し中にエラーが発生しました。")
-        return None
-    
-    except Exception as e:
-        # 処理中メッセージをクリア
-        print("\r                 \r", end="", flush=True)
+    else:
         # その他の例外
-        logging.error(f"予期しないエラー: {str(e)}", exc_info=True)
+        logging.error("予期しないエラー: %s", e, exc_info=True)
         print(f"\n# エラー: 予期しないエラーが発生しました。")
-        return None
+    return None
+
+async def generate_response_async(prompt, model, client, language, shell, moderation=None, events=False,
+                                  max_tokens=None, stop=None, max_pairs=None, deadline=None, prompt_tokens=None,
+                                  temperature=None):
+    """
+    generate_responseのasyncio版（clientはAsyncOpenAI）
+    moderationにはis_sensitive_content_async()のタスクを渡す。引数と結果はgenerate_responseと同じで、
+    制限時間は読み込みスレッドを使わずに差分ごとに判定し、ヘッジリクエストはタスクとして競わせる
+    キャンセルされた場合（_run_asyncではCtrl-C）は、すぐにストリームを閉じて接続を切り、
+    出力済みの部分を持つGenerationInterruptedを送出する
+    """
+    import asyncio
+    logging.debug("APIリクエスト（asyncio）: モデル=%s, プロンプト長=%s", model, len(str(prompt)))
+    openai = _load_openai()
+    deadline = deadline or timeouts.Deadline()
+    first_token = timeouts.limit('first_token')
+    idle = timeouts.limit('idle')
+    stream = None
+    contents = None
+    printer = None
+
+    try:
+        system_prompt, messages = _chat_messages(prompt, language, shell)
+        if not events:
+            print("\n#   処理中...", end="", flush=True)
+        options = _chat_options(max_tokens, stop)
+        max_pairs = MAX_PAIRS if max_pairs is None else max_pairs
+        temperature = TEMPERATURE if temperature is None else temperature
+
+        # 同じマシンの他のシェルと共有する予算を予約し、足りなければ順番が来るまで待つ
+        limiter = rate_limiter.get_limiter()
+        if limiter.enabled:
+            tokens = _reserved_tokens(prompt, system_prompt, max_tokens, prompt_tokens)
+            with timing.span("rate_limit"):
+                # SQLiteのロックを待つ間もCtrl-Cで取り消せるよう別スレッドで予約する
+                waited = await asyncio.get_running_loop().run_in_executor(
+                    None, limiter.reserve, tokens, deadline.bound(None))
+                if waited is None:
+                    raise timeouts.QueryTimeout('rate_limit', deadline.seconds)
+                if waited:
+                    if not events:
+                        _show_wait(waited)
+                    await asyncio.sleep(waited)
+            if waited and not events:
+                print("\r" + " " * 24 + "\r#   処理中...", end="", flush=True)
+
+        started = time.perf_counter()
+        requested = time.monotonic()
+        waiting = True
+
+        async def within(awaitable):
+            # 最初のトークン（送信から）、差分の間隔、クエリ全体の制限時間まで待つ
+            phase, seconds, wait = timeouts.next_wait(waiting, requested, deadline, first_token, idle)
+            try:
+                return await _wait_within(awaitable, wait)
+            except asyncio.TimeoutError:
+                raise timeouts.QueryTimeout(phase, seconds) from None
+
+        async def create():
+            timeout = _request_timeout(openai, deadline)
+            return await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+                **(dict(options, timeout=timeout) if timeout is not None else options)
+            )
+
+        finish = {}
+
+        async def read_chunks():
+            async for chunk in stream:
+                choice = chunk.choices[0]
+                finish['reason'] = getattr(choice, 'finish_reason', None)
+                yield choice.delta.content
+
+        # ヘッジする場合は最初のトークンまで（CODEX_HEDGE_AFTER秒たっても届かなければもう1つ送る）
+        with timing.span("request"):
+            stream = await within(retry.open_stream_async(create, deadline=_retry_until(deadline),
+                                                          on_retry=limiter.on_retry))
+        if isinstance(stream, retry.AsyncHedgedStream) and stream.attempt:
+            timing.annotate(hedged=True)
+        contents = timing.timed_astream(read_chunks())
+        printer = _StreamPrinter(events, max_pairs, shell)
+        # モデレーションの結果が出るまでは差分を保持する
+        pending = [] if moderation is not None else None
+        size = 0
+
+        async def release(received):
+            nonlocal pending
+            if pending is not None:
+                pending.extend(received)
+                if await _moderation_result_async(moderation, deadline):
+                    raise _ContentFlagged()
+                received, pending = pending, None
+            return any(printer.write(content) for content in received)
+
+        stopped = False
+        while not stopped:
+            try:
+                content = await within(contents.__anext__())
+            except StopAsyncIteration:
+                break
+            if content is None:
+                continue
+            if content:
+                waiting = False
+            if pending is not None and not moderation.done() and size + len(content) < MODERATION_BUFFER_CHARS:
+                pending.append(content)
+                size += len(content)
+                continue
+            stopped = await release([content])
+        # 結果より先にストリームが終わった場合
+        if not stopped and pending is not None:
+            stopped = await release([])
+        if stopped:
+            # 必要な組がそろったので、残りの生成を待たずにストリームを閉じる
+            finish['early'] = (printer.completed, time.perf_counter() - started)
+
+        response = printer.close()
+        _report_finish(finish, response, max_tokens)
+        return response
+
+    except _ContentFlagged:
+        printer.close()
+        return _report_flagged()
+
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        partial = printer.close() if printer is not None else ""
+        _report_interrupt()
+        raise GenerationInterrupted(partial) from None
+
+    except Exception as e:
+        if printer is not None:
+            printer.close()
+        return _report_error(openai, e)
+
+    finally:
+        # 途中でやめた場合もここで接続を切る
+        await _close_async(contents, stream)
+
+async def _close_async(contents, stream):
+    """ストリームと差分の読み込みを閉じる（取り消した読み込みが残っていても接続は切る）"""
+    for close in (getattr(stream, 'close', None), getattr(contents, 'aclose', None)):
+        if close is None:
+            continue
+        try:
+            await close()
+        except Exception as e:
+            logging.debug("ストリームを閉じる際のエラー: %s", e)
+
+def _show_wait(seconds):
+    """レート制限で待つ時間を処理中メッセージの代わりに表示する"""
+    print("\r#   送信待ち 約{}秒".format(int(seconds + 0.999)), end="", flush=True)
+
+def _report_timeout(error):
+    """タイムアウトを表示する（出力済みの部分はそのまま残す）"""
+    timing.annotate(timeout=error.phase)
+    logging.warning("タイムアウトしました: %s", error)
+    # 処理中メッセージをクリア
+    print("\r                 \r", end="", flush=True)
+    print(f"\n# タイムアウト: {error}。時間をおいて再試行してください。")
+
+def _report_interrupt():
+    """Ctrl-Cで中断したことを表示する（出力済みの部分はそのまま残す）"""
+    timing.annotate(interrupted=True)
+    logging.info("Ctrl-Cで応答の生成を中断しました")
+    # 処理中メッセージをクリア
+    print("\r                 \r", end="", flush=True)
+    print("\n# 中断しました")
+
+def shell_prefix(shell):
+    """シェルタイプに応じたプロンプトのプレフィックス"""
+    if shell == "zsh":
+        return '#!/bin/zsh\n\n'
+    elif shell == "bash":
+        return '#!/bin/bash\n\n'
+    elif shell == "powershell":
+        return '<# powershell #>\n\n'
+    else:
+        return '#' + shell + '\n\n'
+
+def run_query(user_query, prompt_file, client, use_cache=True, events=False):
+    """自然言語クエリを処理して応答を出力する"""
+    config = prompt_file.config
+    timing.annotate(kind="query")
+    # クエリ全体の締め切り（履歴や例の検索、モデレーション、応答の生成を含む）
+    deadline = timeouts.Deadline()
+
+    # 「# force クエリ」は過去の応答やキャッシュを使わずにAPIに問い合わせる
+    user_query, forced = history_lookup.split_force(user_query)
+    use_history = history_lookup.lookup_enabled()
+
+    # 過去に同じまたはほぼ同じクエリがあれば、その応答を返す
+    # （応答キャッシュとは別の機能のため、CODEX_HISTORY_LOOKUPと「# force」だけで切り替える）
+    # マルチターンモードでは「それを削除して」のように直前の会話で意味が変わるため使わない
+    if use_history and not forced and config['multi_turn'] != "on":
+        with timing.span("history_lookup"):
+            match = history_lookup.get_index().lookup(user_query, config['shell'], prompt_file.store.turns())
+        if match is not None:
+            timing.annotate(history_hit=True)
+            # 過去の応答を返す場合もクエリのモデレーションは行う
+            if _moderate(user_query, client):
+                return _report_flagged()
+            replay_response(match.response, events)
+            return match.response
+
+    # プロンプトの構築
+    with timing.span("context"):
+        context = shell_prefix(config['shell']) + prompt_file.read_prompt_file(user_query)
+    codex_query = context + user_query
+
+    # 同じプロンプトの応答がキャッシュにあれば再生する（モデレーション済みの応答のみ保存される）
+    cache = None
+    if use_cache and response_cache.cache_enabled():
+        cache = response_cache.ResponseCache()
+        cache_key = response_cache.make_key(
+            config['model'], config['temperature'], config['shell'], config['language'],
+            format_system_prompt(config['language'], config['shell']), context, user_query
+        )
+        with timing.span("cache"):
+            generated_text = None if forced else cache.get(cache_key)
+        if generated_text is not None:
+            timing.annotate(cached=True)
+            replay_response(generated_text, events)
+            if config['multi_turn'] == "on":
+                with timing.span("history"):
+                    prompt_file.add_input_output_pair(user_query, generated_text)
+            return generated_text
+    
+    # 応答の生成（ストリーミング方式）
+    # モデレーションは応答の生成と並行して実行し、判定が出るまで出力を保留する
+    # 温度は応答キャッシュのキーと同じ設定の値を送る
+    started = time.perf_counter()
+    options = dict(events=events, max_tokens=config['max_tokens'], temperature=config['temperature'],
+                   deadline=deadline, prompt_tokens=prompt_file.last_prompt_tokens)
+    try:
+        if _is_async_client(client):
+            generated_text = _run_async(_generate_async(codex_query, user_query, config, client, options))
+        else:
+            moderation = start_moderation(user_query, client)
+            generated_text = generate_response(codex_query, config['model'], client, config['language'],
+                                               config['shell'], moderation=moderation, **options)
+    except GenerationInterrupted as e:
+        _save_partial(prompt_file, user_query, e.partial)
+        raise
+
+    if generated_text and cache is not None:
+        cache.put(cache_key, generated_text)
+    if generated_text and use_history:
+        index = history_lookup.get_index()
+        index.record(config['shell'], user_query, generated_text)
+        index.record_api_time(time.perf_counter() - started)
+    
+    # マルチターンモードの場合、会話履歴を保存
+    if generated_text and config['multi_turn'] == "on":
+        with timing.span("history"):
+            prompt_file.add_input_output_pair(user_query, generated_text)
+
+    return generated_text
+
+def _moderate(user_query, client):
+    """応答を生成せずに返す前に、クエリが不適切かをチェックする（clientはOpenAIまたはAsyncOpenAI）"""
+    if not _is_async_client(client):
+        return is_sensitive_content(user_query, client)
+
+    async def moderate():
+        # AsyncOpenAIの接続はこのイベントループでしか使えないため、終わったらclientを閉じる
+        try:
+            return await is_sensitive_content_async(user_query, client)
+        finally:
+            await client.close()
+    return _run_async(moderate())
+
+async def _generate_async(codex_query, user_query, config, client, options):
+    """
+    モデレーションと応答の生成を同じイベントループで並行して実行する
+    AsyncOpenAIの接続はこのイベントループでしか使えないため、終わったらclientを閉じる
+    """
+    import asyncio
+    moderation = asyncio.ensure_future(is_sensitive_content_async(user_query, client))
+    try:
+        return await generate_response_async(codex_query, config['model'], client, config['language'],
+                                             config['shell'], moderation=moderation, **options)
+    finally:
+        moderation.cancel()
+        await client.close()
+
+def _run_async(coroutine):
+    """
+    コルーチンをasyncioで実行する
+    Ctrl-CではKeyboardInterruptの代わりにタスクをキャンセルし、ストリームを閉じるなどの
+    後片付けをさせる（2回目のCtrl-Cは通常どおりKeyboardInterruptになる）
+    """
+    import asyncio
+    import signal
+    import threading
+    interrupted = []
+
+    async def run():
+        task = asyncio.current_task()
+        loop = asyncio.get_event_loop()
+
+        def cancel(signum, frame):
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            loop.call_soon_threadsafe(task.cancel)
+
+        # シグナルのハンドラーはメインスレッドでしか設定できない
+        installed = threading.current_thread() is threading.main_thread()
+        if installed:
+            previous = signal.signal(signal.SIGINT, cancel)
+        try:
+            return await coroutine
+        except GenerationInterrupted as e:
+            # イベントループを通常どおり閉じてから送出する
+            interrupted.append(e)
+        finally:
+            if installed:
+                signal.signal(signal.SIGINT, previous if previous is not None else signal.SIG_DFL)
+
+    result = asyncio.run(run())
+    if interrupted:
+        raise interrupted[0]
+    return result
+
+def _save_partial(prompt_file, user_query, partial):
+    """中断した応答の出力済みの部分を、打ち切られた応答として会話履歴に保存する（CODEX_SAVE_PARTIAL）"""
+    if not SAVE_PARTIAL or not partial.strip() or prompt_file.config['multi_turn'] != "on":
+        return
+    with timing.span("history"):
+        prompt_file.add_input_output_pair(user_query, partial.rstrip('\n') + '\n' + INTERRUPTED_MARK + '\n')
+    logging.info("中断した応答を会話履歴に保存しました: %s文字", len(partial))
+
+def run_batch_from_args(args, prompt_file, api_key, org_id):
+    """
+    --batch [ファイル] [--concurrency N] [--no-cache] を処理する
+    Returns: 失敗した件数
+    """
+    import batch
+    index = args.index("--batch")
+    input_file = args[index + 1] if index + 1 < len(args) and not args[index + 1].startswith("--") else None
+    concurrency = batch.BATCH_CONCURRENCY
+    if "--concurrency" in args and args.index("--concurrency") + 1 < len(args):
+        concurrency = int(args[args.index("--concurrency") + 1])
+
+    if input_file:
+        text, _ = read_text(input_file)
+    else:
+        text = sys.stdin.read()
+
+    # 再試行はbatchがretry.pyで行うため、対話モードと同じ設定のクライアントを使う
+    client = create_async_client(api_key, org_id)
+    return batch.run_batch(text, prompt_file, client, concurrency, use_cache="--no-cache" not in args)
 
 def main():
     """メイン処理"""
+    # 常駐サーバーモード（codex_client.pyから起動される）
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        from codex_server import serve
+        shell = sys.argv[3] if len(sys.argv) > 3 and sys.argv[2] == "--shell" else None
+        serve(shell)
+        return
+
+    # 各処理の時間を計測する（CODEX_TIMINGが設定されている場合のみ）
+    timing.begin()
+    status = "ok"
     try:
         # シェル検出（元のcodex_query.pyの機能を維持）
-        detect_shell()
+        with timing.span("detect_shell"):
+            detect_shell()
         
-        # 初期化
-        prompt_file, client, language = initialize()
+        # 設定とプロンプトファイルの準備（OpenAIクライアントはまだ作らない）
+        # APIキーはモデルを呼び出す場合だけ必要なため、組み込みコマンドの後で確かめる
+        with timing.span("load_config"):
+            api_key, org_id, model_name, language = load_config(require_key=False)
+        with timing.span("prompt_file"):
+            prompt_file = create_prompt_file(model_name, language)
 
-        # クエリ取得
-        user_query, prompt_file = get_query(prompt_file)
-        if user_query is None:
-            return
-        
-        config = prompt_file.config if prompt_file else {
-            'model': MODEL,
-            'temperature': TEMPERATURE,
-            'max_tokens': MAX_TOKENS,
-            'shell': SHELL,
-            'multi_turn': MULTI_TURN,
-            'token_count': 0,
-            'language': language
-        }
-
-        # シェルタイプに応じたプレフィックスを使用
-        prefix = ""
-        if config['shell'] == "zsh":
-            prefix = '#!/bin/zsh\n\n'
-        elif config['shell'] == "bash":
-            prefix = '#!/bin/bash\n\n'
-        elif config['shell'] == "powershell":
-            prefix = '<# powershell #>\n\n'
-        else:
-            prefix = '#' + config['shell'] + '\n\n'
+        # バッチモード（ファイルまたは標準入力の複数のクエリを同時に処理する）
+        if "--batch" in sys.argv:
+            require_api_key(api_key)
+            timing.annotate(kind="batch")
+            sys.exit(1 if run_batch_from_args(sys.argv[1:], prompt_file, api_key, org_id) else 0)
 
-        # プロンプトの構築
-        codex_query = prefix + prompt_file.read_prompt_file(user_query) + user_query
-        
-        # モデレーションチェック
-        if is_sensitive_content(user_query, client):
-            print("\n#   不適切なコンテンツが検出されました。応答を制限します。")
+        # クエリ取得（組み込みコマンドはここで処理されて終了する）
+        with timing.span("input"):
+            user_query, prompt_file = get_query(prompt_file)
+        if user_query is None:
             return
+        require_api_key(api_key)
 
-        # 応答の生成（ストリーミング方式）
-        generated_text = generate_response(codex_query, config['model'], client, config['language'], config['shell'])
-        
-        # マルチターンモードの場合、会話履歴を保存
-        if generated_text and config['multi_turn'] == "on":
-            prompt_file.add_input_output_pair(user_query, generated_text)
+        # モデル呼び出しが必要な場合だけクライアントを初期化
+        # （Ctrl-Cで接続をすぐに切れるよう、asyncioで応答を生成する）
+        with timing.span("create_client"):
+            client = create_async_client(api_key, org_id)
+        run_query(user_query, prompt_file, client, use_cache="--no-cache" not in sys.argv,
+                  events="--events" in sys.argv)
         
+    except KeyboardInterrupt:
+        # 応答の生成中はメッセージを表示済み
+        status = "interrupted"
+        sys.exit(INTERRUPTED_EXIT_CODE)
+    except timeouts.QueryTimeout:
+        # メッセージは表示済み。プラグインが判定できるよう専用の終了コードで終える
+        status = "timeout"
+        sys.exit(timeouts.EXIT_CODE)
     except FileNotFoundError:
+        status = "error"
         logging.error('Prompt file not found, try again')
         print('\n\n# Codex CLI error: プロンプトファイルが見つかりません')
     except UnicodeError as e:
-        logging.error(f'Unicode encoding error: {str(e)}')
+        status = "error"
+        logging.error('Unicode encoding error: %s', e)
         print(f'\n\n# Codex CLI error: 文字エンコーディングエラー - {str(e)}')
     except Exception as e:
-        logging.error(f'Unexpected exception - {str(e)}')
+        status = "error"
+        logging.error('Unexpected exception - %s', e)
         print('\n\n# Codex CLI error: 予期しないエラーが発生しました - ' + str(e))
+    finally:
+        timing.end(status)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
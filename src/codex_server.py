@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+codex_query_integrated.pyの常駐サーバーモード
+
+OpenAIクライアント、PromptFile、設定を一度だけ初期化してメモリに保持し、
+Unixソケット経由でcodex_client.pyからのリクエストを処理する。
+一定時間リクエストがなければ自動的に終了する。
+"""
+
+import os
+import io
+import sys
+import json
+import socket
+import logging
+import threading
+import contextlib
+
+import codex_query_integrated as codex
+import timing
+import timeouts
+from codex_client import secure_dir, socket_path
+from session import sanitize
+from commands import get_command_result
+from env_config import env_float
+
+# アイドル状態でサーバーを終了するまでの秒数
+IDLE_TIMEOUT = env_float('CODEX_DAEMON_IDLE_TIMEOUT', 900)
+# 接続してからリクエストを送り終えるまでの最大秒数
+REQUEST_READ_TIMEOUT = 5.0
+
+_timing_lock = threading.Lock()
+
+
+class _SocketWriter(io.TextIOBase):
+    """print()の出力をソケットへそのまま送るためのテキストストリーム"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.conn.sendall(text.encode('utf-8'))
+        return len(text)
+
+
+class _ThreadStdout(io.TextIOBase):
+    """
+    スレッドごとに出力先を切り替えるsys.stdout
+    （contextlib.redirect_stdoutはプロセス全体のsys.stdoutを置き換えるため、同時に処理する接続の出力が混ざる）
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def _target(self):
+        return getattr(self.local, 'target', None) or self.default
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    @contextlib.contextmanager
+    def redirect(self, target):
+        """このスレッドの出力をtargetへ送る"""
+        self.local.target = target
+        try:
+            yield
+        finally:
+            self.local.target = None
+
+
+class _Sessions:
+    """端末のセッションごとのPromptFileと、同じセッションのリクエストを順に処理するためのロック"""
+
+    def __init__(self, prompt_file):
+        # セッションの指定がなければ最初のものを使う
+        self.prompt_files = {None: prompt_file}
+        self.locks = {None: threading.Lock()}
+        self.lock = threading.Lock()
+
+    def lock_for(self, session):
+        """セッションのロックを返す（初めてのセッションならPromptFileを作成する）"""
+        with self.lock:
+            if session not in self.prompt_files:
+                self.prompt_files[session] = self.prompt_files[None].for_session(session)
+                self.locks[session] = threading.Lock()
+            return self.locks[session]
+
+
+def _read_request(conn):
+    """改行で終わるJSONリクエストを1件読み込む"""
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode('utf-8')) if data.strip() else {}
+
+
+def handle_request(request, prompt_file, client):
+    """リクエストを処理し、(終了コード, prompt_file)を返す（出力はsys.stdoutへ）"""
+    entry = request.get("input", "")
+    if not entry:
+        print("# エラー: 入力がありません")
+        return 1, prompt_file
+
+    timing.begin()
+    timing.annotate(daemon=True)
+    status = "ok"
+    try:
+        # まず、入力がコマンドかどうかをチェック
+        with timing.span("input"):
+            command_result, prompt_file = get_command_result(entry, prompt_file)
+        if command_result == "":
+            codex.run_query(entry, prompt_file, client, use_cache=not request.get("no_cache", False),
+                            events=request.get("events", False))
+        return 0, prompt_file
+    except timeouts.QueryTimeout:
+        # メッセージは表示済み
+        status = "timeout"
+        return timeouts.EXIT_CODE, prompt_file
+    except SystemExit as e:
+        status = "exit"
+        return (e.code if isinstance(e.code, int) else 1), prompt_file
+    except Exception as e:
+        status = "error"
+        logging.error("サーバーでのリクエスト処理中にエラーが発生しました: %s", e, exc_info=True)
+        print('\n\n# Codex CLI error: 予期しないエラーが発生しました - ' + str(e))
+        return 1, prompt_file
+    finally:
+        timing.end(status)
+
+
+def _serve_connection(conn, request, sessions, client, stdout):
+    """
+    1つの接続のリクエストを処理する（接続ごとのスレッドで実行）
+    同じセッションのリクエストは、PromptFileの履歴と設定を共有するため順に処理する
+    """
+    with conn:
+        session = sanitize(request["session"]) if request.get("session") else None
+        try:
+            try:
+                lock = sessions.lock_for(session)
+            except Exception as e:
+                logging.error("セッションの初期化に失敗しました: %s - %s", session, e, exc_info=True)
+                conn.sendall("# Codex CLI error: {}\n\x001".format(str(e)).encode('utf-8'))
+                return
+            # 計測の記録はプロセスで1つのため、計測中は他のセッションとも順に処理する
+            with lock, (_timing_lock if timing.enabled() else contextlib.nullcontext()):
+                with stdout.redirect(_SocketWriter(conn)):
+                    status, sessions.prompt_files[session] = handle_request(
+                        request, sessions.prompt_files[session], client)
+                conn.sendall(b"\0" + str(status).encode('ascii'))
+                # 設定の変更は応答を返した後に書き込む
+                sessions.prompt_files[session].flush_config()
+        except OSError as e:
+            # クライアントが途中で切断した（Ctrl+Cなど）
+            logging.warning("クライアントが切断されました: %s", e)
+
+
+def _bind(path):
+    """
+    ソケットを作成する。既に別のサーバーが応答する場合や、
+    ディレクトリが他のユーザーのもので安全に使えない場合はNone
+    """
+    directory = os.path.dirname(path)
+    if not secure_dir(directory):
+        logging.error("ソケットのディレクトリが他のユーザーのものか、他のユーザーが書き込めます: %s", directory)
+        return None
+
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            probe.close()
+            logging.info("サーバーは既に起動しています: %s", path)
+            return None
+        except OSError:
+            probe.close()
+            # 前回のサーバーが残したソケットファイルを削除
+            os.unlink(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # bind()で作られるソケットファイルを作成した時点から所有者だけが使えるようにする
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+    return server
+
+
+def serve(shell=None, idle_timeout=IDLE_TIMEOUT):
+    """常駐サーバーを起動し、アイドルタイムアウトまでリクエストを処理する"""
+    if shell:
+        codex.set_shell(shell)
+    else:
+        codex.detect_shell()
+        shell = codex.SHELL
+
+    # 初期化（クライアント、PromptFile、設定はプロセスの寿命の間使い回す）
+    prompt_file, client, language = codex.initialize()
+    sessions = _Sessions(prompt_file)
+
+    path = socket_path(shell)
+    server = _bind(path)
+    if server is None:
+        return
+    server.settimeout(idle_timeout)
+    logging.info("サーバーを起動しました: %s (shell=%s, pid=%s)", path, shell, os.getpid())
+
+    # 接続ごとのスレッドの出力を、それぞれのソケットへ送る
+    stdout = sys.stdout
+    sys.stdout = thread_stdout = _ThreadStdout(stdout)
+    workers = []
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                workers = [worker for worker in workers if worker.is_alive()]
+                if workers:
+                    # 処理中のリクエストがあればアイドル状態ではない
+                    continue
+                logging.info("%s秒間リクエストがないためサーバーを終了します", idle_timeout)
+                break
+
+            # リクエストはすぐに送られてくるため、読み込みまではこのスレッドで行う
+            conn.settimeout(REQUEST_READ_TIMEOUT)
+            try:
+                request = _read_request(conn)
+            except (OSError, ValueError) as e:
+                logging.error("リクエストの読み込みに失敗しました: %s", e)
+                conn.close()
+                continue
+            conn.settimeout(None)
+
+            if request.get("command") == "shutdown":
+                with conn:
+                    conn.sendall(b"\x000")
+                logging.info("停止要求を受け取りました")
+                break
+            if not request:
+                # 接続先を確認しただけで切断したクライアント
+                conn.close()
+                continue
+
+            worker = threading.Thread(target=_serve_connection, args=(conn, request, sessions, client, thread_stdout), daemon=True)
+            worker.start()
+            workers = [worker for worker in workers if worker.is_alive()] + [worker]
+    finally:
+        server.close()
+        with contextlib.suppress(OSError):
+            os.unlink(path)
+        # 処理中のリクエストは最後まで応答する
+        for worker in workers:
+            worker.join()
+        sys.stdout = stdout
@@ -3,6 +3,11 @@ import time
 
 from pathlib import Path
 from prompt_file import *
+from response_cache import ResponseCache
+from moderation_cache import get_cache as get_moderation_cache
+from history_lookup import HistoryIndex
+from rate_limiter import get_limiter
+import timing
 
 def get_command_result(input, prompt_file):
     """
@@ -20,6 +25,9 @@ def get_command_result(input, prompt_file):
     - set temperature <temperature>
     - set max_tokens <max_tokens>
     - set shell <shell>
+    - show cache
+    - clear response cache
+    - show stats
 
     Returns: command result or "" if no command matched
     """
@@ -27,13 +35,17 @@ def get_command_result(input, prompt_file):
         return "", None
     
     config = prompt_file.config
+    # commands without arguments must match the whole input, so that a query such as
+    # "# show stats for docker containers" still goes to the model
+    command = ' '.join(input.strip().lstrip('#').split())
+
     # configuration setting commands
     if input.__contains__("set"):
         # set temperature <temperature>
         if input.__contains__("temperature"):
             input = input.split()
             if len(input) == 4:
-                config['temperature'] = float(input[3])
+                config = config.replace(temperature=float(input[3]))
                 prompt_file.set_config(config)
                 print("# Temperature set to " + str(config['temperature']))
                 return "config set", prompt_file
@@ -43,7 +55,7 @@ def get_command_result(input, prompt_file):
         elif input.__contains__("max_tokens"):
             input = input.split()
             if len(input) == 4:
-                config['max_tokens'] = int(input[3])
+                config = config.replace(max_tokens=int(input[3]))
                 prompt_file.set_config(config)
                 print("# Max tokens set to " + str(config['max_tokens']))
                 return "config set", prompt_file
@@ -52,7 +64,7 @@ def get_command_result(input, prompt_file):
         elif input.__contains__("shell"):
             input = input.split()
             if len(input) == 4:
-                config['shell'] = input[3]
+                config = config.replace(shell=input[3])
                 prompt_file.set_config(config)
                 print("# Shell set to " + str(config['shell']))
                 return "config set", prompt_file
@@ -61,7 +73,7 @@ def get_command_result(input, prompt_file):
         elif input.__contains__("engine"):
             input = input.split()
             if len(input) == 4:
-                config['model'] = input[3]
+                config = config.replace(model=input[3])
                 prompt_file.set_config(config)
                 print("# Model set to " + str(config['model']))
                 return "config set", prompt_file
@@ -72,6 +84,55 @@ def get_command_result(input, prompt_file):
         prompt_file.show_config()
         return "config shown", prompt_file
 
+    # response cache commands
+    if command == "show cache":
+        cache = ResponseCache()
+        stats = cache.stats()
+        cache.close()
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = 100.0 * stats['hits'] / lookups if lookups else 0.0
+        print('\n# response cache: {} entries, {} hits, {} misses ({:.1f}% hit rate)'.format(
+            stats['entries'], stats['hits'], stats['misses'], hit_rate))
+
+        stats = get_moderation_cache().stats()
+        print('# moderation: {} API calls, {} avoided ({} allowlist, {} cached)'.format(
+            stats['calls'], stats['allowlist'] + stats['cached'], stats['allowlist'], stats['cached']))
+        return "cache shown", prompt_file
+
+    # answers from the local history and per-phase timings recorded with CODEX_TIMING
+    if command == "show stats":
+        index = HistoryIndex()
+        stats = index.stats()
+        index.close()
+        hit_rate = 100.0 * stats['hits'] / stats['lookups'] if stats['lookups'] else 0.0
+        print('\n# history lookup: {} pairs, {} hits in {} lookups ({:.1f}% hit rate), '
+              '{:.1f} ms per lookup, {:.1f} s saved'.format(
+                  stats['pairs'], stats['hits'], stats['lookups'], hit_rate, stats['lookup_ms'],
+                  stats['saved_ms'] / 1000.0))
+
+        limiter = get_limiter()
+        if limiter.enabled:
+            waits = limiter.stats()
+            print('# rate limit: {:g} requests/min, {:g} tokens/min, {} waits, {:.1f} s waited'.format(
+                limiter.limits['requests'], limiter.limits['tokens'], waits['waits'], waits['wait_ms'] / 1000.0))
+
+        records = timing.read_records()
+        if not records:
+            print('# no timing records yet, set CODEX_TIMING=1 to record the time of each phase')
+            return "stats shown", prompt_file
+        print('# timings of the last {} runs (ms)'.format(len(records)))
+        print('# {:<20} {:>6} {:>10} {:>10}'.format('phase', 'count', 'p50', 'p95'))
+        for name, (count, p50, p95) in sorted(timing.summarize(records).items()):
+            print('# {:<20} {:>6} {:>10.1f} {:>10.1f}'.format(name, count, p50, p95))
+        return "stats shown", prompt_file
+
+    if command == "clear response cache":
+        cache = ResponseCache()
+        cache.clear()
+        cache.close()
+        print('\n#   Response cache has been cleared')
+        return "cache cleared", prompt_file
+
     # multi turn/single turn commands
     if input.__contains__("multi-turn"):
         # start context
@@ -96,24 +157,23 @@ def get_command_result(input, prompt_file):
         # show context <n>
         if input.__contains__("show"):
             print('\n')
-            with open(prompt_file.file_name, 'r') as f:
-                lines = f.readlines()
-                lines = lines[6:] # skip headers
-            
-            line_numbers = 0
+            # show the last <n> lines of the history (all lines when n is not given)
+            line_count = 0
             if len(input.split()) > 3:
-                line_numbers = int(input.split()[3])
-            
-            if line_numbers != 0:
-                for line in lines[-line_numbers:]:
-                    print('\n# '+line, end='')
-            else:
-                print('\n# '.join(lines))
+                line_count = int(input.split()[3])
+
+            lines = prompt_file.store.text().splitlines()
+            if line_count != 0:
+                lines = lines[-line_count:]
+            for line in lines:
+                print('# ' + line)
             return "context shown", prompt_file
-        
+
         # edit context
         if input.__contains__("view"):
-            # open the prompt file in text editor
+            # write the history to the prompt file and open it in text editor
+            # (the edited file replaces the history on the next query)
+            prompt_file.store.export_file(prompt_file.file_path)
             if config['shell'] != 'powershell':
                 os.system('open {}'.format(prompt_file.file_path))
             else:
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+コンテキストの設定（current_context.config）
+
+設定はプロセスごとに1回だけ読み込む変更不可のオブジェクトとして扱い、
+変更は replace() で新しいオブジェクトを作る。ファイルへの書き込みは
+値が変わったときだけ、プロセス終了時（またはflush()の呼び出し時）に
+一時ファイルからの置き換えでまとめて行う。
+ファイルは「key: value」形式で、キー名で読み込むため行の順序に依存しない。
+"""
+
+import os
+import atexit
+import logging
+import tempfile
+
+from text_reader import read_text
+
+
+class ContextConfig:
+    # フィールド名と型（ファイルに書き込む順）
+    FIELDS = (
+        ('model', str),
+        ('temperature', float),
+        ('max_tokens', int),
+        ('shell', str),
+        ('multi_turn', str),
+        ('token_count', int),
+        ('language', str),
+    )
+    DEFAULTS = {
+        'model': 'gpt-4o',
+        'temperature': 0.0,
+        'max_tokens': 300,
+        'shell': 'unknown',
+        'multi_turn': 'off',
+        'token_count': 0,
+        'language': 'en',
+    }
+    # 古いコンテキストファイルのキー名
+    ALIASES = {'engine': 'model'}
+
+    __slots__ = tuple(name for name, _ in FIELDS)
+
+    def __init__(self, **values):
+        for name, kind in self.FIELDS:
+            object.__setattr__(self, name, kind(values.get(name, self.DEFAULTS[name])))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ContextConfig is immutable, use replace()")
+
+    def __getitem__(self, name):
+        # 辞書と同じ書き方（config['model']）で読めるようにする
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default) if name in self.__slots__ else default
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.__slots__]
+
+    def replace(self, **changes):
+        """変更した値を持つ新しい設定を返す"""
+        values = dict(self.items())
+        values.update(changes)
+        return ContextConfig(**values)
+
+    def __eq__(self, other):
+        return isinstance(other, ContextConfig) and self.items() == other.items()
+
+    def __hash__(self):
+        return hash(tuple(self.items()))
+
+    def __repr__(self):
+        return 'ContextConfig({})'.format(', '.join('{}={!r}'.format(k, v) for k, v in self.items()))
+
+    @classmethod
+    def from_mapping(cls, values):
+        """辞書（または設定オブジェクト）から設定を作る"""
+        if isinstance(values, cls):
+            return values
+        return cls(**{name: values[name] for name in cls.__slots__ if name in values})
+
+    @classmethod
+    def parse(cls, text, defaults=None):
+        """
+        「key: value」形式のテキストを読み込む
+        知らないキーや壊れた行は無視し、足りない値はdefaultsを使う
+        """
+        values = dict(defaults.items()) if defaults is not None else {}
+        for line in text.splitlines():
+            if ':' not in line:
+                continue
+            key, value = line.lstrip('#').split(':', 1)
+            key = cls.ALIASES.get(key.strip(), key.strip())
+            if key in cls.__slots__:
+                values[key] = value.strip()
+        try:
+            return cls(**values)
+        except ValueError as e:
+            logging.error("設定の値が不正なため既定値を使用します: %s", e)
+            return defaults if defaults is not None else cls()
+
+    def format(self):
+        return ''.join('{}: {}\n'.format(name, value) for name, value in self.items())
+
+
+class ConfigFile:
+    def __init__(self, path):
+        self.path = path
+        # ファイルに書かれている（書かれる予定の）設定
+        self.stored = None
+        self._written = None
+        self._pending = None
+        self._registered = False
+
+    def load(self, defaults=None):
+        """ファイルを1回だけ読み込む（なければNone）"""
+        try:
+            text, _ = read_text(self.path)
+        except OSError:
+            return None
+        self.stored = self._written = ContextConfig.parse(text, defaults)
+        return self.stored
+
+    def save(self, config):
+        """値が変わっていれば、プロセス終了時に書き込むよう予約する"""
+        self.stored = config
+        if config == self._written:
+            self._pending = None
+            return
+        self._pending = config
+        if not self._registered:
+            atexit.register(self.flush)
+            self._registered = True
+
+    def flush(self):
+        """予約された設定を一時ファイル経由でまとめて書き込む"""
+        config = self._pending
+        if config is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        temp_path = None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.context-config-')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(config.format())
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.error("設定ファイルの書き込みに失敗しました: %s", e)
+            if temp_path is not None and os.path.exists(temp_path):
+                os.unlink(temp_path)
+            return
+        self._written = config
+        self._pending = None
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+会話履歴をトークン予算内に収めるコンテキストウィンドウ
+
+履歴は空行で区切られたターン（"# クエリ"行と応答行のまとまり）の並びとして扱う。
+先頭のfew-shot例（シェル用コンテキストファイルの例文）は固定し、
+予算を超えた分は古いターンから丸ごと取り除く。
+"""
+
+from collections import deque
+
+from tokenizer import count_tokens
+from env_config import env_int
+
+# プロンプトに含める履歴のトークン予算
+CONTEXT_TOKEN_BUDGET = env_int('CODEX_CONTEXT_TOKENS', 2048)
+
+
+def split_turns(text):
+    """
+    テキストを空行区切りのターンに分割する
+    各ターンは後続の空行を含むため、''.join(turns) で元のテキストに戻る
+    """
+    turns = []
+    current = []
+    has_content = False
+    for line in text.splitlines(keepends=True):
+        blank = not line.strip()
+        # 空行の後に内容のある行が来たら新しいターンを始める
+        if not blank and has_content and not current[-1].strip():
+            turns.append(''.join(current))
+            current = []
+            has_content = False
+        current.append(line)
+        has_content = has_content or not blank
+    if current:
+        turns.append(''.join(current))
+    return turns
+
+
+def count_pinned(turns, examples):
+    """履歴の先頭でfew-shot例と一致するターンの数を返す"""
+    pinned = 0
+    for turn, example in zip(turns, examples):
+        if turn.strip() != example.strip():
+            break
+        pinned += 1
+    return pinned
+
+
+class ContextWindow:
+    def __init__(self, turns, pinned=0, budget=CONTEXT_TOKEN_BUDGET, tokens=None):
+        """
+        tokensには各ターンのトークン数を渡せる（履歴ストアに保存済みの値。Noneのターンはここで数える）
+        """
+        if tokens is None:
+            tokens = [None] * len(turns)
+        tokens = [count_tokens(turn) if count is None else count for turn, count in zip(turns, tokens)]
+        self.budget = budget
+        self.pinned = list(turns[:pinned])
+        self.pinned_tokens = sum(tokens[:pinned])
+        self.history = deque(turns[pinned:])
+        self.history_tokens = deque(tokens[pinned:])
+        self.tokens = self.pinned_tokens + sum(self.history_tokens)
+
+    def fit(self, reserve=0):
+        """
+        reserve（今回のクエリ分）を含めて予算に収まるまで古いターンを取り除く
+        Returns: (取り除いたターン数, 取り除いたトークン数)
+        """
+        evicted = 0
+        trimmed = 0
+        while self.history and self.tokens + reserve > self.budget:
+            self.history.popleft()
+            tokens = self.history_tokens.popleft()
+            self.tokens -= tokens
+            trimmed += tokens
+            evicted += 1
+        return evicted, trimmed
+
+    def text(self):
+        return ''.join(self.pinned) + ''.join(self.history)
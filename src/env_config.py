@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+環境変数から数値の設定を読み込む
+
+値が空なら既定値を使い、数値として読めない場合は警告を記録して既定値を使う
+（設定の誤りで起動できなくならないように）。
+軽量クライアントからも読み込むため、loggingは警告するときだけインポートする。
+"""
+
+import os
+
+
+def _read(name, default, convert):
+    value = os.environ.get(name, '')
+    if value.strip() == '':
+        return default
+    try:
+        return convert(value)
+    except ValueError:
+        import logging
+        logging.warning("環境変数の値が不正なため既定値（%s）を使用します: %s=%r", default, name, value)
+        return default
+
+
+def env_int(name, default):
+    """環境変数の整数の値（空または不正なら既定値）"""
+    return _read(name, default, int)
+
+
+def env_float(name, default):
+    """環境変数の小数の値（空または不正なら既定値）"""
+    return _read(name, default, float)
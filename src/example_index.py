@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+contexts/*.txt のfew-shot例から、クエリに近いものを選ぶ検索インデックス
+
+各コンテキストファイルの例（「# クエリ」行とコマンドのターン）を単語と
+文字bigramに分割してキャッシュフォルダのSQLite（examples.sqlite3）に保存し、
+BM25でクエリとの近さを計算する。英数字は単語ごと（語尾のsを除いた先頭6文字で、
+process/processesなどの活用の違いを吸収する）、空白で区切られない
+日本語などは2文字ずつの組を語として扱う。
+ファイルは（更新時刻, サイズ）で変更を確認し、変わったファイルだけを分割し直す。
+"""
+
+import os
+import re
+import math
+import logging
+import threading
+import unicodedata
+from collections import Counter
+
+import cache_db
+from tokenizer import count_tokens
+from context_window import split_turns
+from history_store import parse_context
+from text_reader import read_text
+from env_config import env_int
+
+# プロンプトに含める例の数（0ならシェル用コンテキストファイルの例をすべて使う）
+EXAMPLE_COUNT = env_int('CODEX_EXAMPLES', 8)
+# 選んだ例の合計トークン数の上限
+EXAMPLE_TOKEN_BUDGET = env_int('CODEX_EXAMPLE_TOKENS', 400)
+
+CONTEXTS_DIR = os.path.join(os.path.dirname(__file__), "..", "contexts")
+
+# BM25のパラメータ
+K1 = 1.2
+B = 0.75
+
+_WORDS = re.compile(r"[a-z0-9_]+")
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+")
+
+
+def tokenize(text):
+    """テキストを検索用の語（英数字の単語と、日本語などの文字bigram）に分割する"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    terms = []
+    for word in _WORDS.findall(text):
+        if len(word) < 2:
+            continue
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        terms.append(word[:6])
+    for run in _CJK.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def read_examples(path):
+    """
+    コンテキストファイルの例を読み込む
+    Returns: (シェル名またはNone, 例のターンのリスト)
+    """
+    headers, body = parse_context(read_text(path)[0])
+    values = dict((key.strip(), value.strip()) for key, value in
+                  (line.split(':', 1) for line in headers if ':' in line))
+    # 例どうしをつなげても区切りが残るよう、各ターンは空行で終える
+    turns = [turn.strip() + '\n\n' for turn in split_turns(body) if turn.strip()]
+    return values.get('shell'), turns
+
+
+class ExampleIndex:
+    def __init__(self, directory=CONTEXTS_DIR, path=None):
+        self.directory = directory
+        self.path = path or cache_db.cache_path("examples.sqlite3")
+        self.conn = None
+        # ファイル名 -> （更新時刻, サイズ）
+        self.stamps = None
+        # [(ファイル名, 位置, シェル, テキスト, トークン数, 語の出現回数)]
+        self.examples = []
+        self.document_frequency = Counter()
+        self.average_length = 0.0
+        # 常駐サーバーでは複数のリクエストのスレッドから同時に使われる
+        self.lock = threading.RLock()
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = cache_db.connect(self.path)
+            with self.conn:
+                self.conn.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, stamp TEXT NOT NULL)")
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS examples ("
+                    "name TEXT NOT NULL, position INTEGER NOT NULL, shell TEXT, text TEXT NOT NULL, "
+                    "tokens INTEGER NOT NULL, terms TEXT NOT NULL, PRIMARY KEY (name, position))"
+                )
+        return self.conn
+
+    def _scan(self):
+        """コンテキストファイルごとの（更新時刻, サイズ）を返す"""
+        stamps = {}
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError as e:
+            logging.warning("コンテキストフォルダを読み込めません: %s", e)
+            return stamps
+        for entry in entries:
+            if entry.name.endswith('.txt') and entry.is_file():
+                stat = entry.stat()
+                stamps[entry.name] = '{}:{}'.format(stat.st_mtime_ns, stat.st_size)
+        return stamps
+
+    def refresh(self):
+        """
+        変更されたコンテキストファイルだけを分割し直してインデックスを更新する
+        Returns: 分割し直したファイルの数
+        """
+        stamps = self._scan()
+        if stamps == self.stamps:
+            return 0
+
+        conn = self._connect()
+        changed = 0
+        with conn:
+            stored = dict(conn.execute("SELECT name, stamp FROM files"))
+            for name in set(stored) - set(stamps):
+                conn.execute("DELETE FROM files WHERE name = ?", (name,))
+                conn.execute("DELETE FROM examples WHERE name = ?", (name,))
+            for name, stamp in stamps.items():
+                if stored.get(name) == stamp:
+                    continue
+                try:
+                    shell, turns = read_examples(os.path.join(self.directory, name))
+                except OSError as e:
+                    logging.warning("コンテキストファイルを読み込めません: %s: %s", name, e)
+                    continue
+                conn.execute("DELETE FROM examples WHERE name = ?", (name,))
+                conn.executemany(
+                    "INSERT INTO examples (name, position, shell, text, tokens, terms) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(name, i, shell, turn, count_tokens(turn), ' '.join(tokenize(turn)))
+                     for i, turn in enumerate(turns)],
+                )
+                conn.execute("INSERT OR REPLACE INTO files (name, stamp) VALUES (?, ?)", (name, stamp))
+                changed += 1
+        if changed:
+            logging.debug("例のインデックスを更新しました: %sファイル", changed)
+
+        self.examples = [
+            (name, position, shell, text, tokens, Counter(terms.split()))
+            for name, position, shell, text, tokens, terms in
+            conn.execute("SELECT name, position, shell, text, tokens, terms FROM examples ORDER BY name, position")
+        ]
+        self.document_frequency = Counter()
+        for example in self.examples:
+            self.document_frequency.update(example[5].keys())
+        lengths = [sum(example[5].values()) for example in self.examples]
+        self.average_length = sum(lengths) / len(lengths) if lengths else 0.0
+        self.stamps = stamps
+        return changed
+
+    def score(self, query_terms, counts):
+        """1つの例のBM25スコア"""
+        total = len(self.examples)
+        length = sum(counts.values())
+        norm = K1 * (1 - B + B * length / self.average_length) if self.average_length else K1
+        score = 0.0
+        for term in query_terms:
+            tf = counts.get(term)
+            if not tf:
+                continue
+            df = self.document_frequency[term]
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            score += idf * tf * (K1 + 1) / (tf + norm)
+        return score
+
+    def select(self, query, shell, count=EXAMPLE_COUNT, budget=EXAMPLE_TOKEN_BUDGET, prefer=None):
+        """
+        同じシェルの例からクエリに近いものを最大count個、合計budgetトークンまで選ぶ
+        一致する語がない分は、preferのファイル（シェル用コンテキストファイル）の先頭の例で補う
+        Returns: 例のターンのリスト（クエリに近いものほど後ろ）
+        """
+        with self.lock:
+            return self._select(query, shell, count, budget, prefer)
+
+    def _select(self, query, shell, count, budget, prefer):
+        self.refresh()
+        query_terms = set(tokenize(query))
+        ranked = []
+        for name, position, example_shell, text, tokens, counts in self.examples:
+            if example_shell is not None and example_shell != shell:
+                continue
+            ranked.append((-self.score(query_terms, counts), name != prefer, name, position, text, tokens))
+        ranked.sort()
+
+        selected = []
+        used = 0
+        seen = set()
+        for _, _, _, _, text, tokens in ranked:
+            if len(selected) >= count:
+                break
+            # 同じ例が複数のファイルにある場合は1つだけ使う
+            if text in seen or used + tokens > budget:
+                continue
+            seen.add(text)
+            selected.append(text)
+            used += tokens
+        # クエリに最も近い例をクエリの直前に置く
+        selected.reverse()
+        return selected
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+# 常駐サーバーではプロセス内で使い回す
+_index = None
+
+
+def get_index():
+    """共有のインデックスを返す"""
+    global _index
+    if _index is None or _index.path != cache_db.cache_path("examples.sqlite3"):
+        _index = ExampleIndex()
+    return _index
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+過去のクエリと応答の組から、同じまたはほぼ同じクエリに即座に答える索引
+
+contexts/*.txt（保存したコンテキスト）、deleted/*.txt（クリアした履歴）、
+現在の会話履歴、APIで生成した応答から「# クエリ」と応答の組を集め、
+正規化したクエリ（全角半角の統一、小文字化、記号の除去）の文字trigramの
+一致度（Dice係数）がしきい値以上なら、その応答をAPIを呼ばずに返す。
+応答は同じシェルのものだけを使い、「## shell:」ヘッダーのないファイルは使わない。
+「kill process 1584」と「kill process 1585」を取り違えないよう、
+クエリに含まれる数字が完全に一致する場合のみ一致とみなす。
+同じく「move a.txt to b.txt」と「move b.txt to a.txt」を取り違えないよう、
+両方のクエリに含まれる語（ストップワードを除く）が同じ順序で現れる場合のみ一致とみなす。
+ファイルは（更新時刻, サイズ）で変更を確認し、変わったファイルだけを読み直す。
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+import unicodedata
+from collections import namedtuple
+
+import cache_db
+from context_window import split_turns
+from history_store import parse_context
+from text_reader import read_text
+from env_config import env_float
+
+# この値以上の一致度なら過去の応答を使う（1.0は完全一致のみ）
+THRESHOLD = env_float('CODEX_HISTORY_THRESHOLD', 0.85)
+# APIで生成した応答を保存する最大件数
+MAX_ANSWERS = 5000
+# 「# force クエリ」で索引を使わずにAPIに問い合わせる
+FORCE_PREFIX = "force"
+
+SOURCE_DIRS = (
+    os.path.join(os.path.dirname(__file__), "..", "contexts"),
+    os.path.join(os.path.dirname(__file__), "..", "deleted"),
+)
+
+_SYMBOLS = re.compile(r"[\W_]+")
+_NUMBERS = re.compile(r"\d+")
+# 英数字の語と、それ以外（日本語など）の文字の並び
+_WORDS = re.compile(r"[a-z0-9]+|[^a-z0-9\s]+")
+# 語順の比較で無視する語
+STOPWORDS = frozenset(("a", "an", "the", "to", "in", "on", "at", "of", "for", "from", "into", "and", "or",
+                       "with", "by", "is", "are"))
+
+Match = namedtuple('Match', ['query', 'response', 'similarity'])
+
+
+def lookup_enabled():
+    """環境変数CODEX_HISTORY_LOOKUPで索引が無効化されていないか"""
+    return os.environ.get('CODEX_HISTORY_LOOKUP', '1') not in ('', '0')
+
+
+def split_force(user_query):
+    """
+    「# force クエリ」から「# force」を取り除く
+    Returns: (クエリ, forceが指定されたか)
+    """
+    stripped = user_query.lstrip()
+    if stripped.startswith('#'):
+        words = stripped[1:].split(None, 1)
+        if words and words[0].lower() == FORCE_PREFIX:
+            return '# ' + (words[1] if len(words) > 1 else '\n'), True
+    return user_query, False
+
+
+def normalize(query):
+    """比較用にクエリを正規化する（先頭の#、記号、大文字小文字、全角半角の違いを無視）"""
+    text = unicodedata.normalize('NFKC', query).lower().strip().lstrip('#')
+    # what's と whats を同じにする
+    text = text.replace("'", "").replace("\u2019", "")
+    return ' '.join(_SYMBOLS.sub(' ', text).split())
+
+
+def trigrams(text):
+    """前後に空白を付けた文字trigramの集合"""
+    padded = ' {} '.format(text)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _words(text):
+    """語順の比較に使う語（ストップワードを除く）"""
+    return [word for word in _WORDS.findall(text) if word not in STOPWORDS]
+
+
+def same_order(a, b):
+    """正規化したクエリの両方に含まれる語が同じ順序で現れるか"""
+    words_a = _words(a)
+    words_b = _words(b)
+    common = set(words_a) & set(words_b)
+    return [word for word in words_a if word in common] == [word for word in words_b if word in common]
+
+
+def similarity(a, b):
+    """正規化したクエリどうしの一致度（0.0〜1.0）"""
+    if a == b:
+        return 1.0
+    if _NUMBERS.findall(a) != _NUMBERS.findall(b):
+        return 0.0
+    # trigramは語順を区別しないため、「aをbに移動」と「bをaに移動」を取り違えないよう語順を確かめる
+    if not same_order(a, b):
+        return 0.0
+    grams_a = trigrams(a)
+    grams_b = trigrams(b)
+    return 2.0 * len(grams_a & grams_b) / (len(grams_a) + len(grams_b))
+
+
+def parse_pairs(text):
+    """「# クエリ」行と応答のターンから(クエリ, 応答)の組を取り出す"""
+    pairs = []
+    for turn in split_turns(text):
+        lines = [line for line in turn.splitlines() if line.strip()]
+        if len(lines) < 2 or not lines[0].startswith('#') or lines[0].startswith('##'):
+            continue
+        pairs.append((lines[0], '\n'.join(lines[1:]) + '\n'))
+    return pairs
+
+
+class HistoryIndex:
+    def __init__(self, path=None, directories=SOURCE_DIRS):
+        self.path = path or cache_db.cache_path("history_index.sqlite3")
+        self.directories = directories
+        self.conn = cache_db.connect(self.path)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, stamp TEXT NOT NULL)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS pairs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL, shell TEXT, "
+                "normalized TEXT NOT NULL, query TEXT NOT NULL, response TEXT NOT NULL, grams INTEGER NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS pairs_normalized ON pairs (normalized)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS pairs_source ON pairs (source)")
+            # クエリのtrigramごとの転置索引（ほぼ同じクエリの候補を全件比較せずに絞り込む）
+            self.conn.execute("CREATE TABLE IF NOT EXISTS grams (gram TEXT NOT NULL, pair INTEGER NOT NULL, "
+                              "PRIMARY KEY (gram, pair)) WITHOUT ROWID")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS grams_pair ON grams (pair)")
+            self.conn.execute("CREATE TRIGGER IF NOT EXISTS pairs_delete AFTER DELETE ON pairs "
+                              "BEGIN DELETE FROM grams WHERE pair = old.id; END")
+        self.stamps = None
+        # 常駐サーバーでは複数のリクエストのスレッドから同時に使われる
+        self.lock = threading.RLock()
+
+    def _scan(self):
+        """対象ファイルごとの（更新時刻, サイズ）を返す"""
+        stamps = {}
+        for directory in self.directories:
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.endswith('.txt') and entry.is_file():
+                    stat = entry.stat()
+                    stamps[os.path.abspath(entry.path)] = '{}:{}'.format(stat.st_mtime_ns, stat.st_size)
+        return stamps
+
+    def refresh(self):
+        """
+        変更されたファイルだけを読み直して索引を更新する
+        Returns: 読み直したファイルの数
+        """
+        stamps = self._scan()
+        if stamps == self.stamps:
+            return 0
+        changed = 0
+        with self.conn:
+            stored = dict(self.conn.execute("SELECT name, stamp FROM sources"))
+            for name in set(stored) - set(stamps):
+                self.conn.execute("DELETE FROM sources WHERE name = ?", (name,))
+                self.conn.execute("DELETE FROM pairs WHERE source = ?", (name,))
+            for name, stamp in stamps.items():
+                if stored.get(name) == stamp:
+                    continue
+                try:
+                    headers, body = parse_context(read_text(name)[0])
+                except OSError as e:
+                    logging.warning("履歴ファイルを読み込めません: %s: %s", name, e)
+                    continue
+                # 「## shell: bash」ヘッダーがないファイル（以前の形式のクリアした履歴）は
+                # どのシェルの応答か分からないため使わない
+                shell = None
+                for header in headers:
+                    key, _, value = header.partition(':')
+                    if key.strip() == 'shell':
+                        shell = value.strip()
+                self.conn.execute("DELETE FROM pairs WHERE source = ?", (name,))
+                if shell:
+                    for query, response in parse_pairs(body):
+                        self._insert(name, shell, query, response)
+                else:
+                    logging.debug("シェルのヘッダーがないため索引に加えません: %s", name)
+                self.conn.execute("INSERT OR REPLACE INTO sources (name, stamp) VALUES (?, ?)", (name, stamp))
+                changed += 1
+        if changed:
+            logging.debug("履歴の索引を更新しました: %sファイル", changed)
+        self.stamps = stamps
+        return changed
+
+    def _insert(self, source, shell, query, response):
+        normalized = normalize(query)
+        grams = trigrams(normalized)
+        cursor = self.conn.execute(
+            "INSERT INTO pairs (source, shell, normalized, query, response, grams) VALUES (?, ?, ?, ?, ?, ?)",
+            (source, shell, normalized, query, response, len(grams)))
+        self.conn.executemany("INSERT INTO grams (gram, pair) VALUES (?, ?)",
+                              [(gram, cursor.lastrowid) for gram in grams])
+
+    def record(self, shell, query, response):
+        """APIで生成した応答を保存する（同じクエリの古い応答は置き換える）"""
+        normalized = normalize(query)
+        if not normalized or not response.strip():
+            return
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM pairs WHERE source = 'answers' AND shell = ? AND normalized = ?",
+                              (shell, normalized))
+            self._insert('answers', shell, query.strip(), response)
+            self.conn.execute(
+                "DELETE FROM pairs WHERE source = 'answers' AND id NOT IN "
+                "(SELECT id FROM pairs WHERE source = 'answers' ORDER BY id DESC LIMIT ?)",
+                (MAX_ANSWERS,),
+            )
+
+    def record_api_time(self, seconds):
+        """APIで応答を生成した時間を記録する（節約できた時間の見積もりに使う）"""
+        with self.lock:
+            cache_db.increment(self.conn, "history.api_calls")
+            cache_db.increment(self.conn, "history.api_ms", int(seconds * 1000))
+
+    def find(self, query, shell, history_turns=(), threshold=THRESHOLD):
+        """
+        最も一致するクエリの応答を探す（しきい値未満ならNone）
+        history_turnsには現在の会話履歴のターンを渡す
+        """
+        with self.lock:
+            return self._find(query, shell, history_turns, threshold)
+
+    def _find(self, query, shell, history_turns, threshold):
+        self.refresh()
+        normalized = normalize(query)
+        if not normalized:
+            return None
+        history = [(normalize(turn_query), turn_query, response)
+                   for turn_query, response in parse_pairs(''.join(history_turns))]
+
+        # 完全一致は索引から引く（新しいものを優先）
+        for other, turn_query, response in reversed(history):
+            if other == normalized:
+                return Match(turn_query, response, 1.0)
+        row = self.conn.execute(
+            "SELECT query, response FROM pairs WHERE normalized = ? AND shell = ? "
+            "ORDER BY id DESC LIMIT 1", (normalized, shell)).fetchone()
+        if row is not None:
+            return Match(row[0], row[1], 1.0)
+        if threshold >= 1.0:
+            return None
+
+        # ほぼ同じクエリは一致度を計算する（同じ一致度なら新しいものを優先）
+        best = None
+        best_score = threshold
+        grams = sorted(trigrams(normalized))
+        size = len(grams)
+        # 一致度がしきい値以上になりうるのは、共通のtrigramが十分にあり、
+        # trigramの数が size*t/(2-t) 以上 size*(2-t)/t 以下のものだけ
+        candidates = self.conn.execute(
+            "SELECT p.id, p.normalized FROM grams g JOIN pairs p ON p.id = g.pair "
+            "WHERE g.gram IN ({}) AND p.shell = ? AND p.grams BETWEEN ? AND ? "
+            "GROUP BY p.id HAVING 2.0 * COUNT(*) >= ? * (? + p.grams) ORDER BY p.id".format(','.join('?' * size)),
+            grams + [shell, size * threshold / (2 - threshold), size * (2 - threshold) / threshold,
+                     threshold, size]).fetchall()
+        for row_id, other in candidates:
+            score = similarity(normalized, other)
+            if score >= best_score:
+                best, best_score = row_id, score
+        for other, turn_query, response in history:
+            score = similarity(normalized, other)
+            if score >= best_score:
+                best, best_score = Match(turn_query, response, score), score
+        if best is None or isinstance(best, Match):
+            return best
+        row = self.conn.execute("SELECT query, response FROM pairs WHERE id = ?", (best,)).fetchone()
+        return Match(row[0], row[1], best_score)
+
+    def lookup(self, query, shell, history_turns=(), threshold=THRESHOLD):
+        """findと同じだが、ヒット率と節約できた時間を記録する"""
+        with self.lock:
+            start = time.perf_counter()
+            match = self.find(query, shell, history_turns, threshold)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            cache_db.increment(self.conn, "history.lookups")
+            cache_db.increment(self.conn, "history.lookup_ms", int(round(elapsed_ms)))
+            if match is not None:
+                counters = cache_db.read_counters(self.conn)
+                calls = counters.get("history.api_calls", 0)
+                # APIを呼んだ場合の平均時間から、索引を引いた時間を差し引く
+                saved = counters.get("history.api_ms", 0) / calls - elapsed_ms if calls else 0
+                cache_db.increment(self.conn, "history.hits")
+                cache_db.increment(self.conn, "history.saved_ms", max(0, int(saved)))
+                logging.debug("履歴から応答しました: 一致度 %.2f", match.similarity)
+        return match
+
+    def stats(self):
+        """検索回数、ヒット数、平均の検索時間、節約できた時間を返す"""
+        with self.lock:
+            counters = cache_db.read_counters(self.conn)
+            lookups = counters.get("history.lookups", 0)
+            pairs = self.conn.execute("SELECT COUNT(*) FROM pairs").fetchone()[0]
+        return {
+            'lookups': lookups,
+            'hits': counters.get("history.hits", 0),
+            'lookup_ms': counters.get("history.lookup_ms", 0) / lookups if lookups else 0.0,
+            'saved_ms': counters.get("history.saved_ms", 0),
+            'pairs': pairs,
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+# 常駐サーバーではプロセス内で使い回す
+_index = None
+
+
+def get_index():
+    """共有の索引を返す"""
+    global _index
+    if _index is None or _index.path != cache_db.cache_path("history_index.sqlite3"):
+        _index = HistoryIndex()
+    return _index
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+会話履歴をターン単位で保存する追記型のストア
+
+履歴はSQLite（WALモード）の1行1ターンで保持し、ファイル全体の読み直しや
+書き換えをせずに、追加・最後のターンの取り消し・直近Nターンの取得を行う。
+few-shot例のターンはpinnedとして保持し、予算超過時にも削除しない。
+ターンは端末ごとのセッションに属し、複数のシェルから同時に読み書きできる。
+contexts/*.txt の「## key: value」ヘッダー形式との相互変換も提供する。
+"""
+
+import os
+import time
+import hashlib
+import contextlib
+
+import cache_db
+from tokenizer import count_tokens
+from context_window import ContextWindow, count_pinned, split_turns
+from session import DEFAULT_SESSION
+from text_reader import read_text
+
+
+def parse_context(text):
+    """
+    「## 」ヘッダー形式のテキストをヘッダー行（「## 」を除く）と本文に分ける
+    """
+    lines = text.splitlines(keepends=True)
+    header_count = 0
+    while header_count < len(lines) and lines[header_count].startswith('## '):
+        header_count += 1
+    headers = [line[3:] for line in lines[:header_count]]
+    return headers, ''.join(lines[header_count:])
+
+
+def format_context(config, text):
+    """設定と本文を「## 」ヘッダー形式のテキストにする"""
+    headers = ''.join('## {}: {}\n'.format(key, value) for key, value in config.items())
+    return headers + '\n' + text.lstrip('\n')
+
+
+class HistoryStore:
+    def __init__(self, path=None, session=DEFAULT_SESSION):
+        self.session = session
+        self.conn = cache_db.connect(path or cache_db.cache_path("history.sqlite3"))
+        with self._write():
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS turns ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, "
+                "tokens INTEGER NOT NULL, pinned INTEGER NOT NULL, created REAL NOT NULL, "
+                "session TEXT NOT NULL DEFAULT '{}')".format(DEFAULT_SESSION)
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)")
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(turns)")]
+            if 'session' not in columns:
+                # セッション導入前のストアは既定のセッションとして扱う
+                self.conn.execute("ALTER TABLE turns ADD COLUMN session TEXT NOT NULL DEFAULT '{}'".format(DEFAULT_SESSION))
+                self.conn.execute("UPDATE meta SET name = ? || ':' || name", (DEFAULT_SESSION,))
+            self.conn.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns (session, pinned, id)")
+
+    @contextlib.contextmanager
+    def _write(self):
+        """
+        読み取りから書き込みまでを1つのトランザクションにする
+        （他のプロセスの書き込みはこの間だけ待たされる）
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        with self.conn:
+            yield
+
+    def append(self, text, pinned=False):
+        """ターンを末尾に追加し、そのトークン数を返す"""
+        tokens = count_tokens(text)
+        with self.conn:
+            self.conn.execute("INSERT INTO turns (text, tokens, pinned, created, session) VALUES (?, ?, ?, ?, ?)",
+                              (text, tokens, int(pinned), time.time(), self.session))
+        return tokens
+
+    def pop(self):
+        """
+        最後のターン（固定の例文を除く）を取り除く
+        Returns: (テキスト, トークン数)、取り除くターンがなければNone
+        """
+        with self._write():
+            row = self.conn.execute(
+                "SELECT id, text, tokens FROM turns WHERE session = ? AND pinned = 0 ORDER BY id DESC LIMIT 1",
+                (self.session,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("DELETE FROM turns WHERE id = ?", (row[0],))
+        return row[1], row[2]
+
+    def last(self, count):
+        """直近count件のターンを古い順に返す"""
+        rows = self.conn.execute("SELECT text FROM turns WHERE session = ? ORDER BY id DESC LIMIT ?",
+                                 (self.session, count)).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def turns(self):
+        """すべてのターンを古い順に返す"""
+        return [row[0] for row in self.conn.execute("SELECT text FROM turns WHERE session = ? ORDER BY id",
+                                                    (self.session,))]
+
+    def text(self):
+        return ''.join(self.turns())
+
+    def token_count(self):
+        return self.conn.execute("SELECT COALESCE(SUM(tokens), 0) FROM turns WHERE session = ?",
+                                 (self.session,)).fetchone()[0]
+
+    def window(self, budget, reserve=0, select=None):
+        """
+        固定の例文と、予算に収まる直近のターンをつなげたテキストを返す
+        予算を超えた古いターンはストアから削除する
+        selectを指定すると、固定の例文のリストを渡して、返されたターンを代わりに使う
+        Returns: (テキスト, 取り除いたターン数, 取り除いたトークン数)
+        """
+        rows = self.conn.execute(
+            "SELECT id, text, tokens, pinned FROM turns WHERE session = ? ORDER BY pinned DESC, id",
+            (self.session,)).fetchall()
+        pinned = sum(row[3] for row in rows)
+        examples = [row[1] for row in rows[:pinned]]
+        # 保存済みのトークン数を使い、数え直すのは入れ替えた例文だけにする
+        tokens = [row[2] for row in rows[:pinned]]
+        if select is not None:
+            selected = select(examples)
+            if selected is not examples:
+                examples, tokens = selected, [None] * len(selected)
+        window = ContextWindow(examples + [row[1] for row in rows[pinned:]], len(examples), budget,
+                               tokens + [row[2] for row in rows[pinned:]])
+        evicted, trimmed = window.fit(reserve)
+        if evicted:
+            # 取り除いたターンは連続した古いidなので範囲で削除する
+            # （読み取り後に追加されたターンはidが大きいため消えない）
+            with self.conn:
+                self.conn.execute("DELETE FROM turns WHERE session = ? AND pinned = 0 AND id <= ?",
+                                  (self.session, rows[pinned + evicted - 1][0]))
+        return window.text(), evicted, trimmed
+
+    def reset(self, text='', source=None):
+        """
+        履歴を空にして、textのターンを固定の例文として入れ直す
+        sourceが前回と同じで追加のターンがなければ何もしない
+        """
+        key = hashlib.sha256(text.encode('utf-8')).hexdigest() if source is None else source
+        with self._write():
+            if self._get_meta('source') == key and not self.conn.execute(
+                    "SELECT 1 FROM turns WHERE session = ? AND pinned = 0 LIMIT 1", (self.session,)).fetchone():
+                return
+            turns = split_turns(text)
+            self._replace_turns(turns, len(turns))
+            self._set_meta('source', key)
+
+    def import_text(self, text, pinned=0):
+        """テキストを履歴として読み込む（先頭pinned個のターンは固定）"""
+        with self._write():
+            self._replace_turns(split_turns(text), pinned)
+            self._set_meta('source', None)
+
+    def _replace_turns(self, turns, pinned):
+        now = time.time()
+        self.conn.execute("DELETE FROM turns WHERE session = ?", (self.session,))
+        self.conn.executemany(
+            "INSERT INTO turns (text, tokens, pinned, created, session) VALUES (?, ?, ?, ?, ?)",
+            [(turn, count_tokens(turn), int(i < pinned), now, self.session) for i, turn in enumerate(turns)],
+        )
+
+    def import_file(self, path, examples=()):
+        """
+        テキストファイル（current_context.txt）が前回の取り込みや書き出しから変わっていれば、
+        履歴として取り込む（先頭のexamplesと一致するターンは固定）。
+        以前の形式のファイルの最初の取り込みと、export_fileで書き出したファイルを
+        エディタで編集した場合に使う。変わっていなければファイルは読まない
+        Returns: 取り込んだか
+        """
+        try:
+            stamp = self._file_stamp(path)
+        except OSError:
+            return False
+        with self._write():
+            if self._get_meta('file_stamp') == stamp:
+                return False
+            text, _ = read_text(path)
+            turns = split_turns(text)
+            self._replace_turns(turns, count_pinned(turns, list(examples)))
+            self._set_meta('source', None)
+            self._set_meta('file_stamp', stamp)
+        return True
+
+    def export_file(self, path):
+        """履歴をテキストファイルに書き出す（エディタで開く場合。編集するとimport_fileで取り込まれる）"""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.text())
+        with self.conn:
+            self._set_meta('file_stamp', self._file_stamp(path))
+
+    @staticmethod
+    def _file_stamp(path):
+        stat = os.stat(path)
+        return '{}:{}'.format(stat.st_mtime_ns, stat.st_size)
+
+    def _get_meta(self, name):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?",
+                                ('{}:{}'.format(self.session, name),)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                          ('{}:{}'.format(self.session, name), value))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+ログの設定
+
+ログはキュー経由でバックグラウンドのスレッドがcodex_debug.logへ書き込むため、
+クエリの処理がファイルへの書き込みを待つことはない。
+ファイルがCODEX_LOG_MAX_BYTESを超えると、codex_debug.log.1 ... のように
+CODEX_LOG_BACKUPS個まで残してローテーションする。
+常駐サーバーと直接実行のプロセスが同じファイルに書き込むため、ローテーションは
+ロックファイル（.codex_debug.log.lock）を取得した1つのプロセスだけが行い、
+他のプロセスはファイルが置き換えられたことに気付いた時点で開き直す。
+出力するレベルはCODEX_LOG_LEVEL（DEBUG、INFO、WARNING、ERROR、OFF）で指定し、
+デフォルトはWARNING。ログ呼び出しは%形式の引数を使うため、出力しないレベルの
+メッセージは文字列に整形されない。
+"""
+
+import os
+import queue
+import atexit
+import logging
+import logging.handlers
+from contextlib import contextmanager
+
+from env_config import env_int
+
+LOG_FILE = os.environ.get('CODEX_LOG_FILE') or os.path.join(os.path.dirname(__file__), "..", "codex_debug.log")
+LOG_LEVEL = os.environ.get('CODEX_LOG_LEVEL', 'WARNING')
+LOG_MAX_BYTES = env_int('CODEX_LOG_MAX_BYTES', 1024 * 1024)
+LOG_BACKUPS = env_int('CODEX_LOG_BACKUPS', 3)
+LOG_FORMAT = '%(asctime)s - %(process)d - %(levelname)s - %(message)s'
+
+_listener = None
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """メッセージの整形も書き込み用のスレッドで行うQueueHandler"""
+
+    def prepare(self, record):
+        # ログの引数は文字列や数値、例外なので、後から整形しても内容は変わらない
+        return record
+
+
+@contextmanager
+def _rotation_lock(path):
+    """他のプロセスとローテーションが重ならないよう排他ロックを取得する（fcntlがなければロックしない）"""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class _SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """複数のプロセスで共有してもローテーションが競合しないRotatingFileHandler"""
+
+    def __init__(self, filename, **kwargs):
+        self._opened = None
+        super().__init__(filename, **kwargs)
+        directory, name = os.path.split(self.baseFilename)
+        self.lock_file = os.path.join(directory, f".{name}.lock")
+
+    def _open(self):
+        stream = super()._open()
+        st = os.fstat(stream.fileno())
+        self._opened = (st.st_dev, st.st_ino)
+        return stream
+
+    def _is_current(self):
+        """開いているファイルがまだbaseFilenameにあるか"""
+        try:
+            st = os.stat(self.baseFilename)
+        except OSError:
+            return False
+        return (st.st_dev, st.st_ino) == self._opened
+
+    def _close_stream(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def shouldRollover(self, record):
+        # 他のプロセスがローテーションした後は新しいファイルに書く（WatchedFileHandlerと同じ）
+        if self.stream is not None and not self._is_current():
+            self._close_stream()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        with _rotation_lock(self.lock_file):
+            if self._is_current():
+                super().doRollover()
+            else:
+                # ロックを待つ間に他のプロセスがローテーションした
+                self._close_stream()
+
+
+def parse_level(name):
+    """レベル名（または数値）をloggingのレベルに変換する。OFFはNone"""
+    name = str(name).strip().upper()
+    if name in ('OFF', 'NONE'):
+        return None
+    if name.isdigit():
+        return int(name)
+    level = logging.getLevelName(name)
+    return level if isinstance(level, int) else logging.WARNING
+
+
+def setup_logging(path=LOG_FILE, level=LOG_LEVEL):
+    """
+    ルートロガーにキュー経由のローテーションするファイル出力を設定する
+    logging.basicConfigと同じく、既にハンドラーが設定されている場合は何もしない
+    """
+    global _listener
+    root = logging.getLogger()
+    if _listener is not None or root.handlers:
+        return
+
+    level = parse_level(level)
+    if level is None:
+        # ログを出力しない（ハンドラーがない場合の標準エラー出力も抑える）
+        root.setLevel(logging.CRITICAL + 1)
+        root.addHandler(logging.NullHandler())
+        return
+    root.setLevel(level)
+
+    # 実際に書き込むまでファイルは開かない
+    handler = _SharedRotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS,
+                                         encoding='utf-8', delay=True)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt='%Y-%m-%d %H:%M:%S'))
+
+    records = queue.SimpleQueue()
+    root.addHandler(_DeferredQueueHandler(records))
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """キューに残っているログを書き込んでスレッドを止める"""
+    global _listener
+    listener = _listener
+    if listener is None:
+        return
+    _listener = None
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
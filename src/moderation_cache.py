@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+モデレーション結果のキャッシュと、安全なクエリの許可リスト
+
+同じクエリ（正規化後）の判定結果を一定期間保存し、
+contexts/*.txt の例文と同じクエリや、設定ファイルの
+"moderation_allowlist" の正規表現に一致するクエリはAPIを呼び出さない。
+許可リストはプロセスごとに1回だけ作り、get_cache()で共有する
+（常駐サーバーではコンテキストや設定ファイルの変更は再起動後に反映される）。
+"""
+
+import os
+import re
+import json
+import time
+import glob
+import hashlib
+import logging
+import threading
+import unicodedata
+
+import cache_db
+from text_reader import read_text
+from response_cache import cache_enabled
+from env_config import env_float
+
+# 判定結果の有効期限（秒）
+TTL_SECONDS = env_float('CODEX_MODERATION_TTL', 24 * 60 * 60)
+
+CONTEXTS_DIR = os.path.join(os.path.dirname(__file__), "..", "contexts")
+CONFIG_FILE_PATH = os.path.join(os.path.expanduser("~"), ".openai", "codex-cli.json")
+
+
+def normalize(text):
+    """大文字小文字、全角半角、空白、先頭の#の違いを吸収する"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = text.strip().lstrip('#').strip()
+    return re.sub(r'\s+', ' ', text)
+
+
+def _example_queries(contexts_dir=CONTEXTS_DIR):
+    """コンテキストファイルの例文（"# "で始まる行）を正規化して返す"""
+    queries = set()
+    for path in glob.glob(os.path.join(contexts_dir, "*.txt")):
+        try:
+            lines = read_text(path)[0].splitlines()
+        except OSError as e:
+            logging.warning("許可リスト用のコンテキストを読み込めません: %s - %s", path, e)
+            continue
+        for line in lines:
+            # "## "はヘッダー行
+            if line.startswith('# '):
+                queries.add(normalize(line))
+    return queries
+
+
+def _configured_patterns(config_path=CONFIG_FILE_PATH):
+    """設定ファイルのmoderation_allowlist（正規表現のリスト）を読み込む"""
+    if not os.path.exists(config_path):
+        return []
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            patterns = json.load(f).get("moderation_allowlist", [])
+        return [re.compile(pattern) for pattern in patterns]
+    except (OSError, ValueError, re.error) as e:
+        logging.error("moderation_allowlistの読み込みに失敗しました: %s", e)
+        return []
+
+
+class ModerationCache:
+    def __init__(self, path=None, ttl=TTL_SECONDS, contexts_dir=CONTEXTS_DIR, config_path=CONFIG_FILE_PATH):
+        self.ttl = ttl
+        self.examples = _example_queries(contexts_dir)
+        self.patterns = _configured_patterns(config_path)
+        self.path = path or cache_db.cache_path("moderation.sqlite3")
+        self.conn = cache_db.connect(self.path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts ("
+            "key TEXT PRIMARY KEY, flagged INTEGER NOT NULL, created REAL NOT NULL)"
+        )
+        # モデレーションのスレッドと常駐サーバーのリクエストのスレッドが同じ接続を使う
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(text):
+        return hashlib.sha256(normalize(text).encode('utf-8')).hexdigest()
+
+    def is_allowed(self, text):
+        """許可リストに一致するか"""
+        normalized = normalize(text)
+        if normalized in self.examples:
+            return True
+        return any(pattern.search(normalized) for pattern in self.patterns)
+
+    def lookup(self, text):
+        """
+        APIを呼び出さずに判定できればTrue/False、できなければNoneを返す
+        回避できた呼び出し回数を記録する
+        """
+        if self.is_allowed(text):
+            with self.lock:
+                cache_db.increment(self.conn, "moderation.allowlist")
+            return False
+
+        if not cache_enabled():
+            return None
+
+        with self.lock:
+            row = self.conn.execute("SELECT flagged, created FROM verdicts WHERE key = ?",
+                                    (self.make_key(text),)).fetchone()
+            if row is None or time.time() - row[1] > self.ttl:
+                return None
+            cache_db.increment(self.conn, "moderation.cached")
+        return bool(row[0])
+
+    def store(self, text, flagged):
+        """APIの判定結果を保存する"""
+        with self.lock:
+            cache_db.increment(self.conn, "moderation.calls")
+            if not cache_enabled():
+                return
+            now = time.time()
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO verdicts (key, flagged, created) VALUES (?, ?, ?)",
+                                  (self.make_key(text), int(flagged), now))
+                self.conn.execute("DELETE FROM verdicts WHERE created < ?", (now - self.ttl,))
+
+    def stats(self):
+        """API呼び出し回数と、許可リスト/キャッシュで回避した回数を返す"""
+        with self.lock:
+            counters = cache_db.read_counters(self.conn)
+        return {
+            'calls': counters.get("moderation.calls", 0),
+            'allowlist': counters.get("moderation.allowlist", 0),
+            'cached': counters.get("moderation.cached", 0),
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+# 許可リストを毎回作り直さないよう、プロセス内で使い回す
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """共有のモデレーション結果キャッシュを返す"""
+    global _cache
+    with _cache_lock:
+        if _cache is None or _cache.path != cache_db.cache_path("moderation.sqlite3"):
+            _cache = ModerationCache()
+        return _cache
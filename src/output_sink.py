@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+ストリーミング応答の出力先
+
+差分ごとに書き込むと長い応答では数百回のwriteになるため、差分をためて
+改行を受け取ったとき、または一定時間（CODEX_OUTPUT_FLUSH_INTERVAL秒）が
+経過したときにまとめて書き出す。
+端末に直接表示する場合は差分ごとに表示する"raw"モードになる
+（CODEX_OUTPUT_MODEで"raw"、"line"を指定することもできる）。
+"""
+
+import os
+import sys
+import time
+
+from env_config import env_float
+
+# "auto"（端末ならraw、それ以外はline）、"raw"、"line"
+OUTPUT_MODE = os.environ.get('CODEX_OUTPUT_MODE', 'auto')
+# lineモードで改行を待たずに書き出すまでの秒数
+FLUSH_INTERVAL = env_float('CODEX_OUTPUT_FLUSH_INTERVAL', 0.05)
+
+
+class OutputSink:
+    def __init__(self, stream=None, mode=OUTPUT_MODE, interval=FLUSH_INTERVAL, clock=time.monotonic):
+        self.stream = stream if stream is not None else sys.stdout
+        if mode == 'auto':
+            isatty = getattr(self.stream, 'isatty', None)
+            mode = 'raw' if isatty is not None and isatty() else 'line'
+        self.raw = mode == 'raw'
+        self.interval = interval
+        self.clock = clock
+        # 応答全体（文字列の連結を繰り返さないようリストにためる）
+        self.chunks = []
+        self._pending = []
+        self._last_flush = clock()
+        # 書き出しごとの(文字数, 所要秒数)
+        self.flushes = []
+
+    def write(self, text):
+        if not text:
+            return
+        self.chunks.append(text)
+        self._pending.append(text)
+        if self.raw or self.clock() - self._last_flush >= self.interval:
+            self.flush()
+        elif '\n' in text:
+            # 最後の改行までを書き出し、行の途中は次の書き出しまでためる
+            head, newline, tail = text.rpartition('\n')
+            self._pending[-1] = head + newline
+            self.flush()
+            if tail:
+                self._pending.append(tail)
+
+    def flush(self):
+        """たまっている差分を書き出す"""
+        if not self._pending:
+            return
+        data = ''.join(self._pending)
+        self._pending.clear()
+        start = self.clock()
+        self.stream.write(data)
+        self.stream.flush()
+        self._last_flush = self.clock()
+        self.flushes.append((len(data), self._last_flush - start))
+
+    def text(self):
+        """これまでに書き込まれた応答全体"""
+        return ''.join(self.chunks)
+
+    def flush_time(self):
+        """書き出しにかかった合計秒数"""
+        return sum(seconds for _, seconds in self.flushes)
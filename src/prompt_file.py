@@ -1,106 +1,118 @@
 import os
 import time
-import configparser
 import sys
 import logging
 
 from pathlib import Path
+from tokenizer import count_tokens
+from context_window import CONTEXT_TOKEN_BUDGET, count_pinned, split_turns
+from history_store import HistoryStore, format_context, parse_context
+from context_config import ConfigFile, ContextConfig
+from session import DEFAULT_SESSION, session_id
+from text_reader import read_text
+import example_index
+import cache_db
+from log_config import setup_logging
 
-# デバッグログ用の設定
-LOG_FILE = os.path.join(os.path.dirname(__file__), "..", "codex_debug.log")
-logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG, 
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+# ログ設定（codex_query_integratedから読み込まれた場合は設定済み）
+setup_logging()
 
 class PromptFile:
     context_source_filename = ""
     default_context_filename = "current_context.txt"
     default_file_path = os.path.join(os.path.dirname(__file__), "..", default_context_filename)
     default_config_path = os.path.join(os.path.dirname(__file__), "..", "current_context.config")
+    # 履歴ストアの場所（Noneならキャッシュフォルダのhistory.sqlite3）
+    default_store_path = None
 
-    def __init__(self, file_name, config):
+    def __init__(self, file_name, config, session=None):
         self.context_source_filename = "{}-context.txt".format(config['shell']) #  feel free to set your own default context path here
-        
-        self.file_path = self.default_file_path
-        self.config_path = self.default_config_path
+        self._file_name = file_name
+        self._base_config = config
+
+        # 端末ごとのセッション（既定のセッションはリポジトリ直下のファイルを使う）
+        self.session = session or session_id()
+        if self.session == DEFAULT_SESSION:
+            self.file_path = self.default_file_path
+            self.config_path = self.default_config_path
+        else:
+            session_dir = cache_db.cache_path("sessions")
+            self.file_path = os.path.join(session_dir, self.session + ".txt")
+            self.config_path = os.path.join(session_dir, self.session + ".config")
         # configパラメータをインスタンス変数として設定
-        self.config = config
+        # 保存済みの設定があればそれを1回だけ読み込む（言語はcodex-cli.jsonの設定を使う）
+        self.config = ContextConfig.from_mapping(config)
+        self._config_file = ConfigFile(self.config_path)
+        stored = self._config_file.load(self.config)
+        if stored is not None:
+            self.config = stored.replace(language=self.config.language)
+        # 直近のread_prompt_fileで予算超過のため取り除いたトークン数
+        self.last_trimmed_tokens = 0
+        # 直近のread_prompt_fileで組み立てたプロンプトと入力のトークン数（送信前のレート制限の予約に使う）
+        self.last_prompt_tokens = 0
+        self._example_turns = None
 
         # ファイルが存在しない場合は作成する
         self._ensure_files_exist()
 
+        # 会話履歴はストアに保持する
+        # current_context.txtは以前の形式のファイルと"view context"で編集した場合だけ取り込む
+        self.store = HistoryStore(self.default_store_path, self.session)
+        self.store.import_file(self.file_path, self._read_example_turns())
+
         # loading in one of the saved contexts
         if file_name != self.default_context_filename:
             self.load_context(file_name, True)
 
+    def for_session(self, session):
+        """
+        Create a PromptFile for another terminal session with the same initial settings
+        """
+        return PromptFile(self._file_name, self._base_config, session)
+
     def _ensure_files_exist(self):
         """
         ファイルが存在しない場合は作成する
         """
         # コンテキストファイルを確認・作成
         if not os.path.exists(self.file_path):
-            logging.debug(f"コンテキストファイルが存在しないため作成します: {self.file_path}")
+            logging.debug("コンテキストファイルが存在しないため作成します: %s", self.file_path)
             os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
             with open(self.file_path, 'w', encoding='utf-8') as f:
                 f.write('')  # 空のファイルを作成
                 
         # 設定ファイルを確認
         if not self.has_config():
-            logging.debug(f"設定ファイルが存在しないため作成します: {self.config_path}")
+            logging.debug("設定ファイルが存在しないため作成します: %s", self.config_path)
             self.set_config(self.config)
 
     def has_config(self):
         """
         Check if the prompt file has a corresponding config file
         """
-        return os.path.isfile(self.config_path)
+        return self._config_file.stored is not None
     
     def read_config(self):
         """
-        Read the prompt config and return a dictionary
+        Return the prompt config (loaded once per process)
         """
-
         if self.has_config() == False:
             self.set_config(self.config)
-            return self.config
-        
-        try:
-            with open(self.config_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-        except UnicodeDecodeError:
-            # UTF-8でデコードできない場合はcp932を試す
-            with open(self.config_path, 'r', encoding='cp932') as f:
-                lines = f.readlines()
-
-        config = {
-            'model': lines[0].split(':')[1].strip(),
-            'temperature': float(lines[1].split(':')[1].strip()),
-            'max_tokens': int(lines[2].split(':')[1].strip()),
-            'shell': lines[3].split(':')[1].strip(),
-            'multi_turn': lines[4].split(':')[1].strip(),
-            'token_count': int(lines[5].split(':')[1].strip()),
-            'language': 'en'  # デフォルト言語は英語
-        }
-
-        self.config = config
-        return self.config 
+        return self.config
     
     def set_config(self, config):
         """
         Set the prompt headers with the new config
+        The file is written when the process exits, and only if a value changed
         """
-        self.config = config
-        
-        # 親ディレクトリが存在することを確認
-        os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
-        
-        with open(self.config_path, 'w', encoding='utf-8') as f:
-            f.write('model: {}\n'.format(self.config['model']))
-            f.write('temperature: {}\n'.format(self.config['temperature']))
-            f.write('max_tokens: {}\n'.format(self.config['max_tokens']))
-            f.write('shell: {}\n'.format(self.config['shell']))
-            f.write('multi_turn: {}\n'.format(self.config['multi_turn']))
-            f.write('token_count: {}\n'.format(self.config['token_count']))
-            f.write('language: {}\n'.format(self.config.get('language', 'en')))
+        self.config = ContextConfig.from_mapping(config)
+        self._config_file.save(self.config)
+
+    def flush_config(self):
+        """
+        Write a pending config change now (used by the background server)
+        """
+        self._config_file.flush()
     
     def show_config(self):
         print('\n')
@@ -112,26 +124,54 @@ class PromptFile:
     
     def add_input_output_pair(self, user_query, prompt_response):
         """
-        Add lines to file_name and update the token_count
+        Append the interaction to the history as one turn and update the token_count
         """
 
+        # store the turn as "query / response / blank line" like the context files
+        turn = user_query.rstrip('\n') + '\n'
+        if prompt_response:
+            # blank lines inside the response would split it into several turns
+            turn += ''.join(line + '\n' for line in prompt_response.splitlines() if line.strip())
+        turn += '\n'
+
         try:
-            with open(self.file_path, 'a', encoding='utf-8') as f:
-                f.write(user_query)
-                if prompt_response:
-                    f.write(prompt_response)
+            turn_tokens = self.store.append(turn)
         except UnicodeEncodeError as e:
-            logging.error(f"ファイル書き込み時のエンコードエラー: {str(e)}")
+            logging.error("履歴書き込み時のエンコードエラー: %s", e)
             # エンコードエラーが発生した場合、問題のある文字を置換
-            with open(self.file_path, 'a', encoding='utf-8', errors='replace') as f:
-                f.write(user_query)
-                if prompt_response:
-                    f.write(prompt_response)
-        
+            turn = turn.encode('utf-8', errors='replace').decode('utf-8')
+            turn_tokens = self.store.append(turn)
+
         if self.config['multi_turn'] == 'on':
-            self.config['token_count'] += len(user_query.split()) + len(prompt_response.split())
-            self.set_config(self.config)
-    
+            self.set_config(self.config.replace(token_count=self.config.token_count + turn_tokens))
+
+    def _read_example_turns(self):
+        """
+        Returns the few-shot example turns of the shell context file
+        """
+        if self._example_turns is None:
+            self._example_turns = []
+            filepath = os.path.join(os.path.dirname(__file__), "..", "contexts", self.context_source_filename)
+            if os.path.exists(filepath):
+                text, _ = read_text(filepath)
+                self._example_turns = split_turns(parse_context(text)[1])
+        return self._example_turns
+
+    def _select_examples(self, input):
+        """
+        Returns a function that replaces the shell's few-shot examples with
+        the examples of contexts/*.txt most similar to the input
+        """
+        def select(pinned):
+            examples = self._read_example_turns()
+            # keep a context loaded with "load context" as it is
+            if example_index.EXAMPLE_COUNT <= 0 or not examples or len(pinned) != len(examples) \
+                    or count_pinned(pinned, examples) != len(examples):
+                return pinned
+            return example_index.get_index().select(input, self.config['shell'],
+                                                    prefer=self.context_source_filename)
+        return select
+
     def read_prompt_file(self, input):
         """
         Get the updated prompt file
@@ -140,7 +180,8 @@ class PromptFile:
         Returns: the prompt file after appending the input
         """
         # デバッグログを追加
-        logging.debug(f"read_prompt_file called with input: '{input}'")
+        # the query itself is not logged, only its length
+        logging.debug("read_prompt_file called, input length: %s", len(input or ''))
         
         # 空の入力チェックを追加
         if not input or input.strip() == '':
@@ -150,77 +191,42 @@ class PromptFile:
             return None
 
         try:
-            # ファイルが存在することを確認
-            if not os.path.exists(self.file_path):
-                with open(self.file_path, 'w', encoding='utf-8') as f:
-                    f.write('')  # 空のファイルを作成
-            
-            input_tokens_count = len(input.split())
-            need_to_refresh = (self.config['token_count'] + input_tokens_count > 2048)
-
-            if need_to_refresh:
-                # delete first 2 lines of prompt context file
-                try:
-                    with open(self.file_path, 'r', encoding='utf-8') as f:
-                        lines = f.readlines()
-                        prompt = lines[2:] if len(lines) > 2 else []  # ファイルが短い場合の対策
-                except UnicodeDecodeError:
-                    # UTF-8でデコードできない場合はcp932を試す
-                    with open(self.file_path, 'r', encoding='cp932') as f:
-                        lines = f.readlines()
-                        prompt = lines[2:] if len(lines) > 2 else []
-                
-                with open(self.file_path, 'w', encoding='utf-8') as f:
-                    f.writelines(prompt)
-
-            # get input from prompt file
-            try:
-                with open(self.file_path, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-            except UnicodeDecodeError:
-                # UTF-8でデコードできない場合はcp932を試す
-                with open(self.file_path, 'r', encoding='cp932') as f:
-                    lines = f.readlines()
-
-            prompt_content = ''.join(lines)
-            logging.debug(f"Returning prompt content, length: {len(prompt_content)}")
+            # pick up edits made to the file opened by "view context"
+            # (the background server keeps the PromptFile, so this is not only done at startup)
+            self.store.import_file(self.file_path, self._read_example_turns())
+
+            # keep the few-shot examples most similar to the input and as many recent
+            # turns as fit the budget; older turns are dropped from the store
+            reserve = count_tokens(input)
+            prompt_content, evicted, self.last_trimmed_tokens = self.store.window(
+                CONTEXT_TOKEN_BUDGET, reserve, self._select_examples(input))
+
+            prompt_tokens = count_tokens(prompt_content)
+            self.last_prompt_tokens = prompt_tokens + reserve
+            if evicted:
+                self.set_config(self.config.replace(token_count=prompt_tokens))
+                logging.info("コンテキストを縮小しました: %sターン, %sトークンを削除", evicted, self.last_trimmed_tokens)
+            if prompt_tokens + reserve > CONTEXT_TOKEN_BUDGET:
+                logging.warning("固定の例文だけでトークン予算を超えています: %s", CONTEXT_TOKEN_BUDGET)
+
+            logging.debug("Returning prompt content, length: %s", len(prompt_content))
             return prompt_content
             
         except Exception as e:
             error_msg = f"\n#   エラー: プロンプト処理中に問題が発生しました: {str(e)}"
             print(error_msg)
-            logging.error(f"Exception in read_prompt_file: {str(e)}", exc_info=True)
+            logging.error("Exception in read_prompt_file: %s", e, exc_info=True)
             return None
     
     def get_token_count(self):
         """
         Get the actual token count
         """
-        token_count = 0
-        if self.has_config():
-            try:
-                with open(self.config_path, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                    token_count = int(lines[5].split(':')[1].strip())
-            except UnicodeDecodeError:
-                with open(self.config_path, 'r', encoding='cp932') as f:
-                    lines = f.readlines()
-                    token_count = int(lines[5].split(':')[1].strip())
+        # the store keeps the token count of every turn
+        true_token_count = self.store.token_count()
         
-        true_token_count = 0
-        try:
-            with open(self.file_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-        except UnicodeDecodeError:
-            with open(self.file_path, 'r', encoding='cp932') as f:
-                lines = f.readlines()
-            # count the number of words in the prompt file
-            for line in lines:
-                true_token_count += len(line.split())
-        
-        if true_token_count != token_count:
-            self.config['token_count'] = true_token_count
-            self.set_config(self.config)
+        if true_token_count != self.config.token_count:
+            self.set_config(self.config.replace(token_count=true_token_count))
         
         return true_token_count
     
@@ -231,82 +237,47 @@ class PromptFile:
         """
         config = self.read_config()
         filename = time.strftime("%Y-%m-%d_%H-%M-%S") + ".txt"
-        try:
-            with open(self.file_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-        except UnicodeDecodeError:
-            with open(self.file_path, 'r', encoding='cp932') as f:
-                lines = f.readlines()
-                
         filename = os.path.join(os.path.dirname(__file__), "..", "deleted", filename)
         os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # keep the ## headers so that the history lookup knows which shell the answers are for
         with Path(filename).open('w', encoding='utf-8') as f:
-            f.writelines(lines)
-        
-        # delete the prompt file
-        with open(self.file_path, 'w', encoding='utf-8') as f:
-            f.write('')
-        
+            f.write(format_context(config, self.store.text()))
+
+        # empty the history
+        self.store.reset()
+
         print("\n#   Context has been cleared, temporarily saved to {}".format(filename))
         self.set_config(config)
-    
+
     def clear_last_interaction(self):
         """
-        Clear the last interaction from the prompt file
+        Clear the last interaction from the history
         """
-        try:
-            with open(self.file_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-        except UnicodeDecodeError:
-            with open(self.file_path, 'r', encoding='cp932') as f:
-                lines = f.readlines()
-                
-        if len(lines) > 1:
-            lines.pop()
-            lines.pop()
-            with open(self.file_path, 'w', encoding='utf-8') as f:
-                f.writelines(lines)
+        removed = self.store.pop()
+        if removed is not None:
+            # subtract the removed turn from the running total instead of recounting the history
+            self.set_config(self.config.replace(token_count=max(0, self.config.token_count - removed[1])))
             print("\n#   Unlearned interaction")
-    
+
     def save_to(self, save_name):
         """
-        Save the prompt file to a new location with the config
+        Save the history to a new location with the config
         """
         if not save_name.endswith('.txt'):
             save_name = save_name + '.txt'
         save_path = os.path.join(os.path.dirname(__file__), "..", "contexts", save_name)
 
-        # first write the config
-        try:
-            with open(self.config_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-        except UnicodeDecodeError:
-            with open(self.config_path, 'r', encoding='cp932') as f:
-                lines = f.readlines()
-                
-        lines = ['## ' + line for line in lines]
+        # the ## headers hold the config, followed by the turns
         with Path(save_path).open('w', encoding='utf-8') as f:
-            f.writelines(lines)
-        
-        # then write the prompt file
-        try:
-            with open(self.file_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-        except UnicodeDecodeError:
-            with open(self.file_path, 'r', encoding='cp932') as f:
-                lines = f.readlines()
-                
-        with Path(save_path).open('a', encoding='utf-8') as f:
-            f.writelines(lines)
-        
+            f.write(format_context(self.read_config(), self.store.text()))
+
         print('\n#   Context saved to {}'.format(save_name))
-    
+
     def start_multi_turn(self):
         """
         Turn on context mode
         """
-        self.config['multi_turn'] = 'on'
-        self.set_config(self.config)
+        self.set_config(self.config.replace(multi_turn='on'))
         print("\n#   Multi turn mode is on")
 
     
@@ -314,8 +285,7 @@ class PromptFile:
         """
         Turn off context mode
         """
-        self.config['multi_turn'] = 'off'
-        self.set_config(self.config)
+        self.set_config(self.config.replace(multi_turn='off'))
         print("\n#   Multi turn mode is off")
     
     def default_context(self):
@@ -334,21 +304,20 @@ class PromptFile:
 
         # check if the file exists
         if filepath.exists():
-            try:
-                with filepath.open('r', encoding='utf-8') as f:
-                    lines = f.readlines()
-            except UnicodeDecodeError:
-                with filepath.open('r', encoding='cp932') as f:
-                    lines = f.readlines()
-            
-            config = {
-                'temperature': float(lines[1].split(':')[1].strip()),
-                'max_tokens': int(lines[2].split(':')[1].strip()),
-                'shell': lines[3].split(':')[1].strip(),
-                'multi_turn': lines[4].split(':')[1].strip(),
-                'token_count': int(lines[5].split(':')[1].strip()),
-                'language': 'en'  # デフォルト言語は英語
-            }
+            headers, text = parse_context(read_text(filepath)[0])
+            values = dict((key.strip(), value.strip()) for key, value in
+                          (line.split(':', 1) for line in headers if ':' in line))
+            text = text.lstrip('\n')
+
+            config = self.config.replace(
+                # コンテキストファイルのengine行は古いモデル名のため、現在のモデルを引き継ぐ
+                temperature=float(values['temperature']),
+                max_tokens=int(values['max_tokens']),
+                shell=values['shell'],
+                multi_turn=values['multi_turn'],
+                # the header holds a word count, so count the tokens of the examples instead
+                token_count=count_tokens(text),
+            )
 
             # use new config if old config doesn't exist
             if initialize == False or self.has_config() == False:
@@ -356,16 +325,11 @@ class PromptFile:
             else:
                 self.config = self.read_config()
 
-            lines = lines[6:]
-
-            # ファイルが存在することを確認
-            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
-            
-            # write to the current prompt file if we are in multi-turn mode
+            # replace the history with the context if we are not in multi-turn mode
+            # (a no-op when the same context is already loaded without further turns)
             if initialize == False or self.config['multi_turn'] == "off":
-                with open(self.file_path, 'w', encoding='utf-8') as f:
-                    f.writelines(lines)
-                
+                self.store.reset(text)
+
                 if initialize == False:
                     print('\n#   Context loaded from {}'.format(filename))
         else:
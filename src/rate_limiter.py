@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+同じマシンのすべてのシェルとスクリプトで共有する、リクエスト数とトークン数のレート制限
+
+1分あたりのリクエスト数（CODEX_RPM）とトークン数（CODEX_TPM）のトークンバケットを
+キャッシュフォルダのSQLite（rate_limit.sqlite3）に置き、送信前にプロセス間で排他的に予約する。
+予約ではバケットの残量がマイナスになることを許し、その分だけ待ってから送信する
+（先に予約したプロセスから順に送信され、予約した時点で待ち時間がわかる）。
+APIが429を返した場合は、Retry-Afterの間すべてのプロセスの送信を止める。
+どちらの上限も0（既定）なら何もしない。
+"""
+
+import time
+import logging
+import threading
+
+import cache_db
+from env_config import env_float
+
+# 1分あたりのリクエスト数とトークン数の上限（0は無制限）
+REQUESTS_PER_MINUTE = env_float('CODEX_RPM', 0)
+TOKENS_PER_MINUTE = env_float('CODEX_TPM', 0)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, path=None):
+        self.limits = {
+            'requests': REQUESTS_PER_MINUTE if requests_per_minute is None else requests_per_minute,
+            'tokens': TOKENS_PER_MINUTE if tokens_per_minute is None else tokens_per_minute,
+        }
+        self.path = path or cache_db.cache_path("rate_limit.sqlite3")
+        self.conn = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return any(limit > 0 for limit in self.limits.values())
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = _open(self.path)
+        return self.conn
+
+    def reserve(self, tokens, max_wait=None, now=None):
+        """
+        1リクエストとtokensトークンを予約する
+        Returns: 送信までに待つ秒数。max_waitより長く待つ必要がある場合は予約せずにNoneを返す
+        """
+        if not self.enabled:
+            return 0.0
+        # 常駐サーバーでは複数のリクエストのスレッドが同じ接続を使う
+        with self.lock:
+            return self._reserve(tokens, max_wait, now)
+
+    def _reserve(self, tokens, max_wait, now):
+        now = time.time() if now is None else now
+        needs = {'requests': 1, 'tokens': tokens}
+        conn = self._connect()
+        # 他のプロセスと同時に読み書きしないよう、書き込みのロックを取ってから残量を読む
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = dict((name, (level, updated)) for name, level, updated in
+                        conn.execute("SELECT name, level, updated FROM buckets"))
+            levels = {}
+            wait = max(0.0, rows.get('pause', (0.0, 0.0))[1] - now)
+            for name, limit in self.limits.items():
+                if limit <= 0:
+                    continue
+                # 上限より大きい予約は満杯のバケットで受け付ける（いつまでも送れなくならないように）
+                need = min(needs[name], limit)
+                rate = limit / 60.0
+                level, updated = rows.get(name, (limit, now))
+                level = min(limit, level + rate * max(0.0, now - updated))
+                if level < need:
+                    wait = max(wait, (need - level) / rate)
+                levels[name] = level - need
+            if max_wait is not None and wait > max_wait:
+                conn.rollback()
+                return None
+            conn.executemany(
+                "INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)",
+                [(name, level, now) for name, level in levels.items()],
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        if wait > 0:
+            cache_db.increment(conn, "rate_limit.waits")
+            cache_db.increment(conn, "rate_limit.wait_ms", int(wait * 1000))
+            logging.info("レート制限: %sトークンのリクエストを%.1f秒待ってから送信します", tokens, wait)
+        return wait
+
+    def acquire(self, tokens, max_wait=None, on_wait=None, sleep=time.sleep):
+        """
+        予約して送信できるまで待つ（on_wait(秒数)は待つ前に呼ぶ）
+        Returns: 待った秒数。max_waitより長く待つ必要がある場合はNone
+        """
+        wait = self.reserve(tokens, max_wait)
+        if wait:
+            if on_wait is not None:
+                on_wait(wait)
+            sleep(wait)
+        return wait
+
+    def pause(self, seconds, now=None):
+        """すべてのプロセスの送信をseconds秒止める（APIのレート制限を受けた場合）"""
+        if not self.enabled or seconds <= 0:
+            return
+        until = (time.time() if now is None else now) + seconds
+        # 読み込みスレッドから呼ばれるため、この呼び出しだけの接続を使う
+        conn = _open(self.path)
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO buckets (name, level, updated) VALUES ('pause', 0, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET updated = MAX(updated, excluded.updated)",
+                    (until,),
+                )
+        finally:
+            conn.close()
+        logging.warning("レート制限: APIの制限を受けたため%.1f秒すべての送信を止めます", seconds)
+
+    def on_retry(self, error, delay):
+        """retry.callの再試行ごとに呼ばれ、レート制限（429）の場合は他のプロセスも止める"""
+        if getattr(error, 'status_code', None) == 429:
+            self.pause(delay)
+
+    def stats(self):
+        """待った回数と合計の待ち時間（ミリ秒）を返す"""
+        with self.lock:
+            counters = cache_db.read_counters(self._connect())
+        return {
+            'waits': counters.get("rate_limit.waits", 0),
+            'wait_ms': counters.get("rate_limit.wait_ms", 0),
+        }
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def _open(path):
+    conn = cache_db.connect(path)
+    # トランザクションはreserve()で明示的に始める
+    conn.isolation_level = None
+    conn.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)")
+    return conn
+
+
+# 常駐サーバーではプロセス内で使い回す
+_limiter = None
+
+
+def get_limiter():
+    """共有のレート制限を返す"""
+    global _limiter
+    if _limiter is None or _limiter.path != cache_db.cache_path("rate_limit.sqlite3"):
+        _limiter = RateLimiter()
+    return _limiter
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+generate_responseの応答を保存するディスクキャッシュ
+
+モデル、温度、シェル、言語、システムプロンプト、コンテキスト、クエリの
+ハッシュをキーとして応答全体を保存する。
+件数上限を超えた分は最後に使われた時刻が古いものから削除し（LRU）、
+有効期限（TTL）を過ぎたものは参照時と保存時に削除する。
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+
+import cache_db
+from env_config import env_int, env_float
+
+# 保存する最大件数と有効期限（秒）
+MAX_ENTRIES = env_int('CODEX_CACHE_MAX_ENTRIES', 1000)
+TTL_SECONDS = env_float('CODEX_CACHE_TTL', 7 * 24 * 60 * 60)
+
+
+def cache_enabled():
+    """環境変数CODEX_NO_CACHEでキャッシュが無効化されていないか"""
+    return os.environ.get('CODEX_NO_CACHE', '') in ('', '0')
+
+
+def make_key(model, temperature, shell, language, system_prompt, context, query):
+    """プロンプトを構成するすべての要素からキャッシュキーを作成する"""
+    fingerprint = json.dumps(
+        [model, temperature, shell, language, system_prompt, context, query],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=None, max_entries=MAX_ENTRIES, ttl=TTL_SECONDS):
+        self.path = path or cache_db.cache_path("responses.sqlite3")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.conn = cache_db.connect(self.path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    def get(self, key):
+        """
+        キャッシュされた応答を返す（なければNone）
+        ヒット/ミスの回数を記録する
+        """
+        now = time.time()
+        row = self.conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+
+        if row is not None and now - row[1] > self.ttl:
+            with self.conn:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            row = None
+
+        if row is None:
+            cache_db.increment(self.conn, "response_cache.misses")
+            logging.debug("応答キャッシュ: ミス %s", key[:12])
+            return None
+
+        with self.conn:
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        cache_db.increment(self.conn, "response_cache.hits")
+        logging.debug("応答キャッシュ: ヒット %s", key[:12])
+        return row[0]
+
+    def put(self, key, response):
+        """応答を保存し、期限切れと上限を超えた古いエントリを削除する"""
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            self.conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            self.conn.execute(
+                "DELETE FROM responses WHERE key NOT IN "
+                "(SELECT key FROM responses ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self):
+        """ヒット数、ミス数、保存件数を返す"""
+        counters = cache_db.read_counters(self.conn)
+        entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {
+            'hits': counters.get("response_cache.hits", 0),
+            'misses': counters.get("response_cache.misses", 0),
+            'entries': entries,
+        }
+
+    def clear(self):
+        """保存されている応答をすべて削除する"""
+        with self.conn:
+            self.conn.execute("DELETE FROM responses")
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+ストリーミング応答の逐次パーサー
+
+モデルの応答は「# 」で始まるコメント行とコマンド行の組み合わせになる。
+差分を受け取るたびに、行が確定したところでコメントとコマンドの組（Pair）を返し、
+コードフェンス（```）の行と、行全体を囲むインラインコード（`コマンド`）の
+バッククォートは応答全体を待たずに取り除く。
+コマンドの中のバッククォート（`pwd`のようなコマンド置換やPowerShellの行継続）は残すため、
+行の途中の文字は、バッククォートで始まる行だけを行が確定するまで保留してすぐに返す。
+"""
+
+import re
+from collections import namedtuple
+
+# コメント（ない場合はNone）とコマンド（コメントだけの場合はNone）の組
+Pair = namedtuple('Pair', ['comment', 'command'])
+
+_FENCE = re.compile(r'^\s*```')
+
+
+class ResponseParser:
+    def __init__(self, shell=None):
+        # PowerShellでは行末のバッククォートが行継続の記号になる
+        self.powershell = shell == 'powershell'
+        self._continuation = '`' if self.powershell else '\\'
+        # 確定していない行と、そのうち出力済みの文字数
+        self._line = ''
+        self._emitted = 0
+        # コマンドを待っているコメント行と、行末が「\」（PowerShellは「`」）で続いているコマンド行
+        self._comments = []
+        self._command = []
+        self._output = []
+
+    def feed(self, delta):
+        """
+        差分を追加する
+        Returns: (すぐに出力できるテキスト, 確定したPairのリスト)
+        """
+        pairs = []
+        out = []
+        parts = delta.split('\n')
+        for part in parts[:-1]:
+            self._line += part
+            out.append(self._finish_line(pairs, '\n'))
+        self._line += parts[-1]
+        out.append(self._partial())
+        text = ''.join(out)
+        self._output.append(text)
+        return text, pairs
+
+    def close(self):
+        """ストリームの終わりで残りの行と保留中の組を確定する"""
+        pairs = []
+        text = self._finish_line(pairs, '') if self._line else ''
+        if self._command:
+            pairs.append(self._make_pair('\n'.join(self._command)))
+            self._command = []
+        if self._comments:
+            pairs.append(self._make_pair(None))
+        self._output.append(text)
+        return text, pairs
+
+    def text(self):
+        """これまでに出力したテキスト（フェンスとバッククォートを除いた応答）"""
+        return ''.join(self._output)
+
+    def _partial(self):
+        """行の途中で出力できる部分を返す"""
+        stripped = self._line.lstrip()
+        # フェンスや行全体を囲むインラインコードの可能性がある行は、行が確定するまで保留する
+        if not stripped or stripped.startswith('`'):
+            return ''
+        # 改行の直前の\rは行の確定時に取り除く
+        end = len(self._line.rstrip('\r'))
+        text = self._line[self._emitted:end]
+        self._emitted = max(self._emitted, end)
+        return text
+
+    def _finish_line(self, pairs, newline):
+        line, emitted = self._line.rstrip('\r'), self._emitted
+        self._line = ''
+        self._emitted = 0
+
+        if emitted == 0:
+            if _FENCE.match(line):
+                return ''
+            line = self._unwrap(line)
+            text = line + newline
+        else:
+            text = line[emitted:] + newline
+            line = line.rstrip()
+        self._parse_line(line, pairs)
+        return text
+
+    def _unwrap(self, line):
+        """
+        行全体が1組のバッククォートで囲まれていれば取り除く
+        PowerShellでは行末のバッククォートが行継続の記号のため取り除かない
+        """
+        stripped = line.strip()
+        if self.powershell or len(stripped) < 2 or stripped[0] != '`' or stripped[-1] != '`':
+            return line
+        inner = stripped[1:-1]
+        if '`' in inner:
+            return line
+        return inner.strip()
+
+    def _parse_line(self, line, pairs):
+        stripped = line.strip()
+        if not stripped:
+            return
+        if self._command:
+            # 行継続の記号で終わるコマンドの続き
+            self._command.append(line)
+            if not stripped.endswith(self._continuation):
+                pairs.append(self._make_pair('\n'.join(self._command)))
+                self._command = []
+            return
+        if stripped.startswith('#'):
+            self._comments.append(stripped.lstrip('#').strip())
+            return
+        if stripped.endswith(self._continuation):
+            self._command.append(line)
+            return
+        pairs.append(self._make_pair(line))
+
+    def _make_pair(self, command):
+        comment = ' '.join(self._comments) if self._comments else None
+        self._comments = []
+        return Pair(comment, command)
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+API呼び出しの再試行と、最初のトークンが遅い場合のヘッジリクエスト
+
+レート制限（429）、サーバーエラー（5xx）、接続エラーの場合は、
+Retry-After（retry-after-msを含む）があればその時間、なければ
+ジッター付きの指数バックオフ（0〜backoff*2^n秒の一様乱数）だけ待ってから再試行する。
+CODEX_HEDGE_AFTERを設定すると、その秒数以内に最初のトークンが届かない場合に
+同じリクエストをもう1つ送り、先に応答が始まった方を使ってもう一方は閉じる。
+openaiライブラリは読み込まない（例外は属性とクラス名で判定する）。
+"""
+
+import time
+import queue
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+from env_config import env_int, env_float
+
+# 再試行の最大回数
+MAX_RETRIES = env_int('CODEX_MAX_RETRIES', 3)
+# Retry-Afterがない場合の待ち時間の基準（秒、再試行ごとに2倍）
+RETRY_BACKOFF = env_float('CODEX_RETRY_BACKOFF', 0.5)
+# 1回の待ち時間の上限（秒）
+RETRY_MAX_DELAY = env_float('CODEX_RETRY_MAX_DELAY', 20)
+# 最初のトークンがこの秒数以内に届かなければ同じリクエストをもう1つ送る（0は無効）
+HEDGE_AFTER = env_float('CODEX_HEDGE_AFTER', 0)
+
+# 再試行するHTTPステータス（タイムアウト、競合、レート制限、サーバーエラー）
+_RETRY_STATUS = (408, 409, 429)
+# ステータスコードを持たない接続エラー（APITimeoutErrorはAPIConnectionErrorのサブクラス）
+_CONNECTION_ERRORS = ('APIConnectionError',)
+
+
+def retry_after(error):
+    """エラー応答のretry-after-msまたはRetry-Afterヘッダーの秒数（ない場合はNone）"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after-ms')) / 1000
+    except (TypeError, ValueError):
+        pass
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    # HTTP日付の形式
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def is_retryable(error):
+    """再試行すれば成功する可能性のあるエラーか"""
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in _RETRY_STATUS or status >= 500
+    return any(cls.__name__ in _CONNECTION_ERRORS for cls in type(error).__mro__)
+
+
+def delay_for(error, attempt, backoff=None, max_delay=None):
+    """attempt回目（0から）の失敗のあとに待つ秒数"""
+    backoff = RETRY_BACKOFF if backoff is None else backoff
+    max_delay = RETRY_MAX_DELAY if max_delay is None else max_delay
+    delay = retry_after(error)
+    if delay is None:
+        # 同時に失敗した複数のシェルが同じ時刻に再試行しないようにばらつかせる
+        delay = random.uniform(0, backoff * (2 ** attempt))
+    return min(delay, max_delay)
+
+
+def call(function, max_retries=None, backoff=None, sleep=time.sleep, deadline=None, on_retry=None):
+    """
+    functionを呼び出し、再試行できるエラーの場合は待ってから呼び直す（Noneの引数はモジュールの設定）
+    deadline（time.monotonic()の時刻）までに再試行できない場合は待たずにエラーを送出する
+    on_retry(エラー, 待つ秒数)は待つ前に呼ぶ
+    """
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    backoff = RETRY_BACKOFF if backoff is None else backoff
+    for attempt in range(max_retries + 1):
+        try:
+            return function()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = delay_for(e, attempt, backoff)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                logging.warning("締め切りまでに再試行できないため中止します: %s", e)
+                raise
+            logging.warning("API呼び出しに失敗したため%.1f秒後に再試行します（%s回目）: %s", delay, attempt + 1, e)
+            if on_retry is not None:
+                on_retry(e, delay)
+            sleep(delay)
+
+
+async def call_async(function, max_retries=None, backoff=None, deadline=None, on_retry=None):
+    """callのasyncio版（function()はコルーチンを返す。待つ間も他のタスクを実行できる）"""
+    import asyncio
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    backoff = RETRY_BACKOFF if backoff is None else backoff
+    for attempt in range(max_retries + 1):
+        try:
+            return await function()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = delay_for(e, attempt, backoff)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                logging.warning("締め切りまでに再試行できないため中止します: %s", e)
+                raise
+            logging.warning("API呼び出しに失敗したため%.1f秒後に再試行します（%s回目）: %s", delay, attempt + 1, e)
+            if on_retry is not None:
+                on_retry(e, delay)
+            await asyncio.sleep(delay)
+
+
+def open_stream(create, max_retries=None, backoff=None, hedge_after=None, sleep=time.sleep, deadline=None,
+                on_retry=None):
+    """
+    create()でストリーミング応答を開く（失敗した場合は再試行する）
+    hedge_afterを指定すると、最初のトークンが届くまで待ち、届かなければヘッジリクエストを送る
+    Returns: チャンクを返すイテレーター（closeで接続を閉じる）
+    """
+    hedge_after = HEDGE_AFTER if hedge_after is None else hedge_after
+    if hedge_after and hedge_after > 0:
+        return call(lambda: _hedged(create, hedge_after), max_retries, backoff, sleep, deadline, on_retry)
+    return call(create, max_retries, backoff, sleep, deadline, on_retry)
+
+
+async def open_stream_async(create, max_retries=None, backoff=None, hedge_after=None, deadline=None,
+                            on_retry=None):
+    """open_streamのasyncio版（create()はAsyncStreamを返すコルーチン）"""
+    hedge_after = HEDGE_AFTER if hedge_after is None else hedge_after
+    if hedge_after and hedge_after > 0:
+        return await call_async(lambda: _hedged_async(create, hedge_after), max_retries, backoff, deadline, on_retry)
+    return await call_async(create, max_retries, backoff, deadline, on_retry)
+
+
+def _has_content(chunk):
+    choices = getattr(chunk, 'choices', None)
+    return bool(choices) and bool(getattr(choices[0].delta, 'content', None))
+
+
+class HedgedStream:
+    """最初のトークンまで読み込んだストリームの続きを返す"""
+
+    def __init__(self, stream, chunks, buffered, attempt):
+        self.stream = stream
+        self.attempt = attempt
+        self._chunks = chunks
+        self._buffered = buffered
+
+    def __iter__(self):
+        yield from self._buffered
+        self._buffered = []
+        yield from self._chunks
+
+    def close(self):
+        close = getattr(self.stream, 'close', None)
+        if close is not None:
+            close()
+
+
+def _hedged(create, hedge_after):
+    """
+    リクエストを送り、hedge_after秒以内に最初のトークンが届かなければもう1つ送る
+    先に最初のトークンが届いた方を返し、もう一方は閉じる
+    """
+    results = queue.Queue()
+    lock = threading.Lock()
+    opened = {}
+    state = {'winner': None}
+
+    def finish(number, stream, result):
+        # 勝者が決まった後に届いた結果は使わずに閉じる（判定と追加は勝者の決定と排他的に行う）
+        with lock:
+            if state['winner'] is None:
+                results.put(result)
+                return
+        if stream is not None:
+            _close(stream)
+
+    def attempt(number):
+        stream = None
+        try:
+            stream = create()
+            with lock:
+                opened[number] = stream
+            chunks = iter(stream)
+            buffered = []
+            for chunk in chunks:
+                buffered.append(chunk)
+                if _has_content(chunk):
+                    break
+            finish(number, stream, (number, stream, chunks, buffered, None))
+        except Exception as e:
+            finish(number, stream, (number, None, None, None, e))
+
+    def start(number):
+        threading.Thread(target=attempt, args=(number,), name="request-{}".format(number), daemon=True).start()
+
+    start(0)
+    started = 1
+    pending = 1
+    error = None
+    while pending:
+        try:
+            number, stream, chunks, buffered, e = results.get(timeout=hedge_after if started == 1 else None)
+        except queue.Empty:
+            logging.info("最初のトークンが%.1f秒以内に届かないため、ヘッジリクエストを送ります", hedge_after)
+            start(1)
+            started += 1
+            pending += 1
+            continue
+        pending -= 1
+        if e is not None:
+            error = e
+            continue
+        with lock:
+            state['winner'] = number
+            losers = [s for n, s in opened.items() if n != number]
+            # 同時に届いていた結果も使わない
+            while not results.empty():
+                losers.append(results.get_nowait()[1])
+        # 遅い方は閉じる（最初のトークンを待っている場合は読み込みが中断される）
+        for loser in losers:
+            if loser is not None and loser is not stream:
+                _close(loser)
+        if started > 1:
+            logging.info("ヘッジ: %s番目のリクエストの応答を使います", number + 1)
+        return HedgedStream(stream, chunks, buffered, number)
+    raise error
+
+
+def _close(stream):
+    close = getattr(stream, 'close', None)
+    if close is not None:
+        try:
+            close()
+        except Exception as e:
+            logging.debug("ストリームを閉じる際のエラー: %s", e)
+
+
+class AsyncHedgedStream:
+    """HedgedStreamのasyncio版"""
+
+    def __init__(self, stream, chunks, buffered, attempt):
+        self.stream = stream
+        self.attempt = attempt
+        self._chunks = chunks
+        self._buffered = buffered
+
+    async def __aiter__(self):
+        for chunk in self._buffered:
+            yield chunk
+        self._buffered = []
+        async for chunk in self._chunks:
+            yield chunk
+
+    async def close(self):
+        await _aclose(self.stream)
+
+
+async def _hedged_async(create, hedge_after):
+    """
+    _hedgedのasyncio版
+    2つのリクエストをタスクとして競わせ、先に最初のトークンが届いた方を返してもう一方は取り消す
+    """
+    import asyncio
+
+    async def attempt(number):
+        stream = await create()
+        try:
+            chunks = stream.__aiter__()
+            buffered = []
+            async for chunk in chunks:
+                buffered.append(chunk)
+                if _has_content(chunk):
+                    break
+        except BaseException:
+            # 取り消された（負けた）場合も接続を切る
+            await _aclose(stream)
+            raise
+        return number, stream, chunks, buffered
+
+    tasks = [asyncio.ensure_future(attempt(0))]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            logging.info("最初のトークンが%.1f秒以内に届かないため、ヘッジリクエストを送ります", hedge_after)
+            tasks.append(asyncio.ensure_future(attempt(1)))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=tasks.index):
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                number, stream, chunks, buffered = task.result()
+                # 遅い方は取り消す（同時に最初のトークンが届いていた場合も使わずに閉じる）
+                await _discard(other for other in tasks if other is not task)
+                if len(tasks) > 1:
+                    logging.info("ヘッジ: %s番目のリクエストの応答を使います", number + 1)
+                return AsyncHedgedStream(stream, chunks, buffered, number)
+        raise error
+    except BaseException:
+        # Ctrl-Cなどで取り消された場合は、どちらのリクエストも接続を切る
+        await _discard(tasks)
+        raise
+
+
+async def _discard(tasks):
+    """使わないリクエストのタスクを取り消し、開いたストリームを閉じる"""
+    import asyncio
+    for task in list(tasks):
+        if not task.done():
+            task.cancel()
+            # 取り消したタスクが接続を切り終えるまで待つ
+            await asyncio.wait({task})
+        elif not task.cancelled() and task.exception() is None:
+            await _aclose(task.result()[1])
+
+
+async def _aclose(stream):
+    close = getattr(stream, 'close', None)
+    if close is not None:
+        try:
+            await close()
+        except Exception as e:
+            logging.debug("ストリームを閉じる際のエラー: %s", e)
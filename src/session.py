@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+端末ごとのセッションID
+
+会話履歴と設定は端末（セッション）ごとに分けて保存する。
+セッションは環境変数CODEX_SESSION、なければ端末（TTY）の名前で決まり、
+どちらもなければ既定のセッションを使う。
+"""
+
+import os
+import re
+
+DEFAULT_SESSION = "default"
+
+
+def _tty_name():
+    """標準入出力のいずれかが端末ならその名前を返す"""
+    # プラグインは標準入力と標準出力をパイプにするため、標準エラーも確認する
+    for fd in (0, 2, 1):
+        try:
+            return os.ttyname(fd)
+        except (OSError, AttributeError):
+            continue
+    return None
+
+
+def sanitize(name):
+    """ファイル名に使える文字だけにする（/dev/pts/3 → pts-3）"""
+    if name.startswith('/dev/'):
+        name = name[len('/dev/'):]
+    return re.sub(r'[^A-Za-z0-9_.-]+', '-', name).strip('-.') or DEFAULT_SESSION
+
+
+def session_id():
+    """現在の端末のセッションIDを返す"""
+    name = os.environ.get('CODEX_SESSION') or _tty_name()
+    return sanitize(name) if name else DEFAULT_SESSION
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+親プロセス（シェル）ごとのシェル検出結果のキャッシュ
+
+シェルの種類は同じ端末の中では変わらないため、検出したシェルと
+コンテキストファイルのパスを親プロセスのPID（とセッションID）ごとの
+小さなファイルに保存し、次回からは親プロセスを調べずに使う。
+PIDは再利用されることがあるため、SHELL_CACHE_TTL秒を過ぎたものは使わずに削除する。
+"""
+
+import os
+import time
+import logging
+
+import cache_db
+from env_config import env_float
+
+SHELL_CACHE_TTL = env_float('CODEX_SHELL_CACHE_TTL', 24 * 60 * 60)
+
+
+def cache_file(ppid=None):
+    """親プロセスごとのキャッシュファイルのパス"""
+    ppid = os.getppid() if ppid is None else ppid
+    name = str(ppid)
+    if hasattr(os, 'getsid'):
+        try:
+            name += "-{}".format(os.getsid(0))
+        except OSError:
+            pass
+    return os.path.join(cache_db.cache_dir(), "shells", name)
+
+
+def lookup(path=None, ttl=SHELL_CACHE_TTL):
+    """保存されている(シェル, コンテキストファイルのパス)を返す（ない場合はNone）"""
+    path = path or cache_file()
+    try:
+        if time.time() - os.stat(path).st_mtime > ttl:
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            shell, _, context = f.read().rstrip('\n').partition('\t')
+    except (OSError, UnicodeDecodeError):
+        return None
+    return (shell, context or None) if shell else None
+
+
+def store(shell, context, path=None, ttl=SHELL_CACHE_TTL):
+    """検出結果を保存し、期限切れのキャッシュファイルを削除する"""
+    path = path or cache_file()
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # 書き込み途中のファイルを読まないよう、一時ファイルから置き換える
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write("{}\t{}\n".format(shell, context or ''))
+        os.replace(temp_path, path)
+        # 検出し直すのは新しいシェルの最初の1回だけなので、ここで古いファイルを片付ける
+        now = time.time()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if now - entry.stat().st_mtime > ttl:
+                    os.unlink(entry.path)
+    except OSError as e:
+        logging.warning("シェル検出結果を保存できません: %s", e)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+文字コードを判定してテキストファイルを読み込む共通処理
+
+ファイルはバイト列として1回だけ読み込み、BOMがあればその文字コード、
+なければUTF-8、cp932、cp1252の順にメモリ上でデコードを試す。
+判定結果はパスごとに（更新時刻, サイズ）と一緒に保存し、ファイルが
+変わっていなければ2回目以降はディスクから読み込まない
+（大きなファイルは文字コードだけを保存し、次回はその文字コードから試す）。
+"""
+
+import os
+import codecs
+import logging
+
+# BOMがない場合に試す文字コード
+ENCODINGS = ('utf-8', 'cp932', 'cp1252')
+# UTF-32のBOMはUTF-16のBOMで始まるため先に調べる
+_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+# 内容もメモリに保存するファイルの最大サイズ
+MAX_CACHED_BYTES = 256 * 1024
+
+# 絶対パス -> ((更新時刻, サイズ), 文字コード, 内容またはNone)
+_cache = {}
+
+
+def decode(data, encodings=ENCODINGS):
+    """
+    バイト列をデコードする
+    Returns: (テキスト, 使用した文字コード)
+    """
+    for bom, encoding in _BOMS:
+        if data.startswith(bom):
+            return data.decode(encoding), encoding
+    for encoding in encodings:
+        try:
+            return data.decode(encoding), encoding
+        except UnicodeDecodeError:
+            continue
+    # どれにも当てはまらない場合は、読めない文字を置き換える
+    logging.warning("文字コードを判定できないため、読めない文字を置き換えます")
+    return data.decode(encodings[0], errors='replace'), encodings[0]
+
+
+def read_text(path, encodings=ENCODINGS):
+    """
+    ファイルを読み込む（変更されていなければ保存済みの内容を返す）
+    Returns: (テキスト, 使用した文字コード)
+    """
+    key = os.path.abspath(path)
+    stat = os.stat(key)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _cache.get(key)
+    if cached is not None and cached[0] == stamp and cached[2] is not None:
+        return cached[2], cached[1]
+
+    with open(key, 'rb') as f:
+        data = f.read()
+    if cached is not None and cached[1] in encodings:
+        # 前回判定した文字コードから試す（BOMによる判定はBOMを見て毎回行う）
+        encodings = (cached[1],) + tuple(e for e in encodings if e != cached[1])
+    text, encoding = decode(data, encodings)
+    _cache[key] = (stamp, encoding, text if len(data) <= MAX_CACHED_BYTES else None)
+    return text, encoding
+
+
+def forget(path=None):
+    """保存済みの判定結果を削除する（pathを省略するとすべて）"""
+    if path is None:
+        _cache.clear()
+    else:
+        _cache.pop(os.path.abspath(path), None)
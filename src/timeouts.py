@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+クエリ全体の締め切りと、接続・最初のトークン・差分の間隔のタイムアウト
+
+各タイムアウト（秒、0は無効）は環境変数、設定ファイル（~/.openai/codex-cli.json の
+"timeouts"）、既定値の順に決まる。ストリームは別スレッドで読み込み、
+各段階の制限時間を超えたらストリームを閉じてQueryTimeoutを送出する
+（それまでに出力した部分はそのまま残る）。タイムアウトで終わったクエリの
+終了コードはEXIT_CODE（timeoutコマンドと同じ124）で、シェルプラグインはこれで判定できる。
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+
+# タイムアウトで終わった場合の終了コード
+EXIT_CODE = 124
+
+# 段階ごとの既定値（秒）と環境変数
+DEFAULTS = {
+    'query': 60.0,
+    'connect': 10.0,
+    'first_token': 30.0,
+    'idle': 15.0,
+}
+ENV_VARS = {
+    'query': 'CODEX_TIMEOUT',
+    'connect': 'CODEX_CONNECT_TIMEOUT',
+    'first_token': 'CODEX_FIRST_TOKEN_TIMEOUT',
+    'idle': 'CODEX_IDLE_TIMEOUT',
+}
+# HTTPの読み込みタイムアウトに加える余裕（段階ごとの判定はwatch()が先に行う）
+READ_GRACE = 1.0
+# タイムアウトを表示する際の段階の名前
+PHASE_NAMES = {
+    'query': 'クエリ全体',
+    'connect': '接続',
+    'first_token': '最初のトークン',
+    'idle': '応答の途切れ',
+    'moderation': 'モデレーション',
+    'rate_limit': '送信待ち',
+}
+
+
+def _read(name, value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        logging.warning("タイムアウトの値が不正なため無視します: %s=%r", name, value)
+        return None
+
+
+def _from_env():
+    timeouts = dict(DEFAULTS)
+    for phase, name in ENV_VARS.items():
+        if os.environ.get(name, '') != '':
+            value = _read(name, os.environ[name])
+            if value is not None:
+                timeouts[phase] = value
+    return timeouts
+
+
+# 現在の設定（段階 -> 秒、0は無効）
+TIMEOUTS = _from_env()
+
+
+def configure(values):
+    """設定ファイルの値を反映する（環境変数で指定された段階は変えない）"""
+    for phase, value in (values or {}).items():
+        if phase not in DEFAULTS:
+            logging.warning("不明なタイムアウトの設定を無視します: %s", phase)
+            continue
+        if os.environ.get(ENV_VARS[phase], '') != '':
+            continue
+        value = _read(phase, value)
+        if value is not None:
+            TIMEOUTS[phase] = value
+
+
+def limit(phase):
+    """段階のタイムアウト（秒、無効ならNone）"""
+    return TIMEOUTS.get(phase) or None
+
+
+class QueryTimeout(Exception):
+    """段階の制限時間を超えた"""
+
+    def __init__(self, phase, seconds):
+        super().__init__("{}のタイムアウト（{:g}秒）".format(PHASE_NAMES.get(phase, phase), seconds))
+        self.phase = phase
+        self.seconds = seconds
+
+
+class Deadline:
+    """クエリ全体の締め切り"""
+
+    def __init__(self, seconds=None):
+        self.seconds = limit('query') if seconds is None else (seconds or None)
+        # time.monotonic()の締め切り（無効ならNone）
+        self.expires = time.monotonic() + self.seconds if self.seconds else None
+
+    def remaining(self):
+        """残りの秒数（締め切りがなければNone）"""
+        if self.expires is None:
+            return None
+        return self.expires - time.monotonic()
+
+    def check(self):
+        """締め切りを過ぎていればQueryTimeoutを送出する"""
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise QueryTimeout('query', self.seconds)
+
+    def bound(self, seconds):
+        """secondsを残りの時間までに縮める（どちらもなければNone）"""
+        remaining = self.remaining()
+        if remaining is None:
+            return seconds
+        remaining = max(0.0, remaining)
+        return remaining if seconds is None else min(seconds, remaining)
+
+
+def request_timeouts(deadline=None):
+    """
+    HTTPリクエストに設定するタイムアウト
+    Returns: (読み込み, 接続)の秒数（無効ならNone）
+    読み込みは応答ヘッダーや差分を待つ時間で、最初のトークンと差分の間隔の長い方に余裕を加える
+    （段階ごとの判定はwatch()で行い、こちらは読み込みスレッドが残り続けないための上限）
+    """
+    reads = [value for value in (limit('first_token'), limit('idle')) if value]
+    read = max(reads) if reads else None
+    connect = limit('connect')
+    if deadline is not None:
+        read, connect = deadline.bound(read), deadline.bound(connect)
+    if read is not None:
+        read += READ_GRACE
+    return read, connect
+
+
+def watch(contents, deadline=None, started=None):
+    """
+    ストリームの差分を別スレッドで読み込み、制限時間を超えたらQueryTimeoutを送出するイテレーター
+    最初の空でない差分はstarted（time.monotonic()、省略時は今）から最初のトークンの制限時間まで、
+    以降は差分の間隔の制限時間まで待つ。どちらもクエリ全体の締め切りを超えない
+    contentsはリクエストの送信を含むジェネレーターでもよい（読み込みスレッドで実行される）。
+    このイテレーターを閉じるかタイムアウトした後は、読み込みスレッドは次の差分でcontentsを閉じる
+    """
+    first_token = limit('first_token')
+    idle = limit('idle')
+    if not first_token and not idle and (deadline is None or deadline.expires is None):
+        return iter(contents)
+    return _watch(contents, deadline or Deadline(0), started or time.monotonic(), first_token, idle)
+
+
+_END = object()
+
+
+def _watch(contents, deadline, started, first_token, idle):
+    results = queue.Queue()
+    cancelled = threading.Event()
+
+    def read():
+        try:
+            for content in contents:
+                if cancelled.is_set():
+                    break
+                results.put((content, None))
+        except Exception as e:
+            results.put((None, e))
+            return
+        finally:
+            close = getattr(contents, 'close', None)
+            if close is not None:
+                close()
+        results.put((_END, None))
+
+    threading.Thread(target=read, name="stream-reader", daemon=True).start()
+    try:
+        yield from _receive(results, deadline, started, first_token, idle)
+    finally:
+        cancelled.set()
+
+
+def next_wait(waiting, started, deadline, first_token=None, idle=None):
+    """
+    次の差分を待てる時間
+    waitingは最初の空でない差分を待っているか、startedは最初のトークンの制限時間の起点（time.monotonic()）
+    Returns: (段階, その制限時間, 待てる秒数)（制限がなければすべてNone、秒数は0以上）
+    """
+    if waiting and first_token:
+        phase, seconds = 'first_token', first_token
+        wait = started + first_token - time.monotonic()
+    elif not waiting and idle:
+        phase, seconds = 'idle', idle
+        wait = idle
+    else:
+        phase, seconds, wait = None, None, None
+    remaining = deadline.remaining()
+    if remaining is not None and (wait is None or remaining < wait):
+        phase, seconds, wait = 'query', deadline.seconds, remaining
+    return phase, seconds, max(0.0, wait) if wait is not None else None
+
+
+def _receive(results, deadline, started, first_token, idle):
+    waiting = True
+    while True:
+        phase, seconds, wait = next_wait(waiting, started, deadline, first_token, idle)
+        try:
+            content, error = results.get(timeout=wait)
+        except queue.Empty:
+            raise QueryTimeout(phase, seconds) from None
+        if error is not None:
+            raise error
+        if content is _END:
+            return
+        if content:
+            waiting = False
+        yield content
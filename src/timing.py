@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+クエリごとの処理時間の計測
+
+環境変数CODEX_TIMINGを設定すると、シェル検出、設定の読み込み、コンテキストの読み込み、
+モデレーション、APIリクエスト、最初のトークン、ストリーミングなどの各処理の時間を
+1クエリにつき1行のJSONとして記録する。
+    CODEX_TIMING=1（またはfile）  キャッシュフォルダのtimings.jsonlに追記する
+    CODEX_TIMING=stderr           標準エラー出力に書き出す
+無効な場合、span()は何もしない共通のオブジェクトを返すだけで計測は行わない。
+"# show stats"はtimings.jsonlの最近の記録から処理ごとのp50/p95を表示する。
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import logging
+from collections import deque
+
+import cache_db
+from env_config import env_int
+
+TIMING_MODE = os.environ.get('CODEX_TIMING', '').lower()
+# "# show stats"で集計する記録の数
+STATS_RECORDS = env_int('CODEX_TIMING_RECORDS', 200)
+# timings.jsonlがこのサイズを超えたら最近のSTATS_RECORDS件だけを残す
+MAX_FILE_BYTES = 1024 * 1024
+
+# 計測中のクエリの記録（無効な場合や計測していない間はNone）
+_record = None
+_start = 0.0
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _add(self.record, self.name, time.perf_counter() - self.start)
+        return False
+
+
+def enabled():
+    return TIMING_MODE not in ('', '0', 'off')
+
+
+def timings_path():
+    return cache_db.cache_path("timings.jsonl")
+
+
+def _add(record, name, seconds):
+    phases = record["phases"]
+    phases[name] = round(phases.get(name, 0.0) + seconds * 1000, 3)
+
+
+def begin(kind="command"):
+    """クエリの計測を始める（無効な場合は何もしない）"""
+    global _record, _start
+    if not enabled():
+        return
+    _start = time.perf_counter()
+    _record = {"ts": round(time.time(), 3), "kind": kind, "phases": {}}
+
+
+def span(name):
+    """with文で囲んだ処理の時間をnameとして記録する（同じ名前は合計する）"""
+    if _record is None:
+        return _NULL_SPAN
+    return _Span(_record, name)
+
+
+def add(name, seconds):
+    """計測済みの時間を記録する"""
+    if _record is not None:
+        _add(_record, name, seconds)
+
+
+def mark(name):
+    """計測開始からの経過時間を記録する（最初の1回だけ）"""
+    if _record is not None:
+        marks = _record.setdefault("marks", {})
+        if name not in marks:
+            marks[name] = round((time.perf_counter() - _start) * 1000, 3)
+
+
+def annotate(**fields):
+    """記録に項目を追加する（kind、cachedなど）"""
+    if _record is not None:
+        _record.update(fields)
+
+
+def timed_stream(contents, first="first_token", rest="stream"):
+    """
+    ストリームの最初の差分までの時間をfirst、それ以降をrestとして記録する
+    無効な場合はcontentsをそのまま返す
+    """
+    if _record is None:
+        return contents
+    return _timed_stream(contents, first, rest)
+
+
+def _timed_stream(contents, first, rest):
+    start = time.perf_counter()
+    first_at = None
+    try:
+        for content in contents:
+            if first_at is None and content:
+                first_at = time.perf_counter()
+                add(first, first_at - start)
+                mark("ttft")
+            yield content
+    finally:
+        if first_at is not None:
+            add(rest, time.perf_counter() - first_at)
+
+
+def timed_astream(contents, first="first_token", rest="stream"):
+    """timed_streamの非同期イテレーター版"""
+    if _record is None:
+        return contents
+    return _timed_astream(contents, first, rest)
+
+
+async def _timed_astream(contents, first, rest):
+    start = time.perf_counter()
+    first_at = None
+    try:
+        async for content in contents:
+            if first_at is None and content:
+                first_at = time.perf_counter()
+                add(first, first_at - start)
+                mark("ttft")
+            yield content
+    finally:
+        if first_at is not None:
+            add(rest, time.perf_counter() - first_at)
+
+
+def end(status="ok"):
+    """計測を終えて記録を書き出す"""
+    global _record
+    record = _record
+    if record is None:
+        return
+    _record = None
+    record["total_ms"] = round((time.perf_counter() - _start) * 1000, 3)
+    record["status"] = status
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    try:
+        if TIMING_MODE == "stderr":
+            sys.stderr.write(line)
+            sys.stderr.flush()
+        else:
+            _append(timings_path(), line)
+    except OSError as e:
+        logging.warning("処理時間の記録を書き込めません: %s", e)
+
+
+def _append(path, line):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # 1回のwriteで追記するため、複数のプロセスから同時に書いても行は混ざらない
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(line)
+        size = f.tell()
+    if size > MAX_FILE_BYTES:
+        records = read_records(STATS_RECORDS, path)
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        os.replace(temp_path, path)
+
+
+def read_records(limit=STATS_RECORDS, path=None):
+    """最近の記録を最大limit件読み込む"""
+    path = path or timings_path()
+    if not os.path.exists(path):
+        return []
+    records = deque(maxlen=limit)
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # 書き込み途中の行
+                continue
+    return list(records)
+
+
+def _percentile(values, percent):
+    # nearest-rank法
+    values = sorted(values)
+    index = max(0, math.ceil(percent / 100.0 * len(values)) - 1)
+    return values[index]
+
+
+def summarize(records):
+    """
+    処理ごとの(件数, p50, p95)をミリ秒で返す
+    全体の時間は種類ごとに"total (query)"のような名前になる
+    """
+    samples = {}
+    for record in records:
+        for name, ms in record.get("phases", {}).items():
+            samples.setdefault(name, []).append(ms)
+        for name, ms in record.get("marks", {}).items():
+            samples.setdefault(name, []).append(ms)
+        if "total_ms" in record:
+            samples.setdefault("total ({})".format(record.get("kind", "command")), []).append(record["total_ms"])
+    return {name: (len(values), _percentile(values, 50), _percentile(values, 95)) for name, values in samples.items()}
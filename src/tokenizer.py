@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+プロンプトのトークン数を数える
+
+tiktokenがインストールされ、語彙ファイルがローカルにあればモデルのBPE語彙で正確に数え、
+なければGPTのトークン分割を近似した推定値を使う。推定では空白で区切られない日本語も1文字ずつ数える。
+行単位で結果をキャッシュするため、履歴全体を数え直しても再計算は新しい行だけで済む。
+
+語彙ファイル（数MB）はリポジトリに含めず、cache/tiktoken（環境変数TIKTOKEN_CACHE_DIRで変更可能）に置く。
+トークン数を数えるときにはネットワークから取得せず、事前に次のコマンドで一度だけ取得する:
+    python src/tokenizer.py --download
+語彙ファイルはtiktokenのキャッシュを経由せずに直接読み込むため、
+プロセス全体の環境変数TIKTOKEN_CACHE_DIRは変更しない。
+"""
+
+import os
+import re
+import sys
+import base64
+import hashlib
+import logging
+from functools import lru_cache
+
+import cache_db
+
+# tiktokenのエンコーディング名（gpt-4o系はo200k_base）
+ENCODING_NAME = os.environ.get('CODEX_TOKENIZER_ENCODING', 'o200k_base')
+# tiktokenが語彙ファイルを取得するURL（キャッシュのファイル名はこのURLのSHA-1）
+VOCAB_URL = "https://openaipublic.blob.core.windows.net/encodings/{}.tiktoken"
+
+# エンコーディングごとの分割パターンと特殊トークン（tiktoken_ext.openai_publicと同じ）
+_ENCODINGS = {
+    'o200k_base': (
+        "|".join([
+            r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]*[\p{Ll}\p{Lm}\p{Lo}\p{M}]+(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+            r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]+[\p{Ll}\p{Lm}\p{Lo}\p{M}]*(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+            r"""\p{N}{1,3}""",
+            r""" ?[^\s\p{L}\p{N}]+[\r\n/]*""",
+            r"""\s*[\r\n]+""",
+            r"""\s+(?!\S)""",
+            r"""\s+""",
+        ]),
+        {"<|endoftext|>": 199999, "<|endofprompt|>": 200018},
+    ),
+    'cl100k_base': (
+        r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+""",
+        {"<|endoftext|>": 100257, "<|fim_prefix|>": 100258, "<|fim_middle|>": 100259,
+         "<|fim_suffix|>": 100260, "<|endofprompt|>": 100276},
+    ),
+}
+
+# 推定用のトークン分割（CJK文字は1文字ずつ、英字は連続部分、数字は3桁ずつ、記号は1文字ずつ）
+_PIECES = re.compile(
+    r"[\U00003040-\U000030ff\U00003400-\U00004dbf\U00004e00-\U00009fff\U0000ac00-\U0000d7af\U0000ff00-\U0000ffef]"
+    r"|[A-Za-z\U000000c0-\U0000024f]+"
+    r"|\d{1,3}"
+    r"|\s+"
+    r"|."
+)
+
+_encoding = None
+_encoding_loaded = False
+
+
+def vocab_dir():
+    """語彙ファイルを置くフォルダのパスを返す"""
+    return os.environ.get('TIKTOKEN_CACHE_DIR') or cache_db.cache_path("tiktoken")
+
+
+def vocab_path(name=None):
+    """エンコーディングの語彙ファイルのパスを返す（tiktokenのキャッシュと同じファイル名）"""
+    url = VOCAB_URL.format(name or ENCODING_NAME)
+    return os.path.join(vocab_dir(), hashlib.sha1(url.encode()).hexdigest())
+
+
+def _read_ranks(path):
+    """語彙ファイル（1行に「base64のトークン 順位」）を読み込む"""
+    with open(path, 'rb') as f:
+        return {base64.b64decode(token): int(rank) for token, rank in (line.split() for line in f if line.strip())}
+
+
+def _get_encoding():
+    """語彙ファイルからtiktokenのエンコーディングを作成する"""
+    import tiktoken
+    if ENCODING_NAME not in _ENCODINGS:
+        raise ValueError(f"未対応のエンコーディングです: {ENCODING_NAME}")
+    pattern, special_tokens = _ENCODINGS[ENCODING_NAME]
+    return tiktoken.Encoding(ENCODING_NAME, pat_str=pattern, mergeable_ranks=_read_ranks(vocab_path()),
+                             special_tokens=special_tokens)
+
+
+def _load_encoding():
+    """tiktokenのエンコーディングを読み込む（使えなければNone）"""
+    global _encoding
+    global _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        if not os.path.exists(vocab_path()):
+            # 語彙ファイルがなければtiktokenを読み込まない（ネットワークからは取得しない）
+            logging.debug("tiktokenの語彙ファイル（%s）がないため、トークン数は推定値を使用します", vocab_path())
+            return None
+        try:
+            _encoding = _get_encoding()
+        except ImportError:
+            logging.debug("tiktokenが見つからないため、トークン数は推定値を使用します")
+        except Exception as e:
+            logging.warning("tiktokenの語彙を読み込めないため、トークン数は推定値を使用します: %s", e)
+    return _encoding
+
+
+def download():
+    """語彙ファイルをネットワークから取得してvocab_dir()に保存する"""
+    from urllib.request import urlopen
+    os.makedirs(vocab_dir(), exist_ok=True)
+    path = vocab_path()
+    with urlopen(VOCAB_URL.format(ENCODING_NAME), timeout=60) as response:
+        data = response.read()
+    # 途中で失敗しても壊れたファイルを残さない
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    return path
+
+
+def estimate_tokens(text):
+    """tiktokenを使わずにトークン数を推定する"""
+    count = 0
+    for piece in _PIECES.findall(text):
+        if piece.isspace():
+            # 単語の前の空白1つは次のトークンに含まれる
+            count += 0 if piece == ' ' else 1
+        elif piece[0].isalpha() and len(piece) > 1:
+            # 英単語はおよそ6文字ごとに1トークン
+            count += (len(piece) + 5) // 6
+        else:
+            count += 1
+    return count
+
+
+@lru_cache(maxsize=8192)
+def _count_line(line):
+    encoding = _load_encoding()
+    if encoding is not None:
+        return len(encoding.encode(line, disallowed_special=()))
+    return estimate_tokens(line)
+
+
+def count_tokens(text):
+    """テキストのトークン数を返す（行単位でキャッシュ）"""
+    if not text:
+        return 0
+    return sum(_count_line(line) for line in text.splitlines(keepends=True))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["--download"]:
+        print("使い方: python tokenizer.py --download")
+        sys.exit(2)
+    print(download())
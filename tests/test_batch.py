@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+batch.pyの単体テストプログラム
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+import batch
+from context_config import ContextConfig
+
+
+class RateLimited(Exception):
+    """openai.RateLimitErrorと同じ属性を持つ例外"""
+    status_code = 429
+
+    def __init__(self, retry_after):
+        super().__init__("rate limited")
+        self.response = SimpleNamespace(headers={'retry-after': str(retry_after)})
+
+
+class FakeAsyncClient:
+    """AsyncOpenAIの代わりに、ランダムな遅延のあと固定の応答を返すクライアント"""
+
+    def __init__(self, flagged=(), rate_limits=0):
+        self.flagged = set(flagged)
+        self.rate_limits = rate_limits
+        self.active = 0
+        self.max_active = 0
+        self.calls = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.moderations = SimpleNamespace(create=self.moderate)
+
+    async def create(self, model, messages, **kwargs):
+        self.calls.append(time.monotonic())
+        if self.rate_limits:
+            self.rate_limits -= 1
+            raise RateLimited(0.05)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(random.uniform(0, 0.02))
+        finally:
+            self.active -= 1
+        query = messages[-1]["content"].splitlines()[-1]
+        content = "```bash\n{}\necho {}\n```".format(query, len(query))
+        usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+    async def moderate(self, input):
+        return SimpleNamespace(results=[SimpleNamespace(flagged=input in self.flagged)])
+
+
+class SlowAsyncClient(FakeAsyncClient):
+    """応答の生成が終わらず、取り消された回数を数えるクライアント"""
+
+    def __init__(self, flagged=()):
+        super().__init__(flagged)
+        self.cancelled = 0
+
+    async def create(self, model, messages, **kwargs):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+
+class TestReadQueries(unittest.TestCase):
+    """クエリ一覧の読み込みのテストクラス"""
+
+    def test_lines_and_jsonl(self):
+        """1行1クエリとJSONLが混在していても読み込めるテスト"""
+        text = "# list files\n\nshow disk usage\n" + json.dumps({"id": "a1", "query": "現在の時刻"}) + "\n"
+        items = batch.read_queries(text)
+        self.assertEqual([item["query"] for item in items], ["# list files", "# show disk usage", "# 現在の時刻"])
+        self.assertEqual([item["index"] for item in items], [0, 1, 2])
+        self.assertEqual(items[2]["id"], "a1")
+
+    def test_invalid_json(self):
+        """壊れたJSONの行番号がエラーに含まれるテスト"""
+        with self.assertRaisesRegex(ValueError, "2行目"):
+            batch.read_queries("# ok\n{broken\n")
+
+
+class TestBatchRunner(unittest.TestCase):
+    """同時実行と出力順のテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.env = patch.dict(os.environ, {'CODEX_CACHE_DIR': self.temp_dir, 'CODEX_NO_CACHE': ''})
+        self.env.start()
+        self.config = ContextConfig(model='gpt-4o', temperature=0, max_tokens=300, shell='bash',
+                                    multi_turn='off', token_count=0, language='en')
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def run_batch(self, client, items, concurrency=4, use_cache=True):
+        runner = batch.BatchRunner(client, self.config, "#!/bin/bash\n\n", "system", concurrency, use_cache, backoff=0.01)
+        out = io.StringIO()
+        try:
+            results = asyncio.run(runner.run(items, out))
+        finally:
+            runner.close()
+        return runner, results, [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_results_in_input_order(self):
+        """完了順に関係なく入力の順に書き出し、同時実行数を守るテスト"""
+        items = batch.read_queries("\n".join("# query {}".format(i) for i in range(30)))
+        client = FakeAsyncClient(flagged={"# query 7"})
+        _, results, lines = self.run_batch(client, items, concurrency=4, use_cache=False)
+
+        self.assertEqual([line["index"] for line in lines], list(range(30)))
+        self.assertEqual(lines, results)
+        self.assertLessEqual(client.max_active, 4)
+        self.assertEqual(lines[3]["response"], "# query 3\necho 9\n")
+        self.assertEqual(lines[3]["usage"]["total_tokens"], 15)
+        self.assertIn("latency_ms", lines[3])
+        self.assertEqual(lines[7]["status"], "flagged")
+        self.assertIsNone(lines[7]["response"])
+
+    def test_rate_limit_backoff(self):
+        """レート制限を受けたら待ってから再試行するテスト"""
+        items = batch.read_queries("# a\n# b\n")
+        client = FakeAsyncClient(rate_limits=2)
+        runner, _, lines = self.run_batch(client, items, concurrency=2, use_cache=False)
+
+        self.assertEqual([line["status"] for line in lines], ["ok", "ok"])
+        self.assertEqual(runner.rate_limited, 2)
+        # Retry-Afterの間は送信しない
+        self.assertGreaterEqual(client.calls[-1] - client.calls[0], 0.05)
+
+    def test_shared_rate_limit(self):
+        """送信前に他のプロセスと共有する予算を予約し、レート制限を受けたら他のプロセスにも伝えるテスト"""
+        items = batch.read_queries("# a\n# b\n")
+        limiter = MagicMock(enabled=True)
+        limiter.reserve.return_value = 0.01
+        runner = batch.BatchRunner(FakeAsyncClient(rate_limits=1), self.config, "#!/bin/bash\n\n", "system", 2,
+                                   False, backoff=0.01, limiter=limiter)
+        try:
+            asyncio.run(runner.run(items, io.StringIO()))
+        finally:
+            runner.close()
+
+        self.assertEqual(limiter.reserve.call_count, 2)
+        self.assertGreater(limiter.reserve.call_args[0][0], 300)
+        limiter.pause.assert_called_once()
+
+    def test_flagged_query_cancels_generation(self):
+        """モデレーションで不適切と判定されたら生成を取り消すテスト"""
+        client = SlowAsyncClient(flagged={"# bad"})
+        _, _, lines = self.run_batch(client, batch.read_queries("# bad\n"), use_cache=False)
+        self.assertEqual(lines[0]["status"], "flagged")
+        self.assertEqual(client.cancelled, 1)
+
+    def test_query_deadline(self):
+        """クエリ全体の締め切りを過ぎたら取り消してタイムアウトとして記録するテスト"""
+        client = SlowAsyncClient()
+        with patch.dict(batch.timeouts.TIMEOUTS, {'query': 0.05}):
+            _, _, lines = self.run_batch(client, batch.read_queries("# slow\n"), use_cache=False)
+        self.assertEqual(lines[0]["status"], "timeout")
+        self.assertEqual(client.cancelled, 1)
+
+    def test_cached_responses(self):
+        """2回目はキャッシュの応答を使うテスト"""
+        items = batch.read_queries("# a\n")
+        self.run_batch(FakeAsyncClient(), items)
+        client = FakeAsyncClient()
+        _, _, lines = self.run_batch(client, items)
+        self.assertTrue(lines[0]["cached"])
+        self.assertEqual(client.calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
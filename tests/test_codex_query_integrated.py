@@ -10,7 +10,9 @@ import unittest
 import tempfile
 import json
 import time
-from unittest.mock import patch, MagicMock, mock_open
+import shutil
+import signal
+from unittest.mock import patch, MagicMock, AsyncMock, mock_open
 from pathlib import Path
 from io import StringIO
 
@@ -39,6 +41,12 @@ class TestCodexQueryIntegrated(unittest.TestCase):
         os.environ['OPENAI_API_KEY'] = TEST_API_KEY
         os.environ['OPENAI_ORGANIZATION_ID'] = TEST_ORG_ID
         os.environ['OPENAI_MODEL'] = TEST_MODEL
+        # 応答キャッシュを使わない（テスト間で結果が再生されないように）
+        cls.old_no_cache = os.environ.get('CODEX_NO_CACHE')
+        os.environ['CODEX_NO_CACHE'] = '1'
+        cls.old_cache_dir = os.environ.get('CODEX_CACHE_DIR')
+        cls.temp_cache_dir = tempfile.mkdtemp()
+        os.environ['CODEX_CACHE_DIR'] = cls.temp_cache_dir
         
         # テスト用の設定ファイル
         cls.temp_config_dir = tempfile.mkdtemp()
@@ -80,6 +88,17 @@ class TestCodexQueryIntegrated(unittest.TestCase):
         else:
             os.environ.pop('OPENAI_MODEL', None)
         
+        if cls.old_no_cache is not None:
+            os.environ['CODEX_NO_CACHE'] = cls.old_no_cache
+        else:
+            os.environ.pop('CODEX_NO_CACHE', None)
+
+        if cls.old_cache_dir is not None:
+            os.environ['CODEX_CACHE_DIR'] = cls.old_cache_dir
+        else:
+            os.environ.pop('CODEX_CACHE_DIR', None)
+        shutil.rmtree(cls.temp_cache_dir, ignore_errors=True)
+        
         # 一時ファイルを削除（安全にファイルの存在を確認してから）
         try:
             if os.path.exists(cls.temp_config_path):
@@ -207,7 +226,9 @@ class TestCodexQueryIntegrated(unittest.TestCase):
         # OpenAI初期化の検証
         mock_openai.OpenAI.assert_called_once_with(
             api_key=TEST_API_KEY,
-            organization=TEST_ORG_ID
+            organization=TEST_ORG_ID,
+            max_retries=0,
+            timeout=mock_openai.Timeout.return_value
         )
     
     @patch('codex_query_integrated.openai')
@@ -332,14 +353,148 @@ class TestCodexQueryIntegrated(unittest.TestCase):
             # 標準出力を元に戻す
             sys.stdout = sys.__stdout__
 
+    def _make_stream(self, contents):
+        """ストリーミング応答のモックを作成"""
+        chunks = []
+        for content in contents:
+            chunk = MagicMock()
+            chunk.choices = [MagicMock(delta=MagicMock(content=content))]
+            chunks.append(chunk)
+        stream = MagicMock()
+        stream.__iter__.return_value = iter(chunks)
+        return stream
+
+    def test_moderation_runs_concurrently(self):
+        """モデレーションと応答生成が並行して実行されるテスト"""
+        import threading
+        stream_opened = threading.Event()
+        mock_client = MagicMock()
+
+        def open_stream(**kwargs):
+            stream_opened.set()
+            return self._make_stream(["ls", " -la"])
+
+        def moderate(input):
+            # 直列に実行される場合はストリームが開かれず、ここでタイムアウトする
+            self.assertTrue(stream_opened.wait(2))
+            return MagicMock(results=[MagicMock(flagged=False)])
+
+        mock_client.chat.completions.create.side_effect = open_stream
+        mock_client.moderations.create.side_effect = moderate
+
+        captured_output = StringIO()
+        with patch('sys.stdout', captured_output):
+            moderation = self.codex.start_moderation("list files", mock_client)
+            result = self.codex.generate_response("test prompt", "gpt-4o", mock_client, "en", "bash",
+                                                  moderation=moderation)
+
+        self.assertEqual(result, "ls -la")
+        self.assertFalse(moderation.result())
+        self.assertIn("ls -la", captured_output.getvalue())
+
+    def test_moderation_flagged_cancels_stream(self):
+        """不適切と判定された場合に応答を出力せずストリームを閉じるテスト"""
+        from concurrent.futures import Future
+        mock_client = MagicMock()
+        stream = self._make_stream(["rm", " -rf", " /"])
+        mock_client.chat.completions.create.return_value = stream
+        moderation = Future()
+        moderation.set_result(True)
+
+        captured_output = StringIO()
+        with patch('sys.stdout', captured_output):
+            result = self.codex.generate_response("test prompt", "gpt-4o", mock_client, "en", "bash",
+                                                  moderation=moderation)
+
+        self.assertIsNone(result)
+        stream.close.assert_called_once()
+        output = captured_output.getvalue()
+        self.assertNotIn("rm", output)
+        self.assertIn("不適切なコンテンツ", output)
+
+    def test_generate_response_limits(self):
+        """max_tokensと停止シーケンスがAPIに渡されるテスト"""
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value = self._make_stream(["ls"])
+        with patch('sys.stdout', StringIO()), patch('codex_query_integrated.STOP_SEQUENCES', []):
+            self.codex.generate_response("test prompt", "gpt-4o", mock_client, "en", "bash", max_tokens=300)
+            kwargs = mock_client.chat.completions.create.call_args[1]
+            self.assertEqual(kwargs['max_tokens'], 300)
+            self.assertNotIn('stop', kwargs)
+
+            self.codex.generate_response("test prompt", "gpt-4o", mock_client, "en", "bash",
+                                         max_tokens=50, stop=["\n\n\n"])
+            kwargs = mock_client.chat.completions.create.call_args[1]
+            self.assertEqual((kwargs['max_tokens'], kwargs['stop']), (50, ["\n\n\n"]))
+
+    def test_parse_stop_sequences(self):
+        """CODEX_STOPの値の解析テスト"""
+        self.assertEqual(self.codex.parse_stop_sequences(""), [])
+        self.assertEqual(self.codex.parse_stop_sequences("\\n\\n\\n"), ["\n\n\n"])
+        self.assertEqual(self.codex.parse_stop_sequences('["# end", "\\n\\n"]'), ["# end", "\n\n"])
+        self.assertEqual(len(self.codex.parse_stop_sequences('["a", "b", "c", "d", "e"]')), 4)
+
+    def test_early_stop_after_pairs(self):
+        """指定した数の組がそろったらストリームを閉じ、残りを出力しないテスト"""
+        mock_client = MagicMock()
+        stream = self._make_stream(["# list files\nls", " -la\n# show", " disk\ndf -h\n", "# remove\nrm x\n"])
+        mock_client.chat.completions.create.return_value = stream
+
+        captured_output = StringIO()
+        with patch('sys.stdout', captured_output):
+            result = self.codex.generate_response("test prompt", "gpt-4o", mock_client, "en", "bash",
+                                                  max_tokens=300, max_pairs=1)
+
+        self.assertEqual(result, "# list files\nls -la\n")
+        stream.close.assert_called_once()
+        self.assertNotIn("show", captured_output.getvalue())
+
+        # 0の場合は最後まで読む
+        stream = self._make_stream(["# list files\nls -la\n", "# show disk\ndf -h\n"])
+        mock_client.chat.completions.create.return_value = stream
+        with patch('sys.stdout', StringIO()):
+            result = self.codex.generate_response("test prompt", "gpt-4o", mock_client, "en", "bash",
+                                                  max_pairs=0)
+        self.assertEqual(result, "# list files\nls -la\n# show disk\ndf -h\n")
+        stream.close.assert_not_called()
+
+    def test_interrupt_keeps_partial(self):
+        """Ctrl-Cで中断するとストリームを閉じ、出力済みの部分を残して中断を知らせるテスト"""
+        chunk = MagicMock()
+        chunk.choices = [MagicMock(delta=MagicMock(content="# list files\nls"))]
+
+        def chunks():
+            yield chunk
+            raise KeyboardInterrupt()
+
+        stream = MagicMock()
+        stream.__iter__.return_value = chunks()
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value = stream
+
+        captured_output = StringIO()
+        with patch.dict('timeouts.TIMEOUTS', {'query': 0, 'first_token': 0, 'idle': 0}), \
+             patch('sys.stdout', captured_output), \
+             self.assertRaises(self.codex.GenerationInterrupted) as raised:
+            self.codex.generate_response("test prompt", "gpt-4o", mock_client, "en", "bash")
+
+        self.assertEqual(raised.exception.partial, "# list files\nls")
+        stream.close.assert_called_once()
+        output = captured_output.getvalue()
+        self.assertIn("# list files\nls\n", output)
+        self.assertTrue(output.endswith("# 中断しました\n"))
+
     @patch('codex_query_integrated.openai')
     @patch('codex_query_integrated.detect_shell')
-    @patch('codex_query_integrated.initialize')
+    @patch('codex_query_integrated.load_config')
+    @patch('codex_query_integrated.create_prompt_file')
+    @patch('codex_query_integrated.create_async_client')
     @patch('codex_query_integrated.get_query')
     @patch('codex_query_integrated.is_sensitive_content')
     @patch('codex_query_integrated.generate_response')
     def test_main_success(self, mock_generate, mock_sensitive, mock_get_query, 
-                         mock_initialize, mock_detect_shell, mock_openai):
+                         mock_create_client, mock_create_prompt_file, mock_load_config,
+                         mock_detect_shell, mock_openai):
         """メイン処理テスト（成功ケース）"""
         # モックの設定
         mock_prompt_file = MagicMock()
@@ -356,7 +511,9 @@ class TestCodexQueryIntegrated(unittest.TestCase):
         
         mock_client = MagicMock()
         mock_detect_shell.return_value = None
-        mock_initialize.return_value = (mock_prompt_file, mock_client, 'ja')
+        mock_load_config.return_value = (TEST_API_KEY, TEST_ORG_ID, TEST_MODEL, 'ja')
+        mock_create_prompt_file.return_value = mock_prompt_file
+        mock_create_client.return_value = mock_client
         mock_get_query.return_value = ("user query", mock_prompt_file)
         mock_sensitive.return_value = False
         mock_generate.return_value = "generated response"
@@ -366,24 +523,31 @@ class TestCodexQueryIntegrated(unittest.TestCase):
         
         # 検証
         mock_detect_shell.assert_called_once()
-        mock_initialize.assert_called_once()
+        mock_create_prompt_file.assert_called_once_with(TEST_MODEL, 'ja')
         mock_get_query.assert_called_once()
+        mock_create_client.assert_called_once_with(TEST_API_KEY, TEST_ORG_ID)
         mock_prompt_file.read_prompt_file.assert_called_once_with("user query")
-        mock_sensitive.assert_called_once()
         mock_generate.assert_called_once()
+        # モデレーションは生成と並行して実行され、その結果がgenerate_responseに渡される
+        moderation = mock_generate.call_args[1]['moderation']
+        self.assertFalse(moderation.result(timeout=2))
+        mock_sensitive.assert_called_once_with("user query", mock_client)
         mock_prompt_file.add_input_output_pair.assert_called_once_with("user query", "generated response")
 
     @patch('codex_query_integrated.openai')
     @patch('codex_query_integrated.detect_shell')
-    @patch('codex_query_integrated.initialize')
+    @patch('codex_query_integrated.load_config')
+    @patch('codex_query_integrated.create_prompt_file')
+    @patch('codex_query_integrated.create_async_client')
     @patch('codex_query_integrated.get_query')
-    def test_main_no_query(self, mock_get_query, mock_initialize, mock_detect_shell, mock_openai):
+    def test_main_no_query(self, mock_get_query, mock_create_client, mock_create_prompt_file,
+                           mock_load_config, mock_detect_shell, mock_openai):
         """メイン処理テスト（クエリなし）"""
         # モックの設定
         mock_prompt_file = MagicMock()
-        mock_client = MagicMock()
         mock_detect_shell.return_value = None
-        mock_initialize.return_value = (mock_prompt_file, mock_client, 'ja')
+        mock_load_config.return_value = (TEST_API_KEY, TEST_ORG_ID, TEST_MODEL, 'ja')
+        mock_create_prompt_file.return_value = mock_prompt_file
         mock_get_query.return_value = (None, mock_prompt_file)
         
         # 関数実行
@@ -391,8 +555,10 @@ class TestCodexQueryIntegrated(unittest.TestCase):
         
         # 検証
         mock_detect_shell.assert_called_once()
-        mock_initialize.assert_called_once()
+        mock_create_prompt_file.assert_called_once()
         mock_get_query.assert_called_once()
+        # クエリがない場合はOpenAIクライアントを作成しない
+        mock_create_client.assert_not_called()
         # プロンプトファイルのread_prompt_fileは呼ばれない
         mock_prompt_file.read_prompt_file.assert_not_called()
 
@@ -421,6 +587,126 @@ class TestCodexQueryIntegrated(unittest.TestCase):
             # 標準出力を元に戻す
             sys.stdout = sys.__stdout__
 
+def make_chunk(content):
+    chunk = MagicMock()
+    chunk.choices = [MagicMock(delta=MagicMock(content=content), finish_reason=None)]
+    return chunk
+
+
+class FakeAsyncStream:
+    """ストリーミング応答（interrupt=Trueの場合は最後の差分のあとにSIGINTを送り、応答が途切れる）"""
+
+    def __init__(self, contents, interrupt=False):
+        self.contents = contents
+        self.interrupt = interrupt
+        self.closed = False
+
+    async def _chunks(self):
+        import asyncio
+        for content in self.contents:
+            await asyncio.sleep(0)
+            yield make_chunk(content)
+        if self.interrupt:
+            os.kill(os.getpid(), signal.SIGINT)
+            # 次の差分が同時に届いても中断する
+            yield make_chunk(" -la\n")
+            await asyncio.sleep(5)
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def close(self):
+        self.closed = True
+
+
+class AsyncOpenAI:
+    """AsyncOpenAIと同じインターフェースのクライアント"""
+
+    def __init__(self, stream, flagged=False):
+        self.stream = stream
+        self.chat = MagicMock()
+        self.chat.completions.create = AsyncMock(return_value=stream)
+        self.moderations = MagicMock()
+        self.moderations.create = AsyncMock(return_value=MagicMock(results=[MagicMock(flagged=flagged)]))
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+class TestAsyncGeneration(unittest.TestCase):
+    """AsyncOpenAIのクライアントでのrun_queryのテストクラス"""
+
+    @classmethod
+    def setUpClass(cls):
+        import codex_query_integrated
+        cls.codex = codex_query_integrated
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.env = patch.dict(os.environ, {'CODEX_CACHE_DIR': self.temp_dir, 'CODEX_NO_CACHE': '1',
+                                           'CODEX_HISTORY_LOOKUP': '0'})
+        self.env.start()
+        self.prompt_file = MagicMock(last_prompt_tokens=None)
+        self.prompt_file.config = {
+            'model': 'gpt-4o', 'temperature': 0.7, 'max_tokens': 300, 'shell': 'bash',
+            'multi_turn': 'on', 'token_count': 0, 'language': 'en',
+        }
+        self.prompt_file.read_prompt_file.return_value = "context\n"
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_run_query(self):
+        """モデレーションと応答の生成を同じイベントループで行い、終わったらクライアントを閉じるテスト"""
+        client = AsyncOpenAI(FakeAsyncStream(["# list files\n", "ls -la\n"]))
+        with patch('sys.stdout', StringIO()) as stream:
+            result = self.codex.run_query("# list files", self.prompt_file, client, use_cache=False)
+
+        self.assertEqual(result, "# list files\nls -la\n")
+        self.assertIn("ls -la", stream.getvalue())
+        client.moderations.create.assert_awaited_once_with(input="# list files")
+        self.assertTrue(client.closed)
+        self.prompt_file.add_input_output_pair.assert_called_once_with("# list files", result)
+
+        # 不適切と判定された場合は出力せず、会話履歴にも追加しない
+        self.prompt_file.reset_mock()
+        client = AsyncOpenAI(FakeAsyncStream(["# remove\n", "rm -rf /\n"]), flagged=True)
+        with patch('sys.stdout', StringIO()) as stream:
+            self.assertIsNone(self.codex.run_query("# remove", self.prompt_file, client, use_cache=False))
+        self.assertNotIn("rm -rf", stream.getvalue())
+        self.prompt_file.add_input_output_pair.assert_not_called()
+
+    @unittest.skipIf(sys.platform == 'win32', "SIGINTを送れない")
+    def test_interrupt(self):
+        """Ctrl-Cでストリームをすぐに閉じ、出力済みの部分を打ち切られた応答として保存するテスト"""
+        stream = FakeAsyncStream(["# list files\n", "ls"], interrupt=True)
+        client = AsyncOpenAI(stream)
+        started = time.monotonic()
+        with patch('sys.stdout', StringIO()) as output, \
+             patch('codex_query_integrated.SAVE_PARTIAL', True), \
+             self.assertRaises(self.codex.GenerationInterrupted) as raised:
+            self.codex.run_query("# list files", self.prompt_file, client, use_cache=False)
+
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(raised.exception.partial, "# list files\nls")
+        self.assertTrue(stream.closed)
+        self.assertTrue(client.closed)
+        self.assertTrue(output.getvalue().endswith("# 中断しました\n"))
+        self.prompt_file.add_input_output_pair.assert_called_once_with(
+            "# list files", "# list files\nls\n" + self.codex.INTERRUPTED_MARK + "\n")
+        # 中断のあとはCtrl-Cの扱いが元に戻る
+        self.assertIs(signal.getsignal(signal.SIGINT), signal.default_int_handler)
+
+        # 保存しない設定（既定）
+        self.prompt_file.reset_mock()
+        client = AsyncOpenAI(FakeAsyncStream(["# list files\n", "ls\n"], interrupt=True))
+        with patch('sys.stdout', StringIO()), self.assertRaises(self.codex.GenerationInterrupted):
+            self.codex.run_query("# list files", self.prompt_file, client, use_cache=False)
+        self.prompt_file.add_input_output_pair.assert_not_called()
+
+
 # メイン実行部
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
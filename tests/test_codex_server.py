@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+codex_server.py / codex_client.py の単体テストプログラム
+"""
+
+import io
+import os
+import sys
+import stat
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+import codex_client
+import codex_server
+import timeouts
+
+
+class TestCodexServer(unittest.TestCase):
+    """常駐サーバーとクライアントのテストクラス"""
+
+    def setUp(self):
+        """一時ディレクトリにソケットを作成する"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.env = patch.dict(os.environ, {'CODEX_DAEMON_DIR': self.temp_dir})
+        self.env.start()
+
+        self.prompt_file = MagicMock()
+        self.client = MagicMock()
+        self.init = patch('codex_server.codex.initialize',
+                          return_value=(self.prompt_file, self.client, 'ja'))
+        self.init.start()
+        self.set_shell = patch('codex_server.codex.set_shell')
+        self.set_shell.start()
+
+    def tearDown(self):
+        self.set_shell.stop()
+        self.init.stop()
+        self.env.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def start_server(self, idle_timeout=5):
+        thread = threading.Thread(target=codex_server.serve, args=("bash", idle_timeout), daemon=True)
+        thread.start()
+        # ソケットが作成されるまで待つ
+        path = codex_client.socket_path("bash")
+        for _ in range(200):
+            if os.path.exists(path):
+                break
+            thread.join(0.01)
+        return thread
+
+    def test_builtin_command(self):
+        """組み込みコマンドの出力がクライアントに届くテスト"""
+        def fake_command(entry, prompt_file):
+            print("# model: gpt-4o")
+            return "config shown", prompt_file
+
+        thread = self.start_server()
+        with patch('codex_server.get_command_result', side_effect=fake_command):
+            out = io.BytesIO()
+            status = codex_client.send_query("# show config", "bash", out)
+
+        self.assertEqual(status, 0)
+        self.assertIn("# model: gpt-4o", out.getvalue().decode('utf-8'))
+
+        self.assertTrue(codex_client.stop_server("bash"))
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+
+    def test_query_reuses_client(self):
+        """クエリ処理で初期化済みのクライアントが使い回されるテスト"""
+        def fake_run_query(entry, prompt_file, client, use_cache=True, events=False):
+            print("ls -la")
+
+        thread = self.start_server()
+        with patch('codex_server.get_command_result', return_value=("", self.prompt_file)), \
+             patch('codex_server.codex.run_query', side_effect=fake_run_query) as mock_run:
+            for _ in range(2):
+                out = io.BytesIO()
+                status = codex_client.send_query("# 一覧を表示して", "bash", out)
+                self.assertEqual(status, 0)
+                self.assertEqual(out.getvalue().decode('utf-8'), "ls -la\n")
+
+        self.assertEqual(mock_run.call_count, 2)
+        for call in mock_run.call_args_list:
+            self.assertIs(call[0][2], self.client)
+
+        codex_client.stop_server("bash")
+        thread.join(2)
+
+    def test_query_timeout_status(self):
+        """タイムアウトしたクエリは出力済みの部分と終了コード124を返すテスト"""
+        def fake_run_query(entry, prompt_file, client, use_cache=True, events=False):
+            print("ls -la")
+            raise timeouts.QueryTimeout('idle', 15)
+
+        thread = self.start_server()
+        with patch('codex_server.get_command_result', return_value=("", self.prompt_file)), \
+             patch('codex_server.codex.run_query', side_effect=fake_run_query):
+            out = io.BytesIO()
+            status = codex_client.send_query("# 一覧を表示して", "bash", out)
+
+        self.assertEqual(status, timeouts.EXIT_CODE)
+        self.assertEqual(out.getvalue().decode('utf-8'), "ls -la\n")
+
+        codex_client.stop_server("bash")
+        thread.join(2)
+
+    def test_sessions_get_own_prompt_file(self):
+        """端末のセッションごとに別のPromptFileで処理されるテスト"""
+        sessions = {"pts-1": MagicMock(), "pts-2": MagicMock()}
+        self.prompt_file.for_session.side_effect = lambda session: sessions[session]
+        used = []
+
+        def fake_command(entry, prompt_file):
+            used.append(prompt_file)
+            return "config shown", prompt_file
+
+        thread = self.start_server()
+        with patch('codex_server.get_command_result', side_effect=fake_command):
+            for session in ("pts-1", "pts-2", "pts-1"):
+                with patch.dict(os.environ, {'CODEX_SESSION': session}):
+                    codex_client.send_query("# show config", "bash", io.BytesIO())
+
+        self.assertEqual(used, [sessions["pts-1"], sessions["pts-2"], sessions["pts-1"]])
+        self.assertEqual(self.prompt_file.for_session.call_count, 2)
+        sessions["pts-1"].flush_config.assert_called()
+
+        codex_client.stop_server("bash")
+        thread.join(2)
+
+    def send(self, session, text, out):
+        """セッションを指定してリクエストを送る（環境変数を使わないため別のスレッドからも送れる）"""
+        sock = codex_client.connect("bash", spawn=False)
+        with sock:
+            return codex_client.send_request(sock, {"input": text, "session": session}, out)
+
+    def test_sessions_run_concurrently(self):
+        """別のセッションのリクエストは処理中のリクエストの終了を待たずに処理されるテスト"""
+        sessions = {"pts-1": MagicMock(), "pts-2": MagicMock()}
+        self.prompt_file.for_session.side_effect = lambda session: sessions[session]
+        started = threading.Event()
+        release = threading.Event()
+
+        def fake_run_query(entry, prompt_file, client, use_cache=True, events=False):
+            if prompt_file is sessions["pts-1"]:
+                started.set()
+                release.wait(5)
+            print(entry)
+
+        thread = self.start_server()
+        with patch('codex_server.get_command_result', side_effect=lambda entry, prompt_file: ("", prompt_file)), \
+             patch('codex_server.codex.run_query', side_effect=fake_run_query):
+            slow_out = io.BytesIO()
+            slow = threading.Thread(target=self.send, args=("pts-1", "# 時間のかかるクエリ", slow_out))
+            slow.start()
+            self.assertTrue(started.wait(5))
+
+            fast_out = io.BytesIO()
+            self.assertEqual(self.send("pts-2", "# すぐ終わるクエリ", fast_out), 0)
+            self.assertEqual(fast_out.getvalue().decode('utf-8'), "# すぐ終わるクエリ\n")
+            self.assertTrue(slow.is_alive())
+
+            release.set()
+            slow.join(5)
+
+        self.assertEqual(slow_out.getvalue().decode('utf-8'), "# 時間のかかるクエリ\n")
+        sessions["pts-1"].flush_config.assert_called_once()
+        sessions["pts-2"].flush_config.assert_called_once()
+
+        codex_client.stop_server("bash")
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+
+    def test_socket_is_private(self):
+        """ソケットは所有者だけが使えるディレクトリに所有者だけが使えるモードで作られるテスト"""
+        thread = self.start_server()
+        path = codex_client.socket_path("bash")
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode), 0o700)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+
+        codex_client.stop_server("bash")
+        thread.join(2)
+
+    def test_insecure_dir_runs_directly(self):
+        """他のユーザーも書き込めるディレクトリではサーバーを使わずに直接実行するテスト"""
+        directory = codex_client.socket_dir()
+        os.makedirs(directory)
+        os.chmod(directory, 0o777)
+
+        with patch('codex_client._spawn_server') as mock_spawn, \
+             patch('codex_client.run_direct', return_value=0) as mock_direct:
+            status = codex_client.send_query("# 一覧を表示して", "bash", io.BytesIO())
+
+        self.assertEqual(status, 0)
+        mock_spawn.assert_not_called()
+        mock_direct.assert_called_once()
+        # サーバーもそのディレクトリにはソケットを作らない
+        codex_server.serve("bash", 5)
+        self.assertFalse(os.path.exists(codex_client.socket_path("bash")))
+
+    def test_untrusted_server_runs_directly(self):
+        """接続先のサーバーが他のユーザーのものなら何も送らずに直接実行するテスト"""
+        thread = self.start_server()
+        with patch('codex_client._owned_by_user', return_value=False), \
+             patch('codex_client._spawn_server') as mock_spawn, \
+             patch('codex_client.run_direct', return_value=0) as mock_direct, \
+             patch('codex_server.codex.run_query') as mock_run:
+            status = codex_client.send_query("# 一覧を表示して", "bash", io.BytesIO())
+
+        self.assertEqual(status, 0)
+        mock_spawn.assert_not_called()
+        mock_direct.assert_called_once()
+        mock_run.assert_not_called()
+
+        codex_client.stop_server("bash")
+        thread.join(2)
+
+    def test_failed_spawn_runs_directly(self):
+        """起動したサーバーがすぐ終了した場合はSPAWN_TIMEOUTを待たずに直接実行するテスト"""
+        process = MagicMock()
+        process.poll.return_value = 1
+        with patch('codex_client._spawn_server', return_value=process) as mock_spawn, \
+             patch('codex_client.SPAWN_TIMEOUT', 30), \
+             patch('codex_client.run_direct', return_value=0) as mock_direct:
+            start = time.monotonic()
+            status = codex_client.send_query("# 一覧を表示して", "bash", io.BytesIO())
+            elapsed = time.monotonic() - start
+
+        self.assertEqual(status, 0)
+        mock_spawn.assert_called_once_with("bash")
+        mock_direct.assert_called_once()
+        self.assertLess(elapsed, 5)
+
+    def test_idle_shutdown(self):
+        """アイドルタイムアウトでサーバーが終了しソケットが削除されるテスト"""
+        thread = self.start_server(idle_timeout=0.1)
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(codex_client.socket_path("bash")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+context_config.pyの単体テストプログラム
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+from context_config import ConfigFile, ContextConfig
+from prompt_file import PromptFile
+
+
+class TestContextConfig(unittest.TestCase):
+    """コンテキスト設定のテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "current_context.config")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_parse_by_key(self):
+        """行の順序に依存せずキー名で読み込むテスト"""
+        config = ContextConfig.parse("token_count: 12\nshell: zsh\nengine: code-cushman-001\n"
+                                     "unknown: 1\nbroken line\ntemperature: 0.5\n")
+        self.assertEqual(config.model, "code-cushman-001")
+        self.assertEqual(config.shell, "zsh")
+        self.assertEqual(config.temperature, 0.5)
+        self.assertEqual(config.token_count, 12)
+        self.assertEqual(config.max_tokens, 300)
+        self.assertEqual(ContextConfig.parse(config.format()), config)
+
+    def test_immutable(self):
+        """設定は変更できず、replaceで新しい設定を作るテスト"""
+        config = ContextConfig(shell="bash")
+        with self.assertRaises(AttributeError):
+            config.shell = "zsh"
+        with self.assertRaises(AttributeError):
+            config.extra = 1
+        changed = config.replace(token_count="5")
+        self.assertEqual(changed['token_count'], 5)
+        self.assertEqual(config['token_count'], 0)
+
+    def test_write_behind(self):
+        """値が変わったときだけ、flushでまとめて書き込むテスト"""
+        config_file = ConfigFile(self.path)
+        self.assertIsNone(config_file.load())
+
+        config = ContextConfig(shell="bash")
+        with patch('context_config.atexit.register') as register:
+            for count in range(1, 4):
+                config_file.save(config.replace(token_count=count))
+        register.assert_called_once_with(config_file.flush)
+        self.assertFalse(os.path.exists(self.path))
+
+        config_file.flush()
+        self.assertEqual(ConfigFile(self.path).load(), config.replace(token_count=3))
+        self.assertEqual(os.listdir(self.temp_dir), ["current_context.config"])
+
+        # 同じ値の保存では書き込まない
+        config_file.save(config.replace(token_count=3))
+        with patch('context_config.tempfile.mkstemp') as mkstemp:
+            config_file.flush()
+        mkstemp.assert_not_called()
+
+    def test_prompt_file_defers_token_count(self):
+        """マルチターンの各ターンで設定ファイルを書き換えないテスト"""
+        with patch.object(PromptFile, 'default_file_path', os.path.join(self.temp_dir, "current_context.txt")), \
+                patch.object(PromptFile, 'default_config_path', self.path), \
+                patch.object(PromptFile, 'default_store_path', os.path.join(self.temp_dir, "history.sqlite3")):
+            prompt_file = PromptFile("current_context.txt", {
+                'model': 'gpt-4o', 'temperature': 0, 'max_tokens': 300,
+                'shell': 'bash', 'multi_turn': 'on', 'token_count': 0, 'language': 'ja',
+            }, "default")
+            for i in range(3):
+                prompt_file.add_input_output_pair(f"# query {i}", f"echo {i}")
+            self.assertFalse(os.path.exists(self.path))
+
+            prompt_file.flush_config()
+            stored = ConfigFile(self.path).load()
+            self.assertEqual(stored.token_count, prompt_file.store.token_count())
+            prompt_file.store.close()
+            self.assertEqual(stored.language, 'ja')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+context_window.pyの単体テストプログラム
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+from context_window import ContextWindow, count_pinned, split_turns
+from prompt_file import PromptFile
+from example_index import ExampleIndex
+from tokenizer import count_tokens
+
+
+def make_turn(i):
+    return f"# query number {i}\necho result number {i}\n\n"
+
+
+class TestContextWindow(unittest.TestCase):
+    """トークン予算によるコンテキスト縮小のテストクラス"""
+
+    def test_split_turns_round_trip(self):
+        """ターン分割で元のテキストが失われないテスト"""
+        text = "# list files\nls -la\n\n\n# what's my ip\ncurl ifconfig.me\n# no blank\nls\n"
+        turns = split_turns(text)
+        self.assertEqual(''.join(turns), text)
+        self.assertEqual(len(turns), 2)
+        self.assertEqual(split_turns(""), [])
+
+    def test_count_pinned(self):
+        """先頭の例文と一致するターンだけが固定されるテスト"""
+        examples = [make_turn(0), make_turn(1)]
+        self.assertEqual(count_pinned([make_turn(0), make_turn(1), make_turn(2)], examples), 2)
+        self.assertEqual(count_pinned([make_turn(0), make_turn(5)], examples), 1)
+        self.assertEqual(count_pinned([make_turn(5)], examples), 0)
+
+    def test_evicts_whole_oldest_turns(self):
+        """予算を超えると古いターンから丸ごと取り除き、固定の例文は残すテスト"""
+        turns = [make_turn(i) for i in range(10)]
+        per_turn = count_tokens(turns[0])
+        window = ContextWindow(turns, pinned=2, budget=per_turn * 5)
+
+        evicted, trimmed = window.fit(reserve=per_turn)
+        self.assertEqual(evicted, 6)
+        self.assertEqual(trimmed, per_turn * 6)
+        self.assertEqual(window.text(), ''.join(turns[:2] + turns[8:]))
+        self.assertLessEqual(window.tokens + per_turn, window.budget)
+
+    def test_pinned_examples_are_never_evicted(self):
+        """予算が小さすぎても固定の例文は取り除かないテスト"""
+        turns = [make_turn(i) for i in range(3)]
+        window = ContextWindow(turns, pinned=2, budget=1)
+        self.assertEqual(window.fit(), (1, count_tokens(turns[2])))
+        self.assertEqual(window.text(), ''.join(turns[:2]))
+
+
+class TestPromptFileWindow(unittest.TestCase):
+    """PromptFileでのコンテキスト縮小のテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        file_path = os.path.join(self.temp_dir, "current_context.txt")
+        config_path = os.path.join(self.temp_dir, "current_context.config")
+        self.patches = [
+            patch.object(PromptFile, 'default_file_path', file_path),
+            patch.object(PromptFile, 'default_config_path', config_path),
+            patch.object(PromptFile, 'default_store_path', os.path.join(self.temp_dir, "history.sqlite3")),
+        ]
+        for p in self.patches:
+            p.start()
+        self.prompt_file = PromptFile("current_context.txt", {
+            'model': 'gpt-4o', 'temperature': 0, 'max_tokens': 300,
+            'shell': 'zsh', 'multi_turn': 'on', 'token_count': 0, 'language': 'en',
+        }, "default")
+        self.examples = self.prompt_file._read_example_turns()
+
+    def tearDown(self):
+        self.prompt_file.flush_config()
+        self.prompt_file.store.close()
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_add_pair_keeps_turns_separate(self):
+        """追加したターンが空行で区切られるテスト"""
+        store = self.prompt_file.store
+        store.import_text("# old query\nold command\n\n")
+        self.prompt_file.add_input_output_pair("# list files\n", "\nls -la\n\nls -a\n")
+        self.assertEqual(split_turns(store.text()), ["# old query\nold command\n\n", "# list files\nls -la\nls -a\n\n"])
+
+        self.prompt_file.clear_last_interaction()
+        self.assertEqual(store.text(), "# old query\nold command\n\n")
+
+    def test_read_trims_history_but_keeps_examples(self):
+        """履歴が予算を超えると例文を残して古いターンが削除されるテスト"""
+        self.assertTrue(self.examples)
+        history = [make_turn(i) for i in range(200)]
+        self.prompt_file.store.import_text(''.join(self.examples + history), len(self.examples))
+
+        budget = count_tokens(''.join(self.examples)) + count_tokens(''.join(history[-10:])) + 20
+        # 例の選択を無効にして、シェル用コンテキストファイルの例をすべて使う
+        with patch('prompt_file.CONTEXT_TOKEN_BUDGET', budget), patch('example_index.EXAMPLE_COUNT', 0):
+            prompt = self.prompt_file.read_prompt_file("# one more query")
+
+        self.assertTrue(prompt.startswith(''.join(self.examples)))
+        self.assertTrue(prompt.endswith(''.join(history[-10:])))
+        self.assertNotIn(history[0], prompt)
+        self.assertGreater(self.prompt_file.last_trimmed_tokens, 0)
+        self.assertEqual(self.prompt_file.store.text(), prompt)
+        self.assertEqual(self.prompt_file.config['token_count'], count_tokens(prompt))
+
+    def test_read_selects_similar_examples(self):
+        """クエリに近い例だけがプロンプトに入り、履歴はそのまま残るテスト"""
+        history = [make_turn(i) for i in range(3)]
+        self.prompt_file.store.import_text(''.join(self.examples + history), len(self.examples))
+        index = ExampleIndex(path=os.path.join(self.temp_dir, "examples.sqlite3"))
+
+        with patch('example_index.get_index', return_value=index), patch('example_index.EXAMPLE_COUNT', 8):
+            prompt = self.prompt_file.read_prompt_file("# kill process 4321")
+        index.close()
+
+        self.assertTrue(prompt.endswith(''.join(history)))
+        examples = split_turns(prompt[:-len(''.join(history))])
+        self.assertLessEqual(len(examples), 8)
+        self.assertLess(len(examples), len(self.examples))
+        # 最も近い例はクエリの直前に置かれる
+        self.assertIn("kill", examples[-1])
+        self.assertEqual(self.prompt_file.store.text(), ''.join(self.examples + history))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ローカルのOpenAI互換サーバー（benchmarks/fake_openai_server.py）を使った
+HTTP通信を含むテストプログラム
+"""
+
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+sys.path.append(str(Path(__file__).parent.parent / 'benchmarks'))
+
+from fake_openai_server import FakeOpenAIServer
+import codex_query_integrated as codex
+import timeouts
+
+
+class TestFakeOpenAIServer(unittest.TestCase):
+    """実際のopenaiクライアントで応答を受け取るテストクラス"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeOpenAIServer(chunk_chars=3, chunk_delay=0, first_token_delay=0, moderation_delay=0,
+                                      flagged_words=("forbidden",)).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.env = patch.dict(os.environ, {'CODEX_CACHE_DIR': self.temp_dir})
+        self.env.start()
+        self.client = codex._load_openai().OpenAI(base_url=self.server.base_url, api_key="test")
+
+    def tearDown(self):
+        self.client.close()
+        self.env.stop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_streamed_response(self):
+        """ストリーミングの応答がモデレーションを経て出力されるテスト"""
+        stream = io.StringIO()
+        moderation = codex.start_moderation("# list files", self.client)
+        with patch('sys.stdout', stream):
+            result = codex.generate_response("# list files", "gpt-4o", self.client, "en", "bash", moderation)
+        self.assertTrue(result.startswith("# list files\necho "))
+        self.assertTrue(stream.getvalue().endswith(result))
+
+    def test_flagged_response(self):
+        """モデレーションで不適切と判定されると応答を出力しないテスト"""
+        stream = io.StringIO()
+        moderation = codex.start_moderation("# forbidden thing", self.client)
+        with patch('sys.stdout', stream):
+            result = codex.generate_response("# forbidden thing", "gpt-4o", self.client, "en", "bash", moderation)
+        self.assertIsNone(result)
+        self.assertNotIn("echo", stream.getvalue())
+
+    def test_limits(self):
+        """max_tokens、停止シーケンス、組の数による早期終了で応答が短くなるテスト"""
+        server = FakeOpenAIServer(chunk_chars=8, chunk_delay=0.002, first_token_delay=0, moderation_delay=0,
+                                  pairs=5).start()
+        client = codex._load_openai().OpenAI(base_url=server.base_url, api_key="test")
+        try:
+            def generate(**options):
+                with patch('sys.stdout', io.StringIO()):
+                    return codex.generate_response("# list files", "gpt-4o", client, "en", "bash", **options)
+
+            full = generate(max_pairs=0)
+            self.assertEqual(full.count("echo "), 5)
+            self.assertEqual(generate(max_pairs=2).count("echo "), 2)
+            self.assertEqual(generate(stop=["# step 3"], max_pairs=0).count("echo "), 2)
+            self.assertLessEqual(len(generate(max_tokens=10, max_pairs=0)), 40)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_rate_limit_retry(self):
+        """429の応答をRetry-Afterだけ待って再試行するテスト"""
+        server = FakeOpenAIServer(chunk_delay=0, first_token_delay=0, moderation_delay=0,
+                                  rate_limit_count=2, retry_after=0.05).start()
+        client = codex._load_openai().OpenAI(base_url=server.base_url, api_key="test", max_retries=0)
+        try:
+            with patch('sys.stdout', io.StringIO()):
+                result = codex.generate_response("# list files", "gpt-4o", client, "en", "bash")
+            self.assertTrue(result.startswith("# list files\n"))
+            self.assertEqual(server.count("/chat/completions"), 3)
+
+            # 再試行の回数を超えるとエラーを表示してNoneを返す
+            server.rate_limit_count = 100
+            with patch('retry.MAX_RETRIES', 1), patch('sys.stdout', io.StringIO()):
+                self.assertIsNone(codex.generate_response("# list files", "gpt-4o", client, "en", "bash"))
+            self.assertEqual(server.count("/chat/completions"), 5)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_hedged_request(self):
+        """最初のトークンが遅いとヘッジリクエストを送り、先に応答した方を使うテスト"""
+        server = FakeOpenAIServer(chunk_delay=0, first_token_delay=0, moderation_delay=0,
+                                  stall_count=1, stall_delay=3).start()
+        client = codex._load_openai().OpenAI(base_url=server.base_url, api_key="test", max_retries=0)
+        try:
+            with patch('retry.HEDGE_AFTER', 0.2), patch('sys.stdout', io.StringIO()):
+                started = time.monotonic()
+                result = codex.generate_response("# list files", "gpt-4o", client, "en", "bash")
+                elapsed = time.monotonic() - started
+            self.assertTrue(result.startswith("# list files\n"))
+            self.assertEqual(server.count("/chat/completions"), 2)
+            self.assertLess(elapsed, 2)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_hedged_request_async(self):
+        """AsyncOpenAIを使う通常の経路でも、最初のトークンが遅いとヘッジリクエストを送るテスト"""
+        server = FakeOpenAIServer(chunk_delay=0, first_token_delay=0, moderation_delay=0,
+                                  stall_count=1, stall_delay=3).start()
+
+        async def generate():
+            client = codex._load_openai().AsyncOpenAI(base_url=server.base_url, api_key="test", max_retries=0)
+            try:
+                return await codex.generate_response_async("# list files", "gpt-4o", client, "en", "bash")
+            finally:
+                await client.close()
+
+        try:
+            with patch('retry.HEDGE_AFTER', 0.2), patch('sys.stdout', io.StringIO()):
+                started = time.monotonic()
+                result = codex._run_async(generate())
+                elapsed = time.monotonic() - started
+            self.assertTrue(result.startswith("# list files\n"))
+            self.assertEqual(server.count("/chat/completions"), 2)
+            self.assertLess(elapsed, 2)
+        finally:
+            server.stop()
+
+    def test_timeouts(self):
+        """最初のトークンが遅い場合と応答が途切れた場合に、出力済みの部分を残してタイムアウトするテスト"""
+        server = FakeOpenAIServer(chunk_chars=8, chunk_delay=0, first_token_delay=0, moderation_delay=0,
+                                  stall_count=1, stall_delay=3).start()
+        client = codex._load_openai().OpenAI(base_url=server.base_url, api_key="test", max_retries=0)
+        try:
+            with patch.dict('timeouts.TIMEOUTS', {'first_token': 0.3, 'idle': 0.3}), \
+                 patch('retry.MAX_RETRIES', 0), patch('sys.stdout', io.StringIO()) as stream:
+                started = time.monotonic()
+                with self.assertRaises(timeouts.QueryTimeout) as raised:
+                    codex.generate_response("# list files", "gpt-4o", client, "en", "bash")
+                self.assertLess(time.monotonic() - started, 2)
+                self.assertEqual(raised.exception.phase, 'first_token')
+                self.assertIn("# タイムアウト: ", stream.getvalue())
+
+                # 差分の間隔が制限時間を超える
+                server.chunk_delay = 1
+                stream.seek(0)
+                stream.truncate()
+                with self.assertRaises(timeouts.QueryTimeout) as raised:
+                    codex.generate_response("# list files", "gpt-4o", client, "en", "bash")
+                self.assertEqual(raised.exception.phase, 'idle')
+                self.assertIn("# list f", stream.getvalue())
+
+            # クエリ全体の締め切り
+            server.chunk_delay = 0.05
+            with patch.dict('timeouts.TIMEOUTS', {'query': 0.3, 'first_token': 0, 'idle': 0}), \
+                 patch('sys.stdout', io.StringIO()):
+                with self.assertRaises(timeouts.QueryTimeout) as raised:
+                    codex.generate_response("# list files", "gpt-4o", client, "en", "bash")
+                self.assertEqual(raised.exception.phase, 'query')
+        finally:
+            client.close()
+            server.stop()
+
+    def test_async_response(self):
+        """AsyncOpenAIで応答、モデレーション、早期終了、差分の間隔のタイムアウトが同期版と同じになるテスト"""
+        server = FakeOpenAIServer(chunk_chars=8, chunk_delay=0.002, first_token_delay=0, moderation_delay=0,
+                                  pairs=5, flagged_words=("forbidden",)).start()
+
+        async def generate(query, **options):
+            import asyncio
+            client = codex._load_openai().AsyncOpenAI(base_url=server.base_url, api_key="test", max_retries=0)
+            moderation = asyncio.ensure_future(codex.is_sensitive_content_async(query, client))
+            try:
+                return await codex.generate_response_async(query, "gpt-4o", client, "en", "bash",
+                                                           moderation=moderation, **options)
+            finally:
+                await client.close()
+
+        try:
+            with patch('sys.stdout', io.StringIO()) as stream:
+                result = codex._run_async(generate("# list files", max_pairs=0))
+            self.assertEqual(result.count("echo "), 5)
+            self.assertTrue(stream.getvalue().endswith(result))
+            with patch('sys.stdout', io.StringIO()):
+                self.assertEqual(codex._run_async(generate("# list files", max_pairs=2)).count("echo "), 2)
+            with patch('sys.stdout', io.StringIO()) as stream:
+                self.assertIsNone(codex._run_async(generate("# forbidden thing")))
+            self.assertNotIn("echo", stream.getvalue())
+
+            server.chunk_delay = 1
+            with patch.dict('timeouts.TIMEOUTS', {'first_token': 0.3, 'idle': 0.3}), \
+                 patch('sys.stdout', io.StringIO()) as stream:
+                with self.assertRaises(timeouts.QueryTimeout) as raised:
+                    codex._run_async(generate("# list files"))
+            self.assertEqual(raised.exception.phase, 'idle')
+            self.assertIn("# list f", stream.getvalue())
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
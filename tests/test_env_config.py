@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+env_config.pyの単体テストプログラム
+"""
+
+import os
+import sys
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+from env_config import env_int, env_float
+
+
+class TestEnvConfig(unittest.TestCase):
+    """環境変数の数値の設定のテストクラス"""
+
+    def test_valid_values(self):
+        """数値として読める値はその値を使うテスト"""
+        with patch.dict(os.environ, {'CODEX_TEST_INT': ' 5 ', 'CODEX_TEST_FLOAT': '0.25'}):
+            self.assertEqual(env_int('CODEX_TEST_INT', 3), 5)
+            self.assertEqual(env_float('CODEX_TEST_FLOAT', 1.0), 0.25)
+
+    def test_empty_uses_default(self):
+        """未設定または空の場合は既定値を使うテスト"""
+        with patch.dict(os.environ, {'CODEX_TEST_INT': ''}):
+            os.environ.pop('CODEX_TEST_FLOAT', None)
+            self.assertEqual(env_int('CODEX_TEST_INT', 3), 3)
+            self.assertEqual(env_float('CODEX_TEST_FLOAT', 1.0), 1.0)
+
+    def test_invalid_value_warns(self):
+        """不正な値は例外にせず、警告を記録して既定値を使うテスト"""
+        with patch.dict(os.environ, {'CODEX_TEST_INT': '2.5', 'CODEX_TEST_FLOAT': 'fast'}):
+            with self.assertLogs(level='WARNING') as logs:
+                self.assertEqual(env_int('CODEX_TEST_INT', 3), 3)
+                self.assertEqual(env_float('CODEX_TEST_FLOAT', 1.0), 1.0)
+        self.assertIn("CODEX_TEST_INT", logs.output[0])
+        self.assertIn("CODEX_TEST_FLOAT", logs.output[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
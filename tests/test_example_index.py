@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+example_index.pyの単体テストプログラム
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+from example_index import ExampleIndex, tokenize
+from tokenizer import count_tokens
+
+BASH_CONTEXT = (
+    "## shell: bash\n\n"
+    "# list the files\nls -la\n\n"
+    "# show disk usage\ndf -h\n\n"
+    "# kill process 1584\nkill -9 1584\n\n"
+    "# 現在のディレクトリを表示\npwd\n"
+)
+POWERSHELL_CONTEXT = (
+    "## shell: powershell\n\n"
+    "# kill process 1584\nStop-Process -Id 1584\n\n"
+)
+
+
+class TestExampleIndex(unittest.TestCase):
+    """few-shot例の検索インデックスのテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.contexts = os.path.join(self.temp_dir, "contexts")
+        os.makedirs(self.contexts)
+        self.write("bash-context.txt", BASH_CONTEXT)
+        self.write("powershell-context.txt", POWERSHELL_CONTEXT)
+        self.index = self.open_index()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def open_index(self):
+        return ExampleIndex(self.contexts, os.path.join(self.temp_dir, "examples.sqlite3"))
+
+    def write(self, name, text, mtime_ns=None):
+        path = os.path.join(self.contexts, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        if mtime_ns is not None:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def test_tokenize(self):
+        """英単語の活用をそろえ、日本語を文字bigramに分けるテスト"""
+        self.assertEqual(tokenize("Kill the Processes"), ["kill", "the", "proces"])
+        self.assertEqual(tokenize("ファイル一覧"), ["ファ", "ァイ", "イル", "ル一", "一覧"])
+        self.assertEqual(tokenize("ＬＳ コマンド"), ["ls", "コマ", "マン", "ンド"])
+
+    def test_select_similar_examples(self):
+        """同じシェルの例からクエリに近いものを選ぶテスト"""
+        selected = self.index.select("# kill the processes", "bash", count=2, prefer="bash-context.txt")
+        self.assertEqual(len(selected), 2)
+        self.assertEqual(selected[-1], "# kill process 1584\nkill -9 1584\n\n")
+        self.assertFalse(any("Stop-Process" in turn for turn in selected))
+
+        selected = self.index.select("# ディレクトリの場所", "bash", count=1)
+        self.assertEqual(selected, ["# 現在のディレクトリを表示\npwd\n\n"])
+
+        # 一致する語がなければシェル用コンテキストファイルの先頭の例を使う
+        selected = self.index.select("# zzz", "bash", count=1, prefer="bash-context.txt")
+        self.assertEqual(selected, ["# list the files\nls -la\n\n"])
+
+    def test_select_within_budget(self):
+        """選んだ例の合計がトークン予算に収まるテスト"""
+        budget = count_tokens("# list the files\nls -la\n\n") + 1
+        selected = self.index.select("# files", "bash", count=10, budget=budget)
+        self.assertEqual(selected, ["# list the files\nls -la\n\n"])
+
+    def test_incremental_refresh(self):
+        """変更されたファイルだけを分割し直し、ディスクのインデックスを再利用するテスト"""
+        self.assertEqual(self.index.refresh(), 2)
+        self.assertEqual(self.index.refresh(), 0)
+
+        # 別のプロセスでは保存済みのインデックスを読むだけ
+        other = self.open_index()
+        self.assertEqual(other.refresh(), 0)
+        self.assertEqual(len(other.examples), 5)
+        other.close()
+
+        self.write("bash-context.txt", BASH_CONTEXT + "\n# show the date\ndate\n", 2_000_000_000)
+        os.remove(os.path.join(self.contexts, "powershell-context.txt"))
+        self.assertEqual(self.index.refresh(), 1)
+        self.assertEqual(self.index.select("# date", "bash", count=1), ["# show the date\ndate\n\n"])
+        self.assertEqual(self.index.select("# kill", "powershell"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
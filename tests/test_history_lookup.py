@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+history_lookup.pyの単体テストプログラム
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from io import StringIO
+from unittest.mock import patch, MagicMock
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+import history_lookup
+from history_lookup import HistoryIndex, normalize, similarity, split_force
+
+
+class TestHistoryLookup(unittest.TestCase):
+    """過去のクエリと応答の索引のテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.contexts = os.path.join(self.temp_dir, "contexts")
+        self.deleted = os.path.join(self.temp_dir, "deleted")
+        os.makedirs(self.contexts)
+        os.makedirs(self.deleted)
+        self.write(os.path.join(self.contexts, "bash-context.txt"),
+                   "## shell: bash\n\n# what's my IP?\ncurl ifconfig.me\n\n# list all files in this directory\nls -la\n")
+        self.write(os.path.join(self.contexts, "powershell-context.txt"),
+                   "## shell: powershell\n\n# show disk usage\nGet-PSDrive\n")
+        self.write(os.path.join(self.deleted, "2024-01-01_00-00-00.txt"),
+                   "## shell: zsh\n\n# kill process 1584\nkill -9 1584\n\n")
+        self.write(os.path.join(self.deleted, "2023-01-01_00-00-00.txt"),
+                   "# delete the logs\nrm *.log\n\n")
+        self.index = HistoryIndex(os.path.join(self.temp_dir, "history_index.sqlite3"),
+                                  (self.contexts, self.deleted))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def write(self, path, text):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def test_normalize_and_similarity(self):
+        """記号や全角半角の違いを無視し、数字が違えば一致しないテスト"""
+        self.assertEqual(normalize("# What's  my ＩＰ?"), "whats my ip")
+        self.assertEqual(similarity("list all files", "list all files"), 1.0)
+        self.assertGreater(similarity(normalize("# list all files in this directory"),
+                                      normalize("# list all the files in this directory")), 0.9)
+        self.assertEqual(similarity("kill process 1584", "kill process 1585"), 0.0)
+
+    def test_word_order(self):
+        """語の順序が違う（操作の対象が入れ替わった）クエリは一致しないテスト"""
+        swapped = (normalize("# move report.txt to backup.txt"), normalize("# move backup.txt to report.txt"))
+        self.assertEqual(similarity(*swapped), 0.0)
+        self.assertEqual(similarity(normalize("# report.txtをbackup.txtに移動"),
+                                    normalize("# backup.txtをreport.txtに移動")), 0.0)
+        self.assertGreater(similarity(normalize("# move report.txt to backup.txt"),
+                                      normalize("# move the report.txt to backup.txt")), 0.85)
+
+        self.index.record("bash", "# move report.txt to backup.txt\n", "mv report.txt backup.txt\n")
+        self.assertIsNone(self.index.find("# move backup.txt to report.txt", "bash"))
+        self.assertIsNone(self.index.find("# move backup.txt to report.txt", "bash",
+                                          ["# move report.txt to backup.txt\nmv report.txt backup.txt\n\n"]))
+
+    def test_split_force(self):
+        """「# force」を取り除くテスト"""
+        self.assertEqual(split_force("# force list files\n"), ("# list files\n", True))
+        self.assertEqual(split_force("# Force 一覧\n"), ("# 一覧\n", True))
+        self.assertEqual(split_force("# forced march\n"), ("# forced march\n", False))
+
+    def test_find_exact_and_near_duplicates(self):
+        """完全一致とほぼ同じクエリに応答し、シェルの違うものは使わないテスト"""
+        match = self.index.find("# whats my ip", "bash")
+        self.assertEqual((match.response, match.similarity), ("curl ifconfig.me\n", 1.0))
+
+        match = self.index.find("# list all the files in this directory", "bash")
+        self.assertEqual(match.response, "ls -la\n")
+        self.assertGreaterEqual(match.similarity, history_lookup.THRESHOLD)
+        self.assertIsNone(self.index.find("# list all the files in this directory", "bash", threshold=1.0))
+
+        self.assertIsNone(self.index.find("# show disk usage", "bash"))
+        self.assertEqual(self.index.find("# show disk usage", "powershell").response, "Get-PSDrive\n")
+
+        # クリアした履歴はヘッダーのシェルにだけ使い、数字が違えば使わない
+        self.assertEqual(self.index.find("# kill process 1584", "zsh").response, "kill -9 1584\n")
+        self.assertIsNone(self.index.find("# kill process 1584", "powershell"))
+        self.assertIsNone(self.index.find("# kill process 1585", "zsh"))
+
+        # シェルのヘッダーがない以前の形式のファイルはどのシェルにも使わない
+        for shell in ("bash", "zsh", "powershell"):
+            self.assertIsNone(self.index.find("# delete the logs", shell))
+
+        # 現在の会話履歴も探す
+        turns = ["# open it in vim\nvim notes.txt\n\n"]
+        self.assertEqual(self.index.find("# open it in vim", "bash", turns).response, "vim notes.txt\n")
+
+    def test_refresh_and_record(self):
+        """変更されたファイルだけを読み直し、生成した応答を記録するテスト"""
+        self.assertEqual(self.index.refresh(), 4)
+        self.assertEqual(self.index.refresh(), 0)
+        os.remove(os.path.join(self.deleted, "2024-01-01_00-00-00.txt"))
+        self.assertEqual(self.index.refresh(), 0)
+        self.assertIsNone(self.index.find("# kill process 1584", "zsh"))
+
+        self.index.record("bash", "# show the date\n", "date\n")
+        self.index.record("bash", "# Show the date!\n", "date -u\n")
+        self.assertEqual(self.index.find("# show the date", "bash").response, "date -u\n")
+        self.assertEqual(self.index.stats()['pairs'], 4)
+
+    def test_lookup_stats(self):
+        """ヒット率と節約できた時間を記録するテスト"""
+        self.index.record_api_time(1.5)
+        self.assertIsNotNone(self.index.lookup("# what's my ip", "bash"))
+        self.assertIsNone(self.index.lookup("# something else entirely", "bash"))
+        stats = self.index.stats()
+        self.assertEqual((stats['lookups'], stats['hits']), (2, 1))
+        self.assertGreater(stats['saved_ms'], 1000)
+
+
+class TestRunQueryHistory(unittest.TestCase):
+    """run_queryでの過去の応答の利用のテストクラス"""
+
+    @classmethod
+    def setUpClass(cls):
+        import codex_query_integrated
+        cls.codex = codex_query_integrated
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.env = patch.dict(os.environ, {'CODEX_CACHE_DIR': self.temp_dir, 'CODEX_NO_CACHE': '',
+                                           'CODEX_HISTORY_LOOKUP': '1'})
+        self.env.start()
+        self.index = HistoryIndex(os.path.join(self.temp_dir, "history_index.sqlite3"), ())
+        self.patch_index = patch('history_lookup.get_index', return_value=self.index)
+        self.patch_index.start()
+        self.prompt_file = MagicMock()
+        self.prompt_file.config = {
+            'model': 'gpt-4o', 'temperature': 0.7, 'max_tokens': 300, 'shell': 'bash',
+            'multi_turn': 'off', 'token_count': 0, 'language': 'ja'
+        }
+        self.prompt_file.read_prompt_file.return_value = "context\n"
+        self.prompt_file.store.turns.return_value = []
+
+    def tearDown(self):
+        self.patch_index.stop()
+        self.index.close()
+        self.env.stop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def run_query(self, query, client):
+        with patch('sys.stdout', StringIO()):
+            return self.codex.run_query(query, self.prompt_file, client)
+
+    def test_near_duplicate_and_force(self):
+        """ほぼ同じクエリはAPIを呼ばず、「# force」では呼ぶテスト"""
+        client = MagicMock()
+        client.moderations.create.return_value = MagicMock(results=[MagicMock(flagged=False)])
+        chunk = MagicMock()
+        chunk.choices = [MagicMock(delta=MagicMock(content="ls -la"))]
+        client.chat.completions.create.return_value = [chunk]
+
+        self.assertEqual(self.run_query("# list all files in this directory\n", client), "ls -la")
+        self.assertEqual(self.run_query("# List all the files in this directory?\n", client), "ls -la")
+        self.assertEqual(client.chat.completions.create.call_count, 1)
+
+        self.run_query("# force list all files in this directory\n", client)
+        self.assertEqual(client.chat.completions.create.call_count, 2)
+        self.assertEqual(self.index.stats()['hits'], 1)
+
+    def test_lookup_without_response_cache(self):
+        """応答キャッシュを使わない場合も履歴から応答するテスト"""
+        self.index.record("bash", "# list all files in this directory\n", "ls -la\n")
+        client = MagicMock()
+        client.moderations.create.return_value = MagicMock(results=[MagicMock(flagged=False)])
+        with patch.dict(os.environ, {'CODEX_NO_CACHE': '1'}), patch('sys.stdout', StringIO()):
+            result = self.codex.run_query("# list all files in this directory\n", self.prompt_file, client,
+                                          use_cache=False)
+        self.assertEqual(result, "ls -la\n")
+        client.chat.completions.create.assert_not_called()
+
+    def test_flagged_query_is_not_answered_from_history(self):
+        """過去の応答を返す場合もモデレーションで不適切と判定されたクエリには答えないテスト"""
+        self.index.record("bash", "# wipe the other disk\n", "dd if=/dev/zero of=/dev/sdb\n")
+        client = MagicMock()
+        client.moderations.create.return_value = MagicMock(results=[MagicMock(flagged=True)])
+        self.assertIsNone(self.run_query("# wipe the other disk\n", client))
+        client.moderations.create.assert_called_once()
+        client.chat.completions.create.assert_not_called()
+
+    def test_multi_turn_skips_lookup(self):
+        """マルチターンモードでは直前の会話で意味が変わるため過去の応答を使わないテスト"""
+        self.index.record("bash", "# now delete it\n", "rm notes.txt\n")
+        self.prompt_file.config['multi_turn'] = 'on'
+        client = MagicMock()
+        client.moderations.create.return_value = MagicMock(results=[MagicMock(flagged=False)])
+        chunk = MagicMock()
+        chunk.choices = [MagicMock(delta=MagicMock(content="rm report.txt"))]
+        client.chat.completions.create.return_value = [chunk]
+
+        self.assertEqual(self.run_query("# now delete it\n", client), "rm report.txt")
+        self.assertEqual(self.index.stats()['lookups'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+history_store.pyの単体テストプログラム
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+from history_store import HistoryStore, format_context, parse_context
+from prompt_file import PromptFile
+from commands import get_command_result
+from tokenizer import count_tokens
+
+CONTEXTS_DIR = Path(__file__).parent.parent / 'contexts'
+
+
+class TestHistoryStore(unittest.TestCase):
+    """追記型の履歴ストアのテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = HistoryStore(os.path.join(self.temp_dir, "history.sqlite3"))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_append_pop_and_last(self):
+        """追加・取り消し・直近Nターンの取得のテスト"""
+        self.store.reset("# example\necho example\n\n")
+        for i in range(5):
+            self.store.append(f"# query {i}\necho {i}\n\n")
+
+        self.assertEqual(self.store.last(2), ["# query 3\necho 3\n\n", "# query 4\necho 4\n\n"])
+        self.assertEqual(self.store.pop(), ("# query 4\necho 4\n\n", count_tokens("# query 4\necho 4\n\n")))
+        self.assertEqual(len(self.store.turns()), 5)
+
+        # 固定の例文は取り消さない
+        for _ in range(4):
+            self.store.pop()
+        self.assertIsNone(self.store.pop())
+        self.assertEqual(self.store.text(), "# example\necho example\n\n")
+
+    def test_window_deletes_evicted_turns(self):
+        """予算を超えた古いターンがストアから削除されるテスト"""
+        example = "# example\necho example\n\n"
+        turns = [f"# query {i}\necho {i}\n\n" for i in range(20)]
+        self.store.reset(example)
+        for turn in turns:
+            self.store.append(turn)
+
+        budget = count_tokens(example) + count_tokens(''.join(turns[-3:]))
+        text, evicted, trimmed = self.store.window(budget)
+        self.assertEqual(text, example + ''.join(turns[-3:]))
+        self.assertEqual(evicted, 17)
+        self.assertEqual(trimmed, count_tokens(''.join(turns[:17])))
+        self.assertEqual(self.store.text(), text)
+        self.assertEqual(self.store.token_count(), budget)
+
+        # 新しいターンは例文より後ろに並ぶ
+        self.store.append("# newest\nls\n\n")
+        self.assertTrue(self.store.window(10000)[0].startswith(example))
+
+    def test_window_uses_stored_token_counts(self):
+        """保存済みのトークン数を使い、数え直すのは入れ替えた例文だけのテスト"""
+        self.store.reset("# example\necho example\n\n")
+        for i in range(50):
+            self.store.append(f"# query {i}\necho {i}\n\n")
+
+        with patch('context_window.count_tokens') as counter:
+            self.store.window(10 ** 6, select=lambda examples: examples)
+        counter.assert_not_called()
+
+        with patch('context_window.count_tokens', return_value=1) as counter:
+            self.store.window(10 ** 6, select=lambda examples: ["# other\nls\n\n"])
+        counter.assert_called_once_with("# other\nls\n\n")
+
+    def test_reset_same_context_is_noop(self):
+        """同じコンテキストの読み込みを繰り返してもターンが増えないテスト"""
+        max_id = "SELECT MAX(id) FROM turns"
+        self.store.reset("# a\nls\n\n# b\npwd\n\n")
+        last_id = self.store.conn.execute(max_id).fetchone()[0]
+        self.store.reset("# a\nls\n\n# b\npwd\n\n")
+        self.assertEqual(self.store.conn.execute(max_id).fetchone()[0], last_id)
+        self.assertEqual(len(self.store.turns()), 2)
+
+        self.store.append("# c\ndate\n\n")
+        self.store.reset("# a\nls\n\n# b\npwd\n\n")
+        self.assertEqual(len(self.store.turns()), 2)
+
+    def test_import_file(self):
+        """テキストファイルは変更された場合だけ取り込むテスト"""
+        path = os.path.join(self.temp_dir, "current_context.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("# example\necho example\n\n# mine\nls\n\n")
+
+        self.assertTrue(self.store.import_file(path, ["# example\necho example\n"]))
+        self.assertFalse(self.store.import_file(path))
+        self.assertEqual(self.store.pop()[0], "# mine\nls\n\n")
+        self.assertIsNone(self.store.pop())
+
+        # 書き出しただけでは取り込み直さない
+        self.store.append("# added\npwd\n\n")
+        self.store.export_file(path)
+        with open(path, 'r', encoding='utf-8') as f:
+            self.assertEqual(f.read(), self.store.text())
+        self.assertFalse(self.store.import_file(path))
+
+        # 書き出したファイルをエディタで編集した場合は取り込む（誤った応答を消すなど）
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("# example\necho example\n\n# edited\nwhoami\n\n")
+        self.assertTrue(self.store.import_file(path, ["# example\necho example\n"]))
+        self.assertEqual(self.store.turns(), ["# example\necho example\n\n", "# edited\nwhoami\n\n"])
+        self.assertEqual(self.store.pop()[0], "# edited\nwhoami\n\n")
+        self.assertIsNone(self.store.pop())
+
+    def test_context_format_round_trip(self):
+        """「## 」ヘッダー形式との相互変換のテスト"""
+        with open(CONTEXTS_DIR / 'bash-context.txt', 'r', encoding='utf-8') as f:
+            headers, text = parse_context(f.read())
+        self.assertEqual(headers[3], "shell: bash\n")
+
+        config = {'model': 'gpt-4o', 'temperature': 0, 'max_tokens': 300, 'shell': 'bash',
+                  'multi_turn': 'on', 'token_count': 10, 'language': 'en'}
+        saved_headers, saved_text = parse_context(format_context(config, text))
+        self.assertEqual(saved_headers[3], "shell: bash\n")
+        self.assertEqual(saved_text.strip(), text.strip())
+
+
+class TestPromptFileStore(unittest.TestCase):
+    """PromptFileと履歴ストアの連携のテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.temp_dir, "current_context.txt")
+        self.patches = [
+            patch.object(PromptFile, 'default_file_path', self.file_path),
+            patch.object(PromptFile, 'default_config_path', os.path.join(self.temp_dir, "current_context.config")),
+            patch.object(PromptFile, 'default_store_path', os.path.join(self.temp_dir, "history.sqlite3")),
+        ]
+        for p in self.patches:
+            p.start()
+        self.config = {'model': 'gpt-4o', 'temperature': 0, 'max_tokens': 300,
+                       'shell': 'bash', 'multi_turn': 'on', 'token_count': 0, 'language': 'en'}
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_existing_context_file_is_imported(self):
+        """以前のcurrent_context.txtが初回に取り込まれ、編集したファイルは次のクエリで取り込まれるテスト"""
+        with open(self.file_path, 'w', encoding='utf-8') as f:
+            f.write("# old query\nold command\n\n")
+        prompt_file = PromptFile("current_context.txt", self.config, "default")
+        self.assertEqual(prompt_file.store.turns(), ["# old query\nold command\n\n"])
+
+        # ファイルが変わらなければ、追加したターンはそのまま使う
+        prompt_file.add_input_output_pair("# new query", "new command")
+        self.assertIn("# new query", prompt_file.read_prompt_file("# next"))
+
+        # "view context"で開いたファイルから誤った応答を消すと、次のクエリから使われない
+        with patch('builtins.print'), patch('os.system'):
+            get_command_result("# view context", prompt_file)
+        with open(self.file_path, 'w', encoding='utf-8') as f:
+            f.write("# old query\nold command\n\n")
+        self.assertNotIn("# new query", prompt_file.read_prompt_file("# next"))
+        self.assertEqual(prompt_file.store.turns(), ["# old query\nold command\n\n"])
+        prompt_file.flush_config()
+        prompt_file.store.close()
+
+    def test_load_context_keeps_examples_pinned(self):
+        """読み込んだコンテキストの例文が取り消されないテスト"""
+        prompt_file = PromptFile("current_context.txt", self.config, "default")
+        with patch('builtins.print'):
+            prompt_file.load_context("bash-context")
+            prompt_file.add_input_output_pair("# list files", "ls -la")
+            prompt_file.clear_last_interaction()
+            prompt_file.clear_last_interaction()
+        self.assertEqual(prompt_file.store.text().strip(), ''.join(prompt_file._read_example_turns()).strip())
+        self.assertIsNone(prompt_file.store.pop())
+        self.assertEqual(prompt_file.get_token_count(), prompt_file.store.token_count())
+        prompt_file.flush_config()
+        prompt_file.store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+log_config.pyの単体テストプログラム
+（ルートロガーの設定はプロセス全体に影響するため、別プロセスで確認する）
+"""
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+import textwrap
+import unittest
+import subprocess
+from pathlib import Path
+
+SRC_DIR = str(Path(__file__).parent.parent / 'src')
+
+# テスト対象のモジュールパスを追加
+sys.path.append(SRC_DIR)
+
+from log_config import parse_level
+
+
+def run_logging(script, env):
+    """setup_logging()の後にscriptを実行し、標準エラー出力を返す"""
+    code = "import sys, logging\nsys.path.insert(0, {!r})\nfrom log_config import setup_logging\nsetup_logging()\n".format(SRC_DIR)
+    result = subprocess.run([sys.executable, "-c", code + textwrap.dedent(script)],
+                            env=dict(os.environ, **env), stderr=subprocess.PIPE, timeout=30)
+    return result.returncode, result.stderr.decode('utf-8')
+
+
+class TestLogConfig(unittest.TestCase):
+    """ログ設定のテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.temp_dir, "codex_debug.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def read_log(self):
+        with open(self.log_file, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def test_parse_level(self):
+        """レベル名の変換のテスト"""
+        self.assertEqual(parse_level("debug"), 10)
+        self.assertEqual(parse_level("30"), 30)
+        self.assertIsNone(parse_level("off"))
+        self.assertEqual(parse_level("verbose"), 30)
+
+    def test_default_level_and_lazy_format(self):
+        """デフォルトはWARNINGで、出力しないレベルのメッセージは整形しないテスト"""
+        status, _ = run_logging("""
+            class Expensive:
+                calls = 0
+                def __str__(self):
+                    Expensive.calls += 1
+                    return "expensive"
+            logging.debug("debug %s", Expensive())
+            logging.info("info %s", Expensive())
+            assert Expensive.calls == 0, Expensive.calls
+            logging.warning("警告 %s", Expensive())
+            # 整形は書き込み用のスレッドで行われる
+            from log_config import stop_logging
+            stop_logging()
+            assert Expensive.calls > 0
+        """, {'CODEX_LOG_FILE': self.log_file, 'CODEX_LOG_LEVEL': ''})
+        self.assertEqual(status, 0)
+        log = self.read_log()
+        self.assertIn("WARNING - 警告 expensive", log)
+        self.assertNotIn("debug", log)
+
+    def test_rotation(self):
+        """サイズを超えるとローテーションし、残す数が上限を超えないテスト"""
+        status, _ = run_logging("""
+            for i in range(400):
+                logging.info("line %04d %s", i, "x" * 40)
+        """, {'CODEX_LOG_FILE': self.log_file, 'CODEX_LOG_LEVEL': 'INFO',
+              'CODEX_LOG_MAX_BYTES': '2000', 'CODEX_LOG_BACKUPS': '2'})
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(os.path.basename(p) for p in glob.glob(self.log_file + "*")),
+                         ["codex_debug.log", "codex_debug.log.1", "codex_debug.log.2"])
+        self.assertLessEqual(os.path.getsize(self.log_file), 2000)
+        # プロセス終了時にキューの残りが書き込まれる
+        self.assertIn("line 0399", self.read_log())
+
+    def test_rotation_with_concurrent_processes(self):
+        """複数のプロセスが同時にローテーションしても行が失われないテスト"""
+        code = "import sys, logging\nsys.path.insert(0, {!r})\nfrom log_config import setup_logging\nsetup_logging()\n".format(SRC_DIR)
+        script = code + textwrap.dedent("""
+            import os
+            for i in range(300):
+                logging.info("line %s-%04d %s", os.getpid(), i, "x" * 40)
+        """)
+        env = dict(os.environ, CODEX_LOG_FILE=self.log_file, CODEX_LOG_LEVEL='INFO',
+                   CODEX_LOG_MAX_BYTES='2000', CODEX_LOG_BACKUPS='200')
+        processes = [subprocess.Popen([sys.executable, "-c", script], env=env) for _ in range(3)]
+        for process in processes:
+            self.assertEqual(process.wait(timeout=60), 0)
+
+        lines = []
+        for path in glob.glob(self.log_file + "*"):
+            with open(path, 'r', encoding='utf-8') as f:
+                lines.extend(line for line in f if " - INFO - line " in line)
+        self.assertEqual(len(lines), 900)
+        self.assertEqual(len(set(lines)), 900)
+
+    def test_off(self):
+        """OFFではファイルにも標準エラー出力にも書かないテスト"""
+        status, stderr = run_logging("""
+            logging.error("should not appear")
+        """, {'CODEX_LOG_FILE': self.log_file, 'CODEX_LOG_LEVEL': 'OFF'})
+        self.assertEqual(status, 0)
+        self.assertFalse(os.path.exists(self.log_file))
+        self.assertNotIn("should not appear", stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
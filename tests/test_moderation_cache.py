@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+moderation_cache.pyの単体テストプログラム
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+from moderation_cache import ModerationCache, normalize
+
+
+class TestModerationCache(unittest.TestCase):
+    """モデレーション結果キャッシュのテストクラス"""
+
+    @classmethod
+    def setUpClass(cls):
+        import codex_query_integrated
+        cls.codex = codex_query_integrated
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.temp_dir, "codex-cli.json")
+        self.env = patch.dict(os.environ, {'CODEX_CACHE_DIR': self.temp_dir, 'CODEX_NO_CACHE': ''})
+        self.env.start()
+        self.cache = self.make_cache()
+        self.patch_cache = patch('moderation_cache.get_cache', return_value=self.cache)
+        self.patch_cache.start()
+
+    def tearDown(self):
+        self.patch_cache.stop()
+        self.cache.close()
+        self.env.stop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def make_cache(self):
+        return ModerationCache(config_path=self.config_path)
+
+    def make_client(self, flagged=False):
+        client = MagicMock()
+        client.moderations.create.return_value = MagicMock(results=[MagicMock(flagged=flagged)])
+        return client
+
+    def test_normalize(self):
+        """表記ゆれが同じキーになるテスト"""
+        self.assertEqual(normalize("#  List   FILES\n"), normalize("list files"))
+        self.assertEqual(normalize("# ＡＢＣ"), "abc")
+
+    def test_repeat_query_uses_cache(self):
+        """同じクエリの2回目はAPIを呼び出さないテスト"""
+        client = self.make_client()
+        self.assertFalse(self.codex.is_sensitive_content("# compress the logs folder", client))
+        self.assertFalse(self.codex.is_sensitive_content("#   Compress the logs folder ", client))
+        self.assertEqual(client.moderations.create.call_count, 1)
+
+        cache = self.make_cache()
+        self.assertEqual(cache.stats(), {'calls': 1, 'allowlist': 0, 'cached': 1})
+        cache.close()
+
+    def test_flagged_verdict_is_cached(self):
+        """不適切と判定された結果もキャッシュされるテスト"""
+        client = self.make_client(flagged=True)
+        self.assertTrue(self.codex.is_sensitive_content("something bad", client))
+        self.assertTrue(self.codex.is_sensitive_content("something bad", client))
+        self.assertEqual(client.moderations.create.call_count, 1)
+
+    def test_context_examples_are_allowed(self):
+        """contexts/*.txt の例文はAPIを呼び出さないテスト"""
+        client = self.make_client()
+        self.assertFalse(self.codex.is_sensitive_content("# what's my IP?", client))
+        client.moderations.create.assert_not_called()
+
+    def test_allowlist_is_built_once(self):
+        """共有のキャッシュを使い回し、クエリごとにコンテキストや設定ファイルを読み直さないテスト"""
+        self.patch_cache.stop()
+        try:
+            import moderation_cache
+            cache = moderation_cache.get_cache()
+            self.assertIs(moderation_cache.get_cache(), cache)
+            client = self.make_client()
+            with patch('moderation_cache.glob.glob') as glob, patch('moderation_cache.read_text') as read, \
+                    patch('moderation_cache.json.load') as load:
+                self.assertFalse(self.codex.is_sensitive_content("# what's my IP?", client))
+                self.assertFalse(self.codex.is_sensitive_content("# compress the logs folder", client))
+            glob.assert_not_called()
+            read.assert_not_called()
+            load.assert_not_called()
+            self.assertEqual(cache.stats(), {'calls': 1, 'allowlist': 1, 'cached': 0})
+        finally:
+            self.patch_cache.start()
+
+    def test_configured_patterns(self):
+        """設定ファイルの正規表現に一致するクエリはAPIを呼び出さないテスト"""
+        with open(self.config_path, 'w', encoding='utf-8') as f:
+            json.dump({"moderation_allowlist": [r"^(list|show) .*files"]}, f)
+
+        cache = self.make_cache()
+        self.assertTrue(cache.is_allowed("# show large files"))
+        self.assertFalse(cache.is_allowed("# delete large files"))
+        cache.close()
+
+    def test_ttl_expiry(self):
+        """有効期限を過ぎた判定は使わないテスト"""
+        cache = ModerationCache(ttl=60, config_path=self.config_path)
+        with patch('moderation_cache.time.time', return_value=1000):
+            cache.store("query", False)
+        with patch('moderation_cache.time.time', return_value=1030):
+            self.assertFalse(cache.lookup("query"))
+        with patch('moderation_cache.time.time', return_value=1061):
+            self.assertIsNone(cache.lookup("query"))
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+output_sink.pyの単体テストプログラム
+"""
+
+import io
+import sys
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+from output_sink import OutputSink
+
+
+class CountingStream(io.StringIO):
+    """書き込み回数を数えるストリーム"""
+
+    def __init__(self, tty=False):
+        super().__init__()
+        self.writes = 0
+        self.tty = tty
+
+    def write(self, text):
+        self.writes += 1
+        return super().write(text)
+
+    def isatty(self):
+        return self.tty
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestOutputSink(unittest.TestCase):
+    """出力のまとめ書きのテストクラス"""
+
+    def test_flushes_on_newline(self):
+        """改行を受け取るまで書き出さないテスト"""
+        stream = CountingStream()
+        sink = OutputSink(stream, mode='line', clock=FakeClock())
+        for delta in ["# list", " files", "\nls", " -la", "\n"]:
+            sink.write(delta)
+        self.assertEqual(stream.getvalue(), "# list files\nls -la\n")
+        self.assertEqual(stream.writes, 2)
+        self.assertEqual([chars for chars, _ in sink.flushes], [13, 7])
+        self.assertEqual(sink.text(), "# list files\nls -la\n")
+
+    def test_flushes_after_interval(self):
+        """改行がなくても一定時間が経てば書き出すテスト"""
+        clock = FakeClock()
+        stream = CountingStream()
+        sink = OutputSink(stream, mode='line', interval=0.05, clock=clock)
+        sink.write("find .")
+        clock.now = 0.01
+        sink.write(" -name")
+        self.assertEqual(stream.getvalue(), "")
+        clock.now = 0.06
+        sink.write(" '*.py'")
+        self.assertEqual(stream.getvalue(), "find . -name '*.py'")
+
+        sink.write(" | wc -l")
+        sink.flush()
+        self.assertEqual(stream.getvalue(), "find . -name '*.py' | wc -l")
+
+    def test_raw_mode_for_tty(self):
+        """端末ではraw（差分ごとに表示）モードになるテスト"""
+        stream = CountingStream(tty=True)
+        sink = OutputSink(stream, clock=FakeClock())
+        for delta in ["ls", " -la"]:
+            sink.write(delta)
+        self.assertTrue(sink.raw)
+        self.assertEqual(stream.writes, 2)
+        self.assertFalse(OutputSink(CountingStream(), mode='auto').raw)
+
+    def test_print_stream_coalesces(self):
+        """_print_streamの書き出し回数が差分の数より少ないテスト"""
+        import codex_query_integrated as codex
+        stream = CountingStream()
+        deltas = ["# show", " disk", " usage", "\n", "df", " -h", None]
+        with patch('sys.stdout', stream):
+            result = codex._print_stream(deltas)
+        self.assertEqual(result, "# show disk usage\ndf -h")
+        self.assertTrue(stream.getvalue().endswith("# show disk usage\ndf -h\n"))
+        # 処理中メッセージの消去 + 2行分
+        self.assertLessEqual(stream.writes, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
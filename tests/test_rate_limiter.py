@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rate_limiter.pyの単体テストプログラム
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from io import StringIO
+from unittest.mock import patch, MagicMock
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+import timeouts
+from rate_limiter import RateLimiter
+
+
+def reserve_in_process(path, now):
+    """別のプロセスで1リクエストを予約して待ち時間を返す"""
+    limiter = RateLimiter(6, 0, path)
+    try:
+        return limiter.reserve(10, now=now)
+    finally:
+        limiter.close()
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class TestRateLimiter(unittest.TestCase):
+    """プロセス間で共有するトークンバケットのテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "rate_limit.sqlite3")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def limiter(self, requests_per_minute=0, tokens_per_minute=0):
+        limiter = RateLimiter(requests_per_minute, tokens_per_minute, self.path)
+        self.addCleanup(limiter.close)
+        return limiter
+
+    def test_disabled(self):
+        """上限がなければ待たず、ファイルも作らないテスト"""
+        limiter = self.limiter()
+        self.assertFalse(limiter.enabled)
+        self.assertEqual(limiter.reserve(10000), 0.0)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_requests_and_tokens(self):
+        """リクエスト数とトークン数のどちらかが足りなければ、足りるまでの時間だけ待つテスト"""
+        limiter = self.limiter(2, 600)
+        self.assertEqual(limiter.reserve(100, now=1000.0), 0.0)
+        self.assertEqual(limiter.reserve(100, now=1000.0), 0.0)
+        # リクエスト数は0.5秒あたり1つずつ戻るので、3つ目は30秒待つ
+        self.assertAlmostEqual(limiter.reserve(100, now=1000.0), 30.0)
+
+        limiter = RateLimiter(0, 600, self.path + "2")
+        self.addCleanup(limiter.close)
+        self.assertEqual(limiter.reserve(400, now=1000.0), 0.0)
+        # トークンは1秒あたり10ずつ戻る
+        self.assertAlmostEqual(limiter.reserve(400, now=1000.0), 20.0)
+        # 予約した順に待ち時間が延びる
+        self.assertAlmostEqual(limiter.reserve(100, now=1000.0), 30.0)
+        # 上限より大きい予約は満杯になるまで待てば送れる
+        self.assertAlmostEqual(limiter.reserve(5000, now=1000.0), 90.0)
+
+    def test_max_wait(self):
+        """待ち時間がmax_waitを超える場合は予約しないテスト"""
+        limiter = self.limiter(1, 0)
+        self.assertEqual(limiter.reserve(1, now=1000.0), 0.0)
+        self.assertIsNone(limiter.reserve(1, max_wait=10, now=1000.0))
+        self.assertAlmostEqual(limiter.reserve(1, now=1000.0), 60.0)
+        self.assertEqual(limiter.stats()['waits'], 1)
+
+    def test_pause_on_rate_limit(self):
+        """429を受けたら他の利用者も止め、それ以外のエラーでは止めないテスト"""
+        limiter = self.limiter(60, 0)
+        limiter.on_retry(ValueError(), 5)
+        self.assertEqual(limiter.reserve(1), 0.0)
+        limiter.on_retry(RateLimitError(), 5)
+        other = RateLimiter(60, 0, self.path)
+        self.addCleanup(other.close)
+        self.assertGreater(other.reserve(1), 4.5)
+
+    def test_acquire(self):
+        """待つ前に待ち時間を知らせてから待つテスト"""
+        limiter = self.limiter(1, 0)
+        sleeps, notices = [], []
+        self.assertEqual(limiter.acquire(1, sleep=sleeps.append), 0.0)
+        waited = limiter.acquire(1, on_wait=notices.append, sleep=sleeps.append)
+        self.assertGreater(waited, 59)
+        self.assertEqual((sleeps, notices), ([waited], [waited]))
+
+    def test_shared_between_processes(self):
+        """同時に予約した複数のプロセスが、同じ予算を順番に使うテスト"""
+        with multiprocessing.get_context('fork').Pool(4) as pool:
+            waits = sorted(pool.starmap(reserve_in_process, [(self.path, 1000.0)] * 8))
+        # 1分あたり6リクエスト（10秒に1つ）なので、7つ目と8つ目だけが待つ
+        self.assertEqual(waits[:6], [0.0] * 6)
+        self.assertAlmostEqual(waits[6], 10.0)
+        self.assertAlmostEqual(waits[7], 20.0)
+
+
+class TestGenerateResponseRateLimit(unittest.TestCase):
+    """generate_responseでの送信前の予約のテストクラス"""
+
+    @classmethod
+    def setUpClass(cls):
+        import codex_query_integrated
+        cls.codex = codex_query_integrated
+
+    def setUp(self):
+        self.limiter = MagicMock(enabled=True)
+        self.patch = patch('rate_limiter.get_limiter', return_value=self.limiter)
+        self.patch.start()
+        chunk = MagicMock()
+        chunk.choices = [MagicMock(delta=MagicMock(content="ls -la\n"))]
+        self.client = MagicMock()
+        self.client.chat.completions.create.return_value = [chunk]
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def test_reserves_prompt_and_max_tokens(self):
+        """PromptFileが数えたトークン数とmax_tokensを予約してから送信するテスト"""
+        self.limiter.acquire.return_value = 0.0
+        with patch('sys.stdout', StringIO()):
+            result = self.codex.generate_response("# list files", "gpt-4o", self.client, "en", "bash",
+                                                  max_tokens=300, prompt_tokens=1000)
+        self.assertEqual(result, "ls -la\n")
+        tokens = self.limiter.acquire.call_args[0][0]
+        self.assertGreater(tokens, 1300)
+        self.assertLess(tokens, 1600)
+
+    def test_wait_beyond_deadline(self):
+        """締め切りまでに順番が来ない場合は送信せずにタイムアウトするテスト"""
+        self.limiter.acquire.return_value = None
+        with patch('sys.stdout', StringIO()) as stream, \
+             self.assertRaises(timeouts.QueryTimeout) as raised:
+            self.codex.generate_response("# list files", "gpt-4o", self.client, "en", "bash",
+                                         deadline=timeouts.Deadline(5))
+        self.assertEqual(raised.exception.phase, 'rate_limit')
+        self.assertLessEqual(self.limiter.acquire.call_args[0][1], 5)
+        self.client.chat.completions.create.assert_not_called()
+        self.assertIn("# タイムアウト: ", stream.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+response_cache.pyの単体テストプログラム
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from io import StringIO
+from unittest.mock import patch, MagicMock
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+from response_cache import ResponseCache, make_key
+
+
+class TestResponseCache(unittest.TestCase):
+    """応答キャッシュのテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "responses.sqlite3")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_key_covers_all_fields(self):
+        """キーがプロンプトの各要素で変わるテスト"""
+        fields = ["gpt-4o", 0.7, "bash", "ja", "system", "context", "# 一覧"]
+        base = make_key(*fields)
+        self.assertEqual(base, make_key(*fields))
+        for index in range(len(fields)):
+            changed = list(fields)
+            changed[index] = "other" if index != 1 else 0.0
+            self.assertNotEqual(base, make_key(*changed))
+
+    def test_hit_and_miss_counters(self):
+        """ヒット/ミスの回数が記録されるテスト"""
+        cache = ResponseCache(self.path)
+        self.assertIsNone(cache.get("key"))
+        cache.put("key", "ls -la\n")
+        self.assertEqual(cache.get("key"), "ls -la\n")
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'entries': 1})
+        cache.close()
+
+        # 別プロセスから開いても値が残っている
+        cache = ResponseCache(self.path)
+        self.assertEqual(cache.stats()['hits'], 1)
+        cache.close()
+
+    def test_lru_eviction(self):
+        """件数上限を超えると最も古く使われたものから削除されるテスト"""
+        cache = ResponseCache(self.path, max_entries=2, ttl=float("inf"))
+        with patch('response_cache.time.time', return_value=100):
+            cache.put("a", "A")
+        with patch('response_cache.time.time', return_value=101):
+            cache.put("b", "B")
+        with patch('response_cache.time.time', return_value=102):
+            cache.get("a")
+        with patch('response_cache.time.time', return_value=103):
+            cache.put("c", "C")
+
+        self.assertEqual(cache.get("a"), "A")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "C")
+        cache.close()
+
+    def test_ttl_expiry(self):
+        """有効期限を過ぎたエントリが返されないテスト"""
+        cache = ResponseCache(self.path, ttl=60)
+        with patch('response_cache.time.time', return_value=1000):
+            cache.put("key", "old")
+        with patch('response_cache.time.time', return_value=1030):
+            self.assertEqual(cache.get("key"), "old")
+        with patch('response_cache.time.time', return_value=1061):
+            self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.stats()['entries'], 0)
+        cache.close()
+
+
+class TestRunQueryCache(unittest.TestCase):
+    """run_queryでのキャッシュ利用のテストクラス"""
+
+    @classmethod
+    def setUpClass(cls):
+        import codex_query_integrated
+        cls.codex = codex_query_integrated
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        # 過去の応答の索引（history_lookup）は応答キャッシュを使わない場合も使われるため無効にする
+        self.env = patch.dict(os.environ, {'CODEX_CACHE_DIR': self.temp_dir, 'CODEX_NO_CACHE': '',
+                                           'CODEX_HISTORY_LOOKUP': '0'})
+        self.env.start()
+        self.prompt_file = MagicMock()
+        self.prompt_file.config = {
+            'model': 'gpt-4o', 'temperature': 0.7, 'max_tokens': 300, 'shell': 'bash',
+            'multi_turn': 'off', 'token_count': 0, 'language': 'ja'
+        }
+        self.prompt_file.read_prompt_file.return_value = "context\n"
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def run_query(self, client, use_cache=True):
+        captured = StringIO()
+        with patch('sys.stdout', captured):
+            result = self.codex.run_query("# 一覧を表示して", self.prompt_file, client, use_cache)
+        return result, captured.getvalue()
+
+    def make_client(self, contents):
+        client = MagicMock()
+        client.moderations.create.return_value = MagicMock(results=[MagicMock(flagged=False)])
+        chunks = []
+        for content in contents:
+            chunk = MagicMock()
+            chunk.choices = [MagicMock(delta=MagicMock(content=content))]
+            chunks.append(chunk)
+        client.chat.completions.create.return_value = chunks
+        return client
+
+    def test_replay_is_identical(self):
+        """キャッシュヒット時の出力がストリーミング時と同一であるテスト"""
+        client = self.make_client(["# 一覧\n", "ls", " -la"])
+        first, first_output = self.run_query(client)
+        self.assertEqual(first, "# 一覧\nls -la")
+
+        second, second_output = self.run_query(client)
+        self.assertEqual(second, first)
+        self.assertEqual(second_output, first_output)
+        # 2回目はAPIを呼び出さない
+        self.assertEqual(client.chat.completions.create.call_count, 1)
+        self.assertEqual(client.moderations.create.call_count, 1)
+
+    def test_bypass(self):
+        """キャッシュを使わない指定でAPIが毎回呼ばれるテスト"""
+        client = self.make_client(["ls"])
+        self.run_query(client)
+        self.run_query(client, use_cache=False)
+        with patch.dict(os.environ, {'CODEX_NO_CACHE': '1'}):
+            self.run_query(client)
+        self.assertEqual(client.chat.completions.create.call_count, 3)
+
+    def test_key_uses_sent_temperature(self):
+        """キャッシュのキーの温度とAPIに送った温度が同じであるテスト"""
+        self.prompt_file.config['temperature'] = 0.2
+        client = self.make_client(["ls"])
+        result, _ = self.run_query(client)
+        sent = client.chat.completions.create.call_args[1]['temperature']
+        self.assertEqual(sent, 0.2)
+
+        key = make_key('gpt-4o', sent, 'bash', 'ja', self.codex.format_system_prompt('ja', 'bash'),
+                       self.codex.shell_prefix('bash') + "context\n", "# 一覧を表示して")
+        cache = ResponseCache()
+        self.assertEqual(cache.get(key), result)
+        cache.close()
+
+        # 温度を変えると別のキーになり、APIを呼び出す
+        self.prompt_file.config['temperature'] = 0.9
+        self.run_query(client)
+        self.assertEqual(client.chat.completions.create.call_args[1]['temperature'], 0.9)
+        self.assertEqual(client.chat.completions.create.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+response_parser.pyの単体テストプログラム
+"""
+
+import io
+import sys
+import json
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+from response_parser import Pair, ResponseParser
+
+
+def run(deltas):
+    """差分を順に渡し、(パーサー, 差分ごとの出力, 確定したPairのリスト)を返す"""
+    return run_shell(deltas, None)
+
+
+def run_shell(deltas, shell):
+    """シェルを指定してrunと同じことをする"""
+    parser = ResponseParser(shell)
+    outputs = []
+    pairs = []
+    for delta in deltas:
+        text, new_pairs = parser.feed(delta)
+        outputs.append(text)
+        pairs.extend(new_pairs)
+    text, new_pairs = parser.close()
+    outputs.append(text)
+    pairs.extend(new_pairs)
+    return parser, outputs, pairs
+
+
+class TestResponseParser(unittest.TestCase):
+    """逐次パーサーのテストクラス"""
+
+    def test_pairs_across_deltas(self):
+        """行をまたぐ差分でもコマンド行の確定時に組が返るテスト"""
+        parser = ResponseParser()
+        self.assertEqual(parser.feed("# list"), ("# list", []))
+        self.assertEqual(parser.feed(" files\nls"), (" files\nls", []))
+        text, pairs = parser.feed(" -la\n# disk")
+        self.assertEqual(pairs, [Pair("list files", "ls -la")])
+        text, pairs = parser.feed(" usage\ndf -h")
+        self.assertEqual(pairs, [])
+        self.assertEqual(parser.close(), ("", [Pair("disk usage", "df -h")]))
+        self.assertEqual(parser.text(), "# list files\nls -la\n# disk usage\ndf -h")
+
+    def test_strips_fences_and_backticks(self):
+        """コードフェンスの行とコマンドを囲むバッククォートを取り除くテスト"""
+        parser, outputs, pairs = run(["```", "bash\n# show", " date\n`da", "te`\n``", "`\n"])
+        self.assertEqual(parser.text(), "# show date\ndate\n")
+        self.assertEqual(pairs, [Pair("show date", "date")])
+        # フェンスの行は何も出力しない
+        self.assertEqual(outputs[0], "")
+
+    def test_command_substitution_is_kept(self):
+        """コマンドの中のバッククォート（コマンド置換）は保留せずにそのまま出力するテスト"""
+        parser = ResponseParser()
+        self.assertEqual(parser.feed("# run\necho `")[0], "# run\necho `")
+        self.assertEqual(parser.feed("date`")[0], "date`")
+        self.assertEqual(parser.feed(" done\n")[0], " done\n")
+        self.assertEqual(parser.text(), "# run\necho `date` done\n")
+
+        parser, _, pairs = run(["# go to the current directory\ncd `pwd", "`\n# stop foo\nkill `pgrep foo`\n"])
+        self.assertEqual(parser.text(), "# go to the current directory\ncd `pwd`\n# stop foo\nkill `pgrep foo`\n")
+        self.assertEqual(pairs, [Pair("go to the current directory", "cd `pwd`"), Pair("stop foo", "kill `pgrep foo`")])
+
+    def test_only_whole_line_wrapper_is_stripped(self):
+        """行全体を1組のバッククォートで囲んだ場合だけ取り除くテスト"""
+        parser, _, pairs = run(["# now\n`date`\n# both\n`echo `whoami``\n"])
+        self.assertEqual(parser.text(), "# now\ndate\n# both\n`echo `whoami``\n")
+        self.assertEqual(pairs, [Pair("now", "date"), Pair("both", "`echo `whoami``")])
+
+    def test_powershell_continuation(self):
+        """PowerShellでは行末のバッククォートを残し、行継続として1つの組にするテスト"""
+        deltas = ["```powershell\n# list files\nGet-ChildItem `", "\n  -Recurse\n```\n# now\nGet-Date\n"]
+        parser, outputs, pairs = run_shell(deltas, "powershell")
+        self.assertEqual(outputs[0], "# list files\nGet-ChildItem `")
+        self.assertEqual(parser.text(), "# list files\nGet-ChildItem `\n  -Recurse\n# now\nGet-Date\n")
+        self.assertEqual(pairs, [Pair("list files", "Get-ChildItem `\n  -Recurse"), Pair("now", "Get-Date")])
+
+    def test_continuation(self):
+        """「\\」で続くコマンドは最後の行で1つの組になるテスト"""
+        _, _, pairs = run(["# build\n", "make \\\n", "  -j4\n", "# clean\n"])
+        self.assertEqual(pairs, [Pair("build", "make \\\n  -j4"), Pair("clean", None)])
+
+    def test_multiple_comments(self):
+        """コメントが複数行の場合は連結されるテスト"""
+        _, _, pairs = run(["# find large files\n# in home\nfind ~ -size +100M\npwd\n"])
+        self.assertEqual(pairs, [Pair("find large files in home", "find ~ -size +100M"), Pair(None, "pwd")])
+
+    def test_print_stream_events(self):
+        """eventsモードでは組ごとにJSONの1行を出力するテスト"""
+        import codex_query_integrated as codex
+        stream = io.StringIO()
+        deltas = ["```bash\n# 一覧", "を表示\nls", " -la\n```", None]
+        with patch('sys.stdout', stream):
+            result = codex._print_stream(deltas, events=True)
+        self.assertEqual(result, "# 一覧を表示\nls -la\n")
+        lines = stream.getvalue().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [{"comment": "一覧を表示", "command": "ls -la"}])
+        self.assertIn("一覧", lines[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
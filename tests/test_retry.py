@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+retry.pyの単体テストプログラム
+"""
+
+import sys
+import time
+import threading
+import unittest
+from unittest.mock import MagicMock, AsyncMock
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+import retry
+
+
+class FakeStatusError(Exception):
+    """ステータスコードとヘッダーを持つAPIエラー"""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__("status {}".format(status_code))
+        self.status_code = status_code
+        self.response = MagicMock(headers=headers or {})
+
+
+class APIConnectionError(Exception):
+    pass
+
+
+class APITimeoutError(APIConnectionError):
+    pass
+
+
+def chunk(content):
+    return MagicMock(choices=[MagicMock(delta=MagicMock(content=content))])
+
+
+class FakeStream:
+    """最初のトークンまでdelay秒かかるストリーム"""
+
+    def __init__(self, text, delay=0.0):
+        self.text = text
+        self.delay = delay
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        yield chunk("")
+        if self.closed.wait(self.delay):
+            raise APIConnectionError("closed")
+        yield chunk(self.text)
+        yield chunk("\n")
+
+    def close(self):
+        self.closed.set()
+
+
+class FakeAsyncStream:
+    """FakeStreamのasyncio版"""
+
+    def __init__(self, text, delay=0.0):
+        self.text = text
+        self.delay = delay
+        self.closed = False
+
+    async def __aiter__(self):
+        import asyncio
+        yield chunk("")
+        await asyncio.sleep(self.delay)
+        yield chunk(self.text)
+        yield chunk("\n")
+
+    async def close(self):
+        self.closed = True
+
+
+class TestRetry(unittest.TestCase):
+    """再試行とヘッジリクエストのテストクラス"""
+
+    def test_retry_after(self):
+        """retry-after-ms、秒数、HTTP日付のRetry-Afterを読むテスト"""
+        self.assertEqual(retry.retry_after(FakeStatusError(429, {'retry-after-ms': '250'})), 0.25)
+        self.assertEqual(retry.retry_after(FakeStatusError(429, {'retry-after': '3'})), 3.0)
+        date = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() + 30))
+        self.assertAlmostEqual(retry.retry_after(FakeStatusError(429, {'retry-after': date})), 30, delta=2)
+        self.assertIsNone(retry.retry_after(FakeStatusError(429)))
+        self.assertIsNone(retry.retry_after(ValueError()))
+
+    def test_is_retryable(self):
+        """レート制限、サーバーエラー、接続エラーだけを再試行するテスト"""
+        for status in (408, 409, 429, 500, 503):
+            self.assertTrue(retry.is_retryable(FakeStatusError(status)))
+        for status in (400, 401, 404):
+            self.assertFalse(retry.is_retryable(FakeStatusError(status)))
+        self.assertTrue(retry.is_retryable(APITimeoutError()))
+        self.assertFalse(retry.is_retryable(ValueError()))
+
+    def test_delay_for(self):
+        """Retry-Afterを優先し、なければジッター付きの指数バックオフで上限までにするテスト"""
+        self.assertEqual(retry.delay_for(FakeStatusError(429, {'retry-after': '2'}), 0, 0.5, 20), 2.0)
+        self.assertEqual(retry.delay_for(FakeStatusError(429, {'retry-after': '60'}), 0, 0.5, 20), 20)
+        delays = [retry.delay_for(FakeStatusError(500), 3, 0.5, 20) for _ in range(50)]
+        self.assertTrue(all(0 <= delay <= 4 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_call(self):
+        """再試行できるエラーは待って呼び直し、回数を超えるか再試行できなければ送出するテスト"""
+        sleeps = []
+        function = MagicMock(side_effect=[FakeStatusError(429, {'retry-after': '1'}), FakeStatusError(503), "ok"])
+        self.assertEqual(retry.call(function, max_retries=3, backoff=0.1, sleep=sleeps.append), "ok")
+        self.assertEqual(function.call_count, 3)
+        self.assertEqual(sleeps[0], 1.0)
+        self.assertLessEqual(sleeps[1], 0.2)
+
+        function = MagicMock(side_effect=FakeStatusError(429))
+        with self.assertRaises(FakeStatusError):
+            retry.call(function, max_retries=2, backoff=0, sleep=sleeps.append)
+        self.assertEqual(function.call_count, 3)
+
+        function = MagicMock(side_effect=FakeStatusError(400))
+        with self.assertRaises(FakeStatusError):
+            retry.call(function, max_retries=2, sleep=sleeps.append)
+        self.assertEqual(function.call_count, 1)
+
+    def test_call_async(self):
+        """asyncio版も再試行できるエラーだけを待って呼び直すテスト"""
+        import asyncio
+        function = AsyncMock(side_effect=[FakeStatusError(429, {'retry-after-ms': '10'}), "ok"])
+        self.assertEqual(asyncio.run(retry.call_async(function, max_retries=1)), "ok")
+        self.assertEqual(function.await_count, 2)
+
+        function = AsyncMock(side_effect=FakeStatusError(400))
+        with self.assertRaises(FakeStatusError):
+            asyncio.run(retry.call_async(function, max_retries=2))
+        self.assertEqual(function.await_count, 1)
+
+    def test_hedge_not_needed(self):
+        """最初のトークンが早ければヘッジリクエストを送らないテスト"""
+        create = MagicMock(side_effect=[FakeStream("ls")])
+        stream = retry.open_stream(create, hedge_after=1)
+        self.assertEqual("".join(c.choices[0].delta.content for c in stream), "ls\n")
+        self.assertEqual((create.call_count, stream.attempt), (1, 0))
+
+    def test_hedge_wins(self):
+        """最初のトークンが遅いとヘッジリクエストを送り、先に応答した方を使って遅い方を閉じるテスト"""
+        slow = FakeStream("slow", delay=5)
+        fast = FakeStream("fast")
+        create = MagicMock(side_effect=[slow, fast])
+        started = time.monotonic()
+        stream = retry.open_stream(create, hedge_after=0.05)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual("".join(c.choices[0].delta.content for c in stream), "fast\n")
+        self.assertEqual(stream.attempt, 1)
+        self.assertTrue(slow.closed.is_set())
+        self.assertFalse(fast.closed.is_set())
+
+    def test_hedge_errors_are_retried(self):
+        """両方のリクエストが失敗した場合は再試行するテスト"""
+        create = MagicMock(side_effect=[FakeStatusError(429), FakeStream("ls")])
+        stream = retry.open_stream(create, max_retries=1, backoff=0, hedge_after=1, sleep=lambda _: None)
+        self.assertEqual("".join(c.choices[0].delta.content for c in stream), "ls\n")
+        self.assertEqual(create.call_count, 2)
+
+    def test_hedge_async(self):
+        """asyncio版も最初のトークンが遅い場合だけヘッジリクエストを送り、遅い方を取り消して閉じるテスト"""
+        import asyncio
+
+        async def read(create, hedge_after):
+            stream = await retry.open_stream_async(create, hedge_after=hedge_after)
+            return stream, "".join([c.choices[0].delta.content async for c in stream])
+
+        create = AsyncMock(side_effect=[FakeAsyncStream("ls")])
+        stream, text = asyncio.run(read(create, 1))
+        self.assertEqual(text, "ls\n")
+        self.assertEqual((create.await_count, stream.attempt), (1, 0))
+
+        slow = FakeAsyncStream("slow", delay=5)
+        fast = FakeAsyncStream("fast")
+        create = AsyncMock(side_effect=[slow, fast])
+        started = time.monotonic()
+        stream, text = asyncio.run(read(create, 0.05))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(text, "fast\n")
+        self.assertEqual((create.await_count, stream.attempt), (2, 1))
+        self.assertTrue(slow.closed)
+        self.assertFalse(fast.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
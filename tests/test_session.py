@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+session.pyと、端末ごとのセッションの同時書き込みのテストプログラム
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from unittest.mock import patch
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+from session import DEFAULT_SESSION, sanitize, session_id
+from history_store import HistoryStore
+from prompt_file import PromptFile
+
+# ストレステストの規模
+WRITERS = 32
+TURNS_PER_WRITER = 25
+SESSIONS = 4
+
+
+def write_turns(db_path, writer):
+    """1つの端末として、ターンの追加と履歴の読み取りを繰り返す"""
+    # 複数の端末で共有するセッションと、この端末だけのセッション
+    shared = HistoryStore(db_path, "s{}".format(writer % SESSIONS))
+    private = HistoryStore(db_path, "p{}".format(writer))
+    for turn in range(TURNS_PER_WRITER):
+        text = "# writer {} turn {}\necho {}\n\n".format(writer, turn, turn)
+        shared.append(text)
+        # 予算に余裕があるため何も削除されない読み取り
+        shared.window(10 ** 9)
+        # 取り消し用のターンを追加してすぐに取り消す
+        private.append(text)
+        private.append("# writer {} scratch {}\n\n".format(writer, turn))
+        private.pop()
+    shared.close()
+    private.close()
+
+
+class TestSessionId(unittest.TestCase):
+    """セッションIDのテストクラス"""
+
+    def test_env_var_wins(self):
+        """CODEX_SESSIONが端末名より優先されるテスト"""
+        with patch.dict(os.environ, {'CODEX_SESSION': 'work/../1'}), \
+                patch('session._tty_name', return_value='/dev/pts/3'):
+            self.assertEqual(session_id(), 'work-..-1')
+
+    def test_tty_name(self):
+        """端末名からセッションIDを作るテスト"""
+        with patch.dict(os.environ, {'CODEX_SESSION': ''}), \
+                patch('session._tty_name', return_value='/dev/pts/3'):
+            self.assertEqual(session_id(), 'pts-3')
+        with patch.dict(os.environ, {'CODEX_SESSION': ''}), \
+                patch('session._tty_name', return_value=None):
+            self.assertEqual(session_id(), DEFAULT_SESSION)
+
+    def test_sanitize(self):
+        """ファイル名に使えない文字が残らないテスト"""
+        self.assertEqual(sanitize('../../etc/passwd'), 'etc-passwd')
+        self.assertEqual(sanitize('///'), DEFAULT_SESSION)
+
+
+class TestSessionStore(unittest.TestCase):
+    """セッションの分離と同時書き込みのテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, "history.sqlite3")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_sessions_are_isolated(self):
+        """セッションごとに履歴と取り消しが分かれるテスト"""
+        first = HistoryStore(self.db_path, "pts-1")
+        second = HistoryStore(self.db_path, "pts-2")
+        first.reset("# example\nls\n\n")
+        second.reset("# example\nls\n\n")
+        first.append("# first\npwd\n\n")
+        second.append("# second\ndate\n\n")
+
+        self.assertEqual(first.pop()[0], "# first\npwd\n\n")
+        self.assertIsNone(first.pop())
+        self.assertEqual(second.last(1), ["# second\ndate\n\n"])
+        first.close()
+        second.close()
+
+    def test_parallel_writers(self):
+        """多数の端末が同時に書き込んでもターンが失われず重複もしないテスト"""
+        HistoryStore(self.db_path).close()
+        context = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+        processes = [context.Process(target=write_turns, args=(self.db_path, writer)) for writer in range(WRITERS)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+
+        for index in range(SESSIONS):
+            store = HistoryStore(self.db_path, "s{}".format(index))
+            turns = store.turns()
+            store.close()
+
+            writers = [writer for writer in range(WRITERS) if writer % SESSIONS == index]
+            expected = ["# writer {} turn {}\necho {}\n\n".format(writer, turn, turn)
+                        for writer in writers for turn in range(TURNS_PER_WRITER)]
+            self.assertEqual(len(turns), len(expected))
+            self.assertEqual(sorted(turns), sorted(expected))
+            # 各端末のターンは書き込んだ順に並ぶ
+            for writer in writers:
+                own = [t for t in expected if t.startswith("# writer {} ".format(writer))]
+                self.assertEqual([turn for turn in turns if turn.startswith("# writer {} ".format(writer))], own)
+
+                store = HistoryStore(self.db_path, "p{}".format(writer))
+                self.assertEqual(store.turns(), own)
+                store.close()
+
+    def test_prompt_file_per_session(self):
+        """セッションごとに設定と書き出し先が分かれるテスト"""
+        config = {'model': 'gpt-4o', 'temperature': 0, 'max_tokens': 300,
+                  'shell': 'bash', 'multi_turn': 'on', 'token_count': 0, 'language': 'en'}
+        with patch.dict(os.environ, {'CODEX_CACHE_DIR': self.temp_dir}):
+            first = PromptFile("current_context.txt", config, "pts-1")
+            second = first.for_session("pts-2")
+            first.add_input_output_pair("# first", "pwd")
+            first.flush_config()
+            second.flush_config()
+
+        self.assertEqual(second.store.turns(), [])
+        self.assertNotEqual(first.config_path, second.config_path)
+        self.assertEqual(os.path.dirname(first.file_path), os.path.join(self.temp_dir, "sessions"))
+        self.assertGreater(first.config.token_count, 0)
+        self.assertEqual(second.config.token_count, 0)
+        first.store.close()
+        second.store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+shell_cache.pyと、キャッシュを使うシェル検出のテストプログラム
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+import shell_cache
+import codex_query_integrated as codex
+
+
+class TestShellCache(unittest.TestCase):
+    """シェル検出結果のキャッシュのテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.env = patch.dict(os.environ, {'CODEX_CACHE_DIR': self.temp_dir, 'CODEX_SHELL': ''})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_store_and_lookup(self):
+        """保存した結果を親プロセスごとに読み出せるテスト"""
+        self.assertIsNone(shell_cache.lookup())
+        shell_cache.store("zsh", "/path/to/zsh-context.txt")
+        self.assertEqual(shell_cache.lookup(), ("zsh", "/path/to/zsh-context.txt"))
+        self.assertIsNone(shell_cache.lookup(shell_cache.cache_file(os.getppid() + 1)))
+
+    def test_expired_entries(self):
+        """期限切れの結果は使わず、次の保存時に削除するテスト"""
+        old = shell_cache.cache_file(1)
+        shell_cache.store("bash", None, old)
+        expired = time.time() - shell_cache.SHELL_CACHE_TTL - 60
+        os.utime(old, (expired, expired))
+        self.assertIsNone(shell_cache.lookup(old))
+
+        shell_cache.store("zsh", None)
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(shell_cache.lookup(), ("zsh", None))
+
+    def test_detect_shell_uses_env(self):
+        """CODEX_SHELLがあれば親プロセスを調べないテスト"""
+        with patch.dict(os.environ, {'CODEX_SHELL': 'zsh'}), \
+                patch('codex_query_integrated.os.name', 'posix'), \
+                patch('codex_query_integrated._parent_process_name') as mock_parent:
+            codex.detect_shell()
+        self.assertEqual(codex.SHELL, "zsh")
+        mock_parent.assert_not_called()
+        self.assertTrue(str(codex.PROMPT_CONTEXT).endswith("zsh-context.txt"))
+
+    def test_detect_shell_uses_cache(self):
+        """2回目は親プロセスを調べずにキャッシュを使うテスト"""
+        with patch('codex_query_integrated.os.name', 'posix'), \
+                patch('codex_query_integrated._parent_process_name', return_value='zsh') as mock_parent:
+            codex.detect_shell()
+            codex.detect_shell()
+        self.assertEqual(codex.SHELL, "zsh")
+        self.assertEqual(mock_parent.call_count, 1)
+        self.assertEqual(shell_cache.lookup(), ("zsh", str(codex.PROMPT_CONTEXT)))
+
+
+if __name__ == '__main__':
+    unittest.main()
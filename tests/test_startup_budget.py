@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+組み込みコマンド実行時に重いモジュールを読み込まないことを確認するテスト
+
+python -X importtime でcodex_query_integrated.pyを実行し、
+組み込みコマンドではOpenAI SDKやpsutilが読み込まれないこと、
+APIキーがなくても組み込みコマンドを実行できることを確認する。
+インポート時間と実行時間の計測は benchmarks/startup_budget.py で行う
+（負荷の高いCI環境で不安定にならないよう、単体テストでは時間を判定しない）。
+"""
+
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import unittest
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent
+
+# 組み込みコマンドで読み込まれてはいけないモジュール
+HEAVY_MODULES = ('openai', 'psutil', 'httpx', 'pydantic', 'platform')
+
+
+def parse_importtime(stderr):
+    """-X importtime の出力を (モジュール名, 自身の時間[us]) のリストにする"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(self_us)))
+    return modules
+
+
+class TestStartupBudget(unittest.TestCase):
+    """組み込みコマンドの起動コストのテストクラス"""
+
+    def setUp(self):
+        # リポジトリのファイルを書き換えないよう、一時ディレクトリにコピーして実行する
+        self.temp_dir = tempfile.mkdtemp()
+        shutil.copytree(PROJECT_ROOT / 'src', os.path.join(self.temp_dir, 'src'),
+                        ignore=shutil.ignore_patterns('__pycache__'))
+        shutil.copytree(PROJECT_ROOT / 'contexts', os.path.join(self.temp_dir, 'contexts'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def run_command(self, command, api_key='test_api_key'):
+        env = dict(os.environ)
+        env.pop('OPENAI_API_KEY', None)
+        env.update({
+            'HOME': self.temp_dir,
+            'USERPROFILE': self.temp_dir,
+            'PYTHONDONTWRITEBYTECODE': '1',
+        })
+        if api_key:
+            env['OPENAI_API_KEY'] = api_key
+        script = os.path.join(self.temp_dir, 'src', 'codex_query_integrated.py')
+        return subprocess.run(
+            [sys.executable, '-X', 'importtime', script],
+            input=command.encode('utf-8'),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            cwd=self.temp_dir,
+            timeout=30,
+        )
+
+    def assert_light(self, command, api_key='test_api_key'):
+        result = self.run_command(command, api_key)
+        self.assertEqual(result.returncode, 0, result.stdout.decode('utf-8', errors='replace'))
+
+        names = [name for name, _ in parse_importtime(result.stderr.decode('utf-8', errors='replace'))]
+        for heavy in HEAVY_MODULES:
+            loaded = [name for name in names if name == heavy or name.startswith(heavy + '.')]
+            self.assertEqual(loaded, [], f"{command!r} で {heavy} が読み込まれました")
+        return result.stdout.decode('utf-8')
+
+    def test_show_config(self):
+        """# show config で重いモジュールを読み込まないテスト"""
+        output = self.assert_light("# show config")
+        self.assertIn("# model:", output)
+
+    def test_start_multi_turn(self):
+        """# start multi-turn で重いモジュールを読み込まないテスト"""
+        output = self.assert_light("# start multi-turn")
+        self.assertIn("Multi turn mode is on", output)
+
+    def test_load_context(self):
+        """# load context で重いモジュールを読み込まないテスト"""
+        output = self.assert_light("# load context bash-context")
+        self.assertIn("Context loaded from bash-context.txt", output)
+
+    def test_builtin_without_api_key(self):
+        """APIキーがなくても組み込みコマンドを実行でき、クエリの場合だけ終了するテスト"""
+        output = self.assert_light("# show config", api_key=None)
+        self.assertIn("# model:", output)
+
+        result = self.run_command("# list files", api_key=None)
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("OPENAI_API_KEY", result.stdout.decode('utf-8', errors='replace'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+text_reader.pyの単体テストプログラム
+"""
+
+import os
+import sys
+import codecs
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+import text_reader
+from text_reader import decode, read_text
+
+
+class TestTextReader(unittest.TestCase):
+    """文字コード判定とキャッシュのテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "context.txt")
+        text_reader.forget()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        text_reader.forget()
+
+    def write(self, data, mtime_ns=None):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        if mtime_ns is not None:
+            os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def test_decode(self):
+        """BOMと文字コードの候補から判定するテスト"""
+        text = "# ファイル一覧\nls\n"
+        self.assertEqual(decode(text.encode('utf-8')), (text, 'utf-8'))
+        self.assertEqual(decode(text.encode('cp932')), (text, 'cp932'))
+        self.assertEqual(decode(codecs.BOM_UTF8 + text.encode('utf-8')), (text, 'utf-8-sig'))
+        self.assertEqual(decode(text.encode('utf-16')), (text, 'utf-16'))
+        self.assertEqual(decode("café".encode('cp1252'), ('utf-8', 'cp1252')), ("café", 'cp1252'))
+
+    def test_reads_once_while_unchanged(self):
+        """更新時刻とサイズが同じなら2回目はファイルを開かないテスト"""
+        self.write("# 日本語\nls\n".encode('cp932'), 1_000_000_000)
+        with patch('builtins.open', wraps=open) as mock_open:
+            self.assertEqual(read_text(self.path), ("# 日本語\nls\n", 'cp932'))
+            self.assertEqual(read_text(self.path), ("# 日本語\nls\n", 'cp932'))
+        self.assertEqual(mock_open.call_count, 1)
+
+        # 変更されたら読み直す
+        self.write("# 英語\nls -la\n".encode('utf-8'), 2_000_000_000)
+        self.assertEqual(read_text(self.path), ("# 英語\nls -la\n", 'utf-8'))
+
+    def test_large_file_keeps_encoding_only(self):
+        """大きなファイルは内容を保存せず、文字コードだけを次回に使うテスト"""
+        text = "# 大きなファイル\n" * 10
+        self.write(text.encode('cp932'))
+        with patch('text_reader.MAX_CACHED_BYTES', 10), patch('builtins.open', wraps=open) as mock_open, \
+                patch('text_reader.decode', wraps=decode) as mock_decode:
+            read_text(self.path)
+            self.assertEqual(read_text(self.path), (text, 'cp932'))
+        self.assertEqual(mock_open.call_count, 2)
+        self.assertEqual(mock_decode.call_args[0][1][0], 'cp932')
+
+    def test_missing_file(self):
+        """存在しないファイルはOSErrorになるテスト"""
+        with self.assertRaises(OSError):
+            read_text(os.path.join(self.temp_dir, "missing.txt"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+timeouts.pyの単体テストプログラム
+"""
+
+import os
+import sys
+import time
+import unittest
+from unittest.mock import patch
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+import timeouts
+from timeouts import Deadline, QueryTimeout
+
+
+def slow_stream(delays, text="ab"):
+    """delaysの秒数ずつ待ってから差分を返す"""
+    for delay in delays:
+        time.sleep(delay)
+        yield text
+
+
+class TestTimeouts(unittest.TestCase):
+    """締め切りとタイムアウトのテストクラス"""
+
+    def setUp(self):
+        self.timeouts = patch.dict('timeouts.TIMEOUTS', {'query': 0, 'connect': 0, 'first_token': 0, 'idle': 0})
+        self.timeouts.start()
+
+    def tearDown(self):
+        self.timeouts.stop()
+
+    def test_configure(self):
+        """設定ファイルの値を反映し、環境変数で指定された段階と不正な値は変えないテスト"""
+        with patch.dict(os.environ, {'CODEX_IDLE_TIMEOUT': '5'}):
+            timeouts.configure({'query': 20, 'idle': 30, 'first_token': 'soon', 'unknown': 1})
+        self.assertEqual(timeouts.TIMEOUTS['query'], 20.0)
+        self.assertEqual(timeouts.TIMEOUTS['idle'], 0)
+        self.assertEqual(timeouts.TIMEOUTS['first_token'], 0)
+        self.assertEqual(timeouts.limit('query'), 20.0)
+        self.assertIsNone(timeouts.limit('idle'))
+
+    def test_deadline(self):
+        """残り時間で制限時間を縮め、過ぎたらQueryTimeoutを送出するテスト"""
+        self.assertIsNone(Deadline().remaining())
+        self.assertEqual(Deadline().bound(5), 5)
+
+        deadline = Deadline(10)
+        self.assertEqual(deadline.bound(3), 3)
+        self.assertLessEqual(deadline.bound(30), 10)
+        self.assertLessEqual(deadline.bound(None), 10)
+        deadline.check()
+
+        deadline = Deadline(0.01)
+        time.sleep(0.02)
+        self.assertEqual(deadline.bound(3), 0.0)
+        with self.assertRaises(QueryTimeout) as raised:
+            deadline.check()
+        self.assertEqual(raised.exception.phase, 'query')
+
+    def test_request_timeouts(self):
+        """HTTPの読み込みタイムアウトは最初のトークンと差分の間隔の長い方に余裕を加えるテスト"""
+        self.assertEqual(timeouts.request_timeouts(), (None, None))
+        timeouts.TIMEOUTS.update(connect=5, first_token=20, idle=10)
+        self.assertEqual(timeouts.request_timeouts(), (20 + timeouts.READ_GRACE, 5))
+        read, connect = timeouts.request_timeouts(Deadline(2))
+        self.assertLessEqual(read, 2 + timeouts.READ_GRACE)
+        self.assertLessEqual(connect, 2)
+
+    def test_watch_disabled(self):
+        """タイムアウトがすべて無効ならそのまま返すテスト"""
+        contents = ["a", "b"]
+        self.assertEqual(list(timeouts.watch(contents)), contents)
+
+    def test_watch_phases(self):
+        """最初のトークン、差分の間隔、全体の締め切りをそれぞれ判定するテスト"""
+        timeouts.TIMEOUTS.update(first_token=0.1, idle=0.1)
+        self.assertEqual(list(timeouts.watch(slow_stream([0.05, 0.05, 0.05]))), ["ab"] * 3)
+
+        # 空の差分は最初のトークンとみなさない
+        with self.assertRaises(QueryTimeout) as raised:
+            list(timeouts.watch(slow_stream([0, 0.3], "")))
+        self.assertEqual(raised.exception.phase, 'first_token')
+
+        received = []
+        with self.assertRaises(QueryTimeout) as raised:
+            for content in timeouts.watch(slow_stream([0, 0.05, 0.3])):
+                received.append(content)
+        self.assertEqual((raised.exception.phase, received), ('idle', ["ab", "ab"]))
+
+        timeouts.TIMEOUTS.update(first_token=0, idle=0)
+        started = time.monotonic()
+        with self.assertRaises(QueryTimeout) as raised:
+            list(timeouts.watch(slow_stream([0.05] * 20), Deadline(0.2)))
+        self.assertEqual(raised.exception.phase, 'query')
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_watch_errors(self):
+        """読み込み中のエラーをそのまま送出するテスト"""
+        def failing():
+            yield "a"
+            raise ValueError("broken")
+
+        timeouts.TIMEOUTS.update(idle=1)
+        with self.assertRaises(ValueError):
+            list(timeouts.watch(failing()))
+
+
+if __name__ == '__main__':
+    unittest.main()
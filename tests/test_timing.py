@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+timing.pyの単体テストプログラム
+"""
+
+import io
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+import timing
+from commands import get_command_result
+
+
+class TestTiming(unittest.TestCase):
+    """処理時間の計測のテストクラス"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.env = patch.dict(os.environ, {'CODEX_CACHE_DIR': self.temp_dir})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_disabled(self):
+        """無効な場合は共通の空のspanを返し、何も書き出さないテスト"""
+        with patch('timing.TIMING_MODE', ''):
+            timing.begin()
+            self.assertIs(timing.span("load_config"), timing._NULL_SPAN)
+            contents = iter(["ls"])
+            self.assertIs(timing.timed_stream(contents), contents)
+            timing.end()
+        self.assertFalse(os.path.exists(timing.timings_path()))
+
+    def test_record_phases(self):
+        """処理ごとの時間が1行のJSONとして記録されるテスト"""
+        with patch('timing.TIMING_MODE', '1'):
+            timing.begin()
+            with timing.span("context"):
+                pass
+            with timing.span("context"):
+                pass
+            timing.annotate(kind="query")
+            self.assertEqual(list(timing.timed_stream(iter([None, "ls", " -la"]))), [None, "ls", " -la"])
+            timing.end()
+
+        records = timing.read_records()
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record["kind"], "query")
+        self.assertEqual(record["status"], "ok")
+        self.assertEqual(set(record["phases"]), {"context", "first_token", "stream"})
+        self.assertIn("ttft", record["marks"])
+        self.assertGreaterEqual(record["total_ms"], record["marks"]["ttft"])
+        # 終了後は計測しない
+        self.assertIs(timing.span("context"), timing._NULL_SPAN)
+
+    def test_stderr_mode(self):
+        """stderrモードでは標準エラー出力に書き出すテスト"""
+        stream = io.StringIO()
+        with patch('timing.TIMING_MODE', 'stderr'), patch('sys.stderr', stream):
+            timing.begin()
+            timing.end("error")
+        self.assertEqual(json.loads(stream.getvalue())["status"], "error")
+        self.assertFalse(os.path.exists(timing.timings_path()))
+
+    def test_summarize(self):
+        """p50とp95をnearest-rank法で求めるテスト"""
+        records = [{"kind": "query", "phases": {"request": float(ms)}, "total_ms": float(ms) * 2}
+                   for ms in range(1, 101)]
+        summary = timing.summarize(records)
+        self.assertEqual(summary["request"], (100, 50.0, 95.0))
+        self.assertEqual(summary["total (query)"], (100, 100.0, 190.0))
+
+    def test_show_stats(self):
+        """# show statsで処理ごとの集計を表示するテスト"""
+        prompt_file = MagicMock()
+        with patch('timing.TIMING_MODE', '1'):
+            for _ in range(3):
+                timing.begin()
+                with timing.span("moderation"):
+                    pass
+                timing.end()
+
+        stream = io.StringIO()
+        with patch('sys.stdout', stream):
+            result, _ = get_command_result("# show stats", prompt_file)
+        self.assertEqual(result, "stats shown")
+        self.assertIn("last 3 runs", stream.getvalue())
+        self.assertRegex(stream.getvalue(), r"# moderation\s+3 ")
+
+    def test_query_containing_command_is_not_a_command(self):
+        """コマンド名を含むだけのクエリはモデルに渡すテスト"""
+        for query in ("# show stats for docker containers\n", "# show cache usage of the disk\n",
+                      "# clear response cache of nginx\n"):
+            with patch('sys.stdout', io.StringIO()):
+                result, _ = get_command_result(query, MagicMock())
+            self.assertEqual(result, "", query)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+tokenizer.pyの単体テストプログラム
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+from pathlib import Path
+
+# テスト対象のモジュールパスを追加
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+import tokenizer
+from tokenizer import count_tokens, estimate_tokens
+
+
+class TestTokenizer(unittest.TestCase):
+    """トークン数計測のテストクラス"""
+
+    def test_japanese_is_not_one_word(self):
+        """空白のない日本語が1語として数えられないテスト"""
+        text = "現在のディレクトリで最大のファイルを表示して"
+        self.assertEqual(len(text.split()), 1)
+        self.assertGreaterEqual(estimate_tokens(text), 10)
+
+    def test_shell_one_liner(self):
+        """記号の多いシェルコマンドが単語数より多く数えられるテスト"""
+        command = "ps aux | sort -nrk 3,3 | head -n 10"
+        self.assertGreater(estimate_tokens(command), len(command.split()))
+
+    def test_english_words(self):
+        """短い英単語はおよそ1語1トークンになるテスト"""
+        self.assertEqual(estimate_tokens("what is my ip"), 4)
+        self.assertEqual(estimate_tokens(""), 0)
+
+    def test_count_is_sum_of_lines(self):
+        """複数行のトークン数が行ごとの合計になるテスト"""
+        lines = ["# 一覧を表示\n", "ls -la\n", "\n"]
+        self.assertEqual(count_tokens(''.join(lines)), sum(count_tokens(line) for line in lines))
+
+    def test_lines_are_memoized(self):
+        """同じ行は再計算されないテスト"""
+        tokenizer._count_line.cache_clear()
+        text = "# list files\nls -la\n"
+        count_tokens(text)
+        count_tokens(text)
+        info = tokenizer._count_line.cache_info()
+        self.assertEqual(info.misses, 2)
+        self.assertEqual(info.hits, 2)
+
+    def test_fallback_without_tiktoken(self):
+        """tiktokenが使えない場合に推定値を使うテスト"""
+        with patch('tokenizer._encoding', None), patch('tokenizer._encoding_loaded', True):
+            tokenizer._count_line.cache_clear()
+            self.assertEqual(count_tokens("日本語"), estimate_tokens("日本語"))
+        tokenizer._count_line.cache_clear()
+
+    def test_no_download_without_vocab(self):
+        """語彙ファイルがなければtiktokenを呼ばず（ネットワークから取得せず）推定値を使うテスト"""
+        fake_tiktoken = MagicMock()
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                patch.dict(os.environ, {'TIKTOKEN_CACHE_DIR': temp_dir}), \
+                patch.dict(sys.modules, {'tiktoken': fake_tiktoken}), \
+                patch('tokenizer._encoding', None), patch('tokenizer._encoding_loaded', False):
+            self.assertIsNone(tokenizer._load_encoding())
+            fake_tiktoken.Encoding.assert_not_called()
+
+            # 語彙ファイルがあれば直接読み込んでエンコーディングを作る
+            with open(tokenizer.vocab_path(), 'w') as f:
+                f.write("bHM= 0\nIC1sYQ== 1\n")
+            tokenizer._encoding_loaded = False
+            self.assertIs(tokenizer._load_encoding(), fake_tiktoken.Encoding.return_value)
+            _, kwargs = fake_tiktoken.Encoding.call_args
+            self.assertEqual(kwargs['mergeable_ranks'], {b"ls": 0, b" -la": 1})
+
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                patch.dict(os.environ, {'TIKTOKEN_CACHE_DIR': temp_dir}), \
+                patch.dict(sys.modules, {'tiktoken': fake_tiktoken}), \
+                patch('tokenizer._encoding', None), patch('tokenizer._encoding_loaded', False):
+            # tiktokenのキャッシュの設定（プロセス全体の環境変数）は変更しない
+            os.environ.pop('TIKTOKEN_CACHE_DIR')
+            with patch('tokenizer.cache_db.cache_path', return_value=temp_dir):
+                with open(tokenizer.vocab_path(), 'w') as f:
+                    f.write("bHM= 0\n")
+                self.assertIsNotNone(tokenizer._load_encoding())
+            self.assertNotIn('TIKTOKEN_CACHE_DIR', os.environ)
+
+
+if __name__ == '__main__':
+    unittest.main()